@@ -0,0 +1,234 @@
+import json
+import os
+from typing import Dict, Optional, Tuple
+
+import nibabel as nib
+import numpy as np
+
+from brainles_preprocessing.brain_extraction.brain_extractor import BrainExtractor
+
+# volume shape and isotropic spacing in mm per resolution
+RESOLUTIONS: Dict[str, Tuple[Tuple[int, int, int], float]] = {
+    "low": ((64, 64, 48), 3.0),
+    "medium": ((128, 128, 96), 1.5),
+    "full": ((240, 240, 155), 1.0),
+}
+
+# intensity of skull, brain and tumor per modality
+CONTRASTS: Dict[str, Tuple[float, float, float]] = {
+    "t1c": (0.2, 0.6, 1.0),
+    "t2": (0.3, 0.5, 0.9),
+    "t1": (0.2, 0.7, 0.4),
+    "fla": (0.25, 0.55, 0.8),
+}
+
+# ellipsoid radii in mm, and the tumor center and radius
+HEAD_RADII = (80.0, 95.0, 70.0)
+BRAIN_RADII = (68.0, 83.0, 58.0)
+TUMOR_CENTER = (20.0, 10.0, 10.0)
+TUMOR_RADIUS = 15.0
+
+# rotation about z (radians) and translation (mm) of the head per modality, written by make_patient
+MISALIGNMENT_FILE = "misalignment.json"
+
+
+def _affine(shape: Tuple[int, int, int], spacing: float) -> np.ndarray:
+    affine = np.diag([spacing, spacing, spacing, 1.0])
+    affine[:3, 3] = -(np.asarray(shape) - 1) / 2 * spacing
+    return affine
+
+
+def _coordinates(
+    shape: Tuple[int, int, int],
+    spacing: float,
+    rotation: float = 0.0,
+    translation: Tuple[float, float, float] = (0.0, 0.0, 0.0),
+) -> np.ndarray:
+    """Physical coordinates of every voxel, in the frame of a head rotated about z and translated."""
+    grid = np.stack(np.meshgrid(*[np.arange(n) for n in shape], indexing="ij"), axis=-1).astype(np.float32)
+    points = (grid - (np.asarray(shape) - 1) / 2) * spacing - np.asarray(translation)
+    cos, sin = np.cos(rotation), np.sin(rotation)
+    x, y = cos * points[..., 0] + sin * points[..., 1], -sin * points[..., 0] + cos * points[..., 1]
+    return np.stack([x, y, points[..., 2]], axis=-1)
+
+
+def _ellipsoid(points: np.ndarray, center, radii, sharpness: float = 12.0) -> np.ndarray:
+    # soft edges, so that the phantoms are registered like real images rather than binary shapes
+    radius = np.sqrt((((points - np.asarray(center)) / np.asarray(radii)) ** 2).sum(axis=-1))
+    return 1 / (1 + np.exp(-(1 - radius) * sharpness))
+
+
+def make_volume(
+    modality: str,
+    shape: Tuple[int, int, int],
+    spacing: float,
+    rotation: float = 0.0,
+    translation: Tuple[float, float, float] = (0.0, 0.0, 0.0),
+    tumor: bool = True,
+    noise: float = 0.02,
+    rng: Optional[np.random.Generator] = None,
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Render one modality of a head phantom: a skull shell, a brain and a spherical tumor.
+
+    Args:
+        modality (str): One of `CONTRASTS`.
+        shape (Tuple[int, int, int]): Volume shape.
+        spacing (float): Isotropic voxel spacing in mm.
+        rotation (float, optional): Rotation of the head about z in radians.
+        translation (Tuple[float, float, float], optional): Translation of the head in mm.
+        tumor (bool, optional): Render the tumor.
+        noise (float, optional): Standard deviation of the Gaussian noise.
+        rng (np.random.Generator, optional): Random generator of the noise.
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray, np.ndarray]: Image, brain mask and tumor mask.
+    """
+    rng = rng or np.random.default_rng(0)
+    skull, brain, lesion = CONTRASTS[modality]
+    points = _coordinates(shape, spacing, rotation, translation)
+    head = _ellipsoid(points, (0.0, 0.0, 0.0), HEAD_RADII)
+    brain_mask = _ellipsoid(points, (0.0, 0.0, 0.0), BRAIN_RADII)
+    tumor_mask = _ellipsoid(points, TUMOR_CENTER, (TUMOR_RADIUS,) * 3) if tumor else np.zeros(shape)
+    image = skull * (head - brain_mask) + brain * (brain_mask - tumor_mask) + lesion * tumor_mask
+    image = image + noise * rng.standard_normal(shape) * (head > 0.5)
+    return image.clip(0).astype(np.float32), brain_mask > 0.5, tumor_mask > 0.5
+
+
+def write_nifti(array: np.ndarray, path: str, spacing: float) -> None:
+    nib.save(nib.Nifti1Image(array, _affine(array.shape, spacing)), path)
+
+
+def make_patient(
+    patient_dir: str,
+    resolution: str,
+    seed: int = 0,
+    biopsy_points: int = 20,
+) -> None:
+    """
+    Write a phantom patient in the data folder structure of run_preprocessing.py.
+
+    Every modality is misaligned by a small random rotation and translation and has an ROI (the tumor) and a sparse
+    biopsy mask (single voxels inside the tumor). The misalignments are written to `MISALIGNMENT_FILE`, as the ground
+    truth of the registration (see `rigid_transform`).
+
+    Args:
+        patient_dir (str): Patient folder (output).
+        resolution (str): One of `RESOLUTIONS`.
+        seed (int, optional): Seed of the misalignment, noise and biopsy points.
+        biopsy_points (int, optional): Number of biopsy voxels per modality.
+    """
+    shape, spacing = RESOLUTIONS[resolution]
+    rng = np.random.default_rng(seed)
+    os.makedirs(patient_dir, exist_ok=True)
+    misalignments = {}
+    for modality in CONTRASTS:
+        rotation = float(np.deg2rad(rng.uniform(-3, 3)))
+        translation = tuple(float(t) for t in rng.uniform(-4, 4, size=3))
+        misalignments[modality] = {"rotation": rotation, "translation": translation}
+        image, _, tumor_mask = make_volume(
+            modality,
+            shape,
+            spacing,
+            rotation=rotation,
+            translation=translation,
+            rng=rng,
+        )
+        biopsy = np.zeros(shape, dtype=np.uint8)
+        candidates = np.argwhere(tumor_mask)
+        chosen = candidates[rng.choice(len(candidates), size=min(biopsy_points, len(candidates)), replace=False)]
+        biopsy[tuple(chosen.T)] = 1
+        write_nifti(image, os.path.join(patient_dir, f"{modality}.nii.gz"), spacing)
+        write_nifti(tumor_mask.astype(np.uint8), os.path.join(patient_dir, f"{modality}_roi.nii.gz"), spacing)
+        write_nifti(biopsy, os.path.join(patient_dir, f"{modality}_biopsy.nii.gz"), spacing)
+    with open(os.path.join(patient_dir, MISALIGNMENT_FILE), "w") as f:
+        json.dump(misalignments, f, indent=2)
+
+
+def rigid_transform(patient_dir: str, fixed: str, moving: str) -> Optional[Tuple[np.ndarray, np.ndarray]]:
+    """
+    Ground-truth transform between two modalities of a phantom patient written by `make_patient`.
+
+    The transform is in the convention of ITK/ANTs registrations: it maps a physical (LPS) point of the fixed image
+    to the point of the moving image showing the same anatomy.
+
+    Args:
+        patient_dir (str): Patient folder.
+        fixed (str): Modality of the fixed image.
+        moving (str): Modality of the moving image.
+
+    Returns:
+        Optional[Tuple[np.ndarray, np.ndarray]]: Matrix (3 x 3) and translation (3), or None without a
+            `MISALIGNMENT_FILE`, e.g. for real data.
+    """
+    try:
+        with open(os.path.join(patient_dir, MISALIGNMENT_FILE)) as f:
+            misalignments = json.load(f)
+    except FileNotFoundError:
+        return None
+
+    def rotation(modality: str) -> np.ndarray:
+        # the head frame of `_coordinates`: q = R (p - t)
+        cos, sin = np.cos(misalignments[modality]["rotation"]), np.sin(misalignments[modality]["rotation"])
+        return np.array([[cos, sin, 0.0], [-sin, cos, 0.0], [0.0, 0.0, 1.0]])
+
+    # p_moving = R_moving^T R_fixed (p_fixed - t_fixed) + t_moving, in the RAS frame of the NIfTI affine
+    matrix = rotation(moving).T @ rotation(fixed)
+    translation = np.asarray(misalignments[moving]["translation"]) - matrix @ np.asarray(
+        misalignments[fixed]["translation"]
+    )
+    # ITK reads the same files in LPS: x and y flip sign
+    flip = np.diag([-1.0, -1.0, 1.0])
+    return flip @ matrix @ flip, flip @ translation
+
+
+def make_atlas(path: str, resolution: str) -> None:
+    """
+    Write an aligned, tumor-free and skullstripped t1 phantom to register against instead of the SRI-24 atlas.
+
+    Args:
+        path (str): Atlas file (output).
+        resolution (str): One of `RESOLUTIONS`.
+    """
+    shape, spacing = RESOLUTIONS[resolution]
+    image, brain_mask, _ = make_volume("t1", shape, spacing, tumor=False, noise=0.0)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    write_nifti(image * brain_mask, path, spacing)
+
+
+class PhantomBrainExtractor(BrainExtractor):
+    """
+    Skullstrips phantoms by thresholding, so that benchmarks do not depend on HD-BET weights or a GPU.
+
+    The skull of every phantom modality is darker than the brain, and the background is 0.
+    """
+
+    def __init__(self, threshold: float = 0.35) -> None:
+        self.threshold = threshold
+
+    def extract(
+        self,
+        input_image_path: str,
+        masked_image_path: str,
+        brain_mask_path: str,
+        log_file_path: Optional[str] = None,
+        mode: str = "accurate",
+    ) -> None:
+        image = nib.load(input_image_path)
+        data = image.get_fdata()
+        mask = (data > self.threshold * data.max()).astype(np.uint8)
+        nib.save(nib.Nifti1Image(mask, image.affine), brain_mask_path)
+        nib.save(nib.Nifti1Image((data * mask).astype(np.float32), image.affine), masked_image_path)
+
+    def apply_mask(
+        self,
+        input_image_path: str,
+        mask_image_path: str,
+        masked_image_path: str,
+    ) -> None:
+        image = nib.load(input_image_path)
+        mask = nib.load(mask_image_path).get_fdata() > 0
+        nib.save(
+            nib.Nifti1Image((image.get_fdata() * mask).astype(np.float32), image.affine),
+            masked_image_path,
+        )
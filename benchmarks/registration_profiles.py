@@ -0,0 +1,217 @@
+import argparse
+import json
+import os
+import tempfile
+import time
+from typing import Dict, List, Optional, Tuple
+
+import ants
+import numpy as np
+import pandas as pd
+from auxiliary.turbopath import turbopath
+
+from benchmarks.phantoms import RESOLUTIONS, make_patient, rigid_transform
+from modified.ANTs import REGISTRATION_PROFILES, ModifiedANTsRegistrator
+
+MODALITIES = ["t1c", "t2", "t1", "fla"]
+
+
+def reference_pairs(data_dir: str) -> List[Tuple[str, str]]:
+    """
+    Collect (center image, moving image) pairs of a reference set in the data folder structure of run_preprocessing.py.
+
+    Args:
+        data_dir (str): Folder with one sub folder per patient.
+
+    Returns:
+        List[Tuple[str, str]]: Fixed and moving image per pair; the center modality is chosen by the same priority.
+    """
+    pairs = []
+    for patient_dir in sorted(turbopath(data_dir).dirs()):
+        images = {
+            modality: files[0]
+            for modality in MODALITIES
+            if len(files := patient_dir.files(f"*{modality}.nii.gz")) == 1
+        }
+        if not images:
+            continue
+        center = next(modality for modality in MODALITIES if modality in images)
+        pairs.extend((images[center], path) for modality, path in images.items() if modality != center)
+    return pairs
+
+
+def _modality(path: str) -> str:
+    return next(modality for modality in MODALITIES if os.path.basename(path).endswith(f"{modality}.nii.gz"))
+
+
+def ground_truth(fixed_image_path: str, moving_image_path: str, matrix_path: str) -> Optional[str]:
+    """
+    Write the known transform of a phantom pair (see `benchmarks.phantoms.rigid_transform`) as an ANTs transform.
+
+    Args:
+        fixed_image_path (str): Fixed image of the pair.
+        moving_image_path (str): Moving image of the pair.
+        matrix_path (str): Transform file (output).
+
+    Returns:
+        Optional[str]: `matrix_path`, or None if the pair has no known misalignment (real data).
+    """
+    truth = rigid_transform(
+        os.path.dirname(fixed_image_path), _modality(fixed_image_path), _modality(moving_image_path)
+    )
+    if truth is None:
+        return None
+    matrix, translation = truth
+    transform = ants.create_ants_transform(
+        transform_type="AffineTransform", dimension=3, matrix=matrix, translation=translation
+    )
+    ants.write_transform(transform, matrix_path)
+    return matrix_path
+
+
+def sample_points(image: ants.ANTsImage, n_points: int) -> pd.DataFrame:
+    """
+    Physical coordinates of up to `n_points` foreground voxels, spread evenly over the foreground.
+
+    Args:
+        image (ants.ANTsImage): The fixed image.
+        n_points (int): Maximum number of points.
+
+    Returns:
+        pd.DataFrame: Points with x, y and z columns, as expected by `ants.apply_transforms_to_points`.
+    """
+    indices = np.argwhere(image.numpy() > 0)
+    indices = indices[:: max(1, len(indices) // n_points)]
+    points = np.asarray(image.origin) + (indices * np.asarray(image.spacing)) @ np.asarray(image.direction).T
+    return pd.DataFrame(points, columns=["x", "y", "z"])
+
+
+def alignment_error(points: pd.DataFrame, matrix_path: str, reference_matrix_path: str) -> np.ndarray:
+    """
+    Distance in mm between the points mapped by a transform and by the reference transform.
+
+    Args:
+        points (pd.DataFrame): Points in the fixed image space.
+        matrix_path (str): Transform to evaluate.
+        reference_matrix_path (str): Reference transform.
+
+    Returns:
+        np.ndarray: Distance per point.
+    """
+    mapped = ants.apply_transforms_to_points(3, points, [matrix_path])
+    reference = ants.apply_transforms_to_points(3, points, [reference_matrix_path])
+    return np.linalg.norm(mapped[["x", "y", "z"]].values - reference[["x", "y", "z"]].values, axis=1)
+
+
+def benchmark(
+    pairs: List[Tuple[str, str]],
+    profiles: List[str],
+    reference: str,
+    work_dir: str,
+    n_points: int = 2000,
+) -> Dict[str, dict]:
+    """
+    Register every pair with every profile and report runtime and alignment error per profile.
+
+    The alignment error of a profile is the distance between the foreground points of the fixed image mapped by
+    its transform and by the true transform, which is known for phantoms (`benchmarks.phantoms`). Pairs without a
+    known transform (real data) are compared to the transform of the reference profile instead, whose error is
+    then 0 by definition.
+
+    Args:
+        pairs (List[Tuple[str, str]]): Fixed and moving image per pair.
+        profiles (List[str]): Profiles to benchmark.
+        reference (str): Profile whose transforms are used for pairs without a known transform.
+        work_dir (str): Folder for the registered images and matrices.
+        n_points (int, optional): Number of foreground points the error is measured on.
+
+    Returns:
+        Dict[str, dict]: Number of pairs and of pairs with a known transform, mean and max runtime in seconds and
+            mean, 95th percentile and max error in mm per profile.
+    """
+    profiles = [reference] + [profile for profile in profiles if profile != reference]
+    runtimes = {profile: [] for profile in profiles}
+    errors = {profile: [] for profile in profiles}
+    known = 0
+    for index, (fixed_image_path, moving_image_path) in enumerate(pairs):
+        points = sample_points(ants.image_read(fixed_image_path), n_points)
+        truth = ground_truth(fixed_image_path, moving_image_path, os.path.join(work_dir, f"{index}_truth.mat"))
+        known += truth is not None
+        matrices = {}
+        for profile in profiles:
+            registrator = ModifiedANTsRegistrator(profile=profile)
+            prefix = os.path.join(work_dir, f"{index}_{profile}")
+            start = time.perf_counter()
+            registrator.register(
+                fixed_image_path=fixed_image_path,
+                moving_image_path=moving_image_path,
+                transformed_image_path=f"{prefix}.nii.gz",
+                matrix_path=f"{prefix}.mat",
+                log_file_path=f"{prefix}.log",
+            )
+            runtimes[profile].append(time.perf_counter() - start)
+            matrices[profile] = f"{prefix}.mat"
+            errors[profile].append(
+                alignment_error(points, matrices[profile], truth if truth is not None else matrices[reference])
+            )
+
+    report = {}
+    for profile in profiles:
+        distances = np.concatenate(errors[profile]) if errors[profile] else np.zeros(0)
+        report[profile] = {
+            "pairs": len(runtimes[profile]),
+            "ground_truth_pairs": known,
+            "runtime_mean_s": float(np.mean(runtimes[profile])) if runtimes[profile] else None,
+            "runtime_max_s": float(np.max(runtimes[profile])) if runtimes[profile] else None,
+            "error_mean_mm": float(distances.mean()) if distances.size else None,
+            "error_p95_mm": float(np.percentile(distances, 95)) if distances.size else None,
+            "error_max_mm": float(distances.max()) if distances.size else None,
+        }
+    return report
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description="Benchmark the registration profiles on a reference set.")
+    parser.add_argument('--data_dir', type=str, default=None,
+                        help='reference set in the data folder structure (default: phantoms with known misalignments)')
+    parser.add_argument('--phantoms', type=int, default=4, help='phantom patients generated without --data_dir')
+    parser.add_argument('--resolution', type=str, default="medium", choices=list(RESOLUTIONS),
+                        help='resolution of the generated phantoms')
+    parser.add_argument('--profiles', type=str, nargs='+', default=list(REGISTRATION_PROFILES),
+                        choices=list(REGISTRATION_PROFILES))
+    parser.add_argument('--reference', type=str, default="accurate", choices=list(REGISTRATION_PROFILES),
+                        help='profile the alignment error is measured against for pairs without a known transform')
+    parser.add_argument('--n_points', type=int, default=2000, help='foreground points per pair')
+    parser.add_argument('--output', type=str, default=None, help='write the report as json')
+
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        data_dir = args.data_dir
+        if data_dir is None:
+            data_dir = os.path.join(work_dir, "phantoms")
+            for seed in range(args.phantoms):
+                make_patient(os.path.join(data_dir, f"phantom_{seed:03d}"), args.resolution, seed=seed)
+        pairs = reference_pairs(data_dir)
+        report = benchmark(pairs, args.profiles, args.reference, work_dir, n_points=args.n_points)
+
+    known = next(iter(report.values()))["ground_truth_pairs"] if report else 0
+    print(f"{' Registration profiles ':=^80}")
+    print(
+        f"{len(pairs)} pairs, alignment error relative to the known transform for {known} of them"
+        + (f" and to the {args.reference} profile for the rest" if known < len(pairs) else "")
+    )
+    print(f"{'profile':<10} {'runtime mean [s]':>17} {'error mean [mm]':>16} {'error p95 [mm]':>15} {'error max [mm]':>15}")
+    for profile, row in report.items():
+        print(
+            f"{profile:<10} {row['runtime_mean_s'] or 0:>17.2f} {row['error_mean_mm'] or 0:>16.3f} "
+            f"{row['error_p95_mm'] or 0:>15.3f} {row['error_max_mm'] or 0:>15.3f}"
+        )
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,129 @@
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+from typing import Dict, List, Tuple
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# what a user or a spawned worker waits for before any work starts
+TARGETS: Dict[str, List[str]] = {
+    "interpreter": ["-c", "pass"],
+    "cli --help": ["run_preprocessing.py", "--help"],
+    "import run_preprocessing": ["-c", "import run_preprocessing"],
+    "import modified.preprocessor": ["-c", "import modified.preprocessor"],
+    "import modified.ANTs": ["-c", "import modified.ANTs"],
+    "import modified.brain_extraction": ["-c", "import modified.brain_extraction"],
+}
+
+
+def time_target(args: List[str], repeats: int) -> float:
+    """Median wall time in seconds of a fresh interpreter running `args`."""
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        subprocess.run(
+            [sys.executable, *args], cwd=ROOT, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True
+        )
+        times.append(time.perf_counter() - start)
+    return statistics.median(times)
+
+
+def import_profile(module: str, top: int = 10) -> List[Tuple[str, float]]:
+    """
+    Cumulative import time of the modules a module imports directly, from `python -X importtime`.
+
+    Returns:
+        List[Tuple[str, float]]: (module, seconds), slowest first.
+    """
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        cwd=ROOT,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+        text=True,
+        check=True,
+    )
+    modules = {}
+    for line in result.stderr.splitlines():
+        # "import time:      self [us] | cumulative | imported package", nested imports are indented
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, cumulative, name = line.split("|")
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        if depth != 1 or not cumulative.strip().isdigit():
+            continue
+        modules[name.strip()] = int(cumulative) / 1e6
+    return sorted(modules.items(), key=lambda item: -item[1])[:top]
+
+
+def compare(report: Dict[str, float], baseline: Dict[str, float], tolerance: float, min_s: float = 0.05) -> List[str]:
+    """
+    Find targets that got slower by more than `tolerance` (relative) compared to the baseline.
+
+    Baseline times below `min_s` are compared against `min_s`, so that timer noise does not fail the benchmark.
+
+    Returns:
+        List[str]: One line per regression.
+    """
+    regressions = []
+    for target, value in report.items():
+        if target not in baseline:
+            continue
+        expected = max(baseline[target], min_s)
+        if value > expected * (1 + tolerance):
+            regressions.append(f"{target}: {value:.3f}s > {expected:.3f}s (+{tolerance:.0%})")
+    return regressions
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description="Benchmark the startup time of the command line and its imports.")
+    parser.add_argument('--repeats', type=int, default=5, help='fresh interpreters per target, the median is reported')
+    parser.add_argument('--profile', type=str, default="run_preprocessing",
+                        help='module whose direct imports are broken down')
+    parser.add_argument('--output', type=str, default=None, help='write the report as json')
+    parser.add_argument('--baseline', type=str, default=None,
+                        help='json report to compare against; a regression exits with status 1')
+    parser.add_argument('--save_baseline', type=str, default=None, help='write the report as the new baseline')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='allowed relative regression per target')
+
+    args = parser.parse_args()
+
+    report = {}
+    print(f"{' Startup time ':=^80}")
+    for target, target_args in TARGETS.items():
+        try:
+            report[target] = time_target(target_args, args.repeats)
+        except subprocess.CalledProcessError:
+            print(f"  {target:<40} failed")
+            continue
+        print(f"  {target:<40} {report[target]:>8.3f}s")
+
+    print(f"{f' Imports of {args.profile} (cumulative) ':=^80}")
+    try:
+        for module, seconds in import_profile(args.profile):
+            print(f"  {module:<40} {seconds:>8.3f}s")
+    except subprocess.CalledProcessError:
+        print(f"  import {args.profile} failed")
+
+    for path in (args.output, args.save_baseline):
+        if path is not None:
+            with open(path, "w") as f:
+                json.dump(report, f, indent=2)
+
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            regressions = compare(report, json.load(f), args.tolerance)
+        if regressions:
+            print(f"{' Regressions ':=^80}")
+            print("\n".join(regressions))
+            sys.exit(1)
+        print("No regressions against the baseline.")
+
+
+if __name__ == "__main__":
+    main()
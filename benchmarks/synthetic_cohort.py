@@ -0,0 +1,315 @@
+import argparse
+import json
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import time
+from multiprocessing import get_context
+from typing import Callable, Dict, List, Optional
+
+from auxiliary.turbopath import turbopath
+
+from benchmarks.phantoms import RESOLUTIONS, PhantomBrainExtractor, make_atlas, make_patient
+from modified.ANTs import ModifiedANTsRegistrator
+from modified.modality import ModifiedModalitiy
+from modified.normalization import FastPercentileNormalizer
+from modified.preprocessor import ModifiedPreprocessor
+
+CENTER, MOVING = "t1c", ["t2", "t1", "fla"]
+METRICS = ["wall_s", "peak_rss_mb", "bytes_written"]
+
+
+def _bytes_written() -> Optional[int]:
+    # bytes passed to write calls by this process; Linux only
+    try:
+        with open("/proc/self/io") as f:
+            return int(next(line for line in f if line.startswith("wchar")).split()[1])
+    except (OSError, StopIteration):
+        return None
+
+
+def _peak_rss_mb() -> float:
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1 << 20) if sys.platform == "darwin" else peak / (1 << 10)
+
+
+def _measure(fn: Callable[[], None]) -> Dict[str, float]:
+    written, start = _bytes_written(), time.perf_counter()
+    fn()
+    wall = time.perf_counter() - start
+    return {
+        "wall_s": wall,
+        "peak_rss_mb": _peak_rss_mb(),
+        "bytes_written": _bytes_written() - written if written is not None else None,
+    }
+
+
+def _modality(patient_dir: str, name: str, output_dir: str) -> ModifiedModalitiy:
+    patient_dir = turbopath(patient_dir)
+    output_dir = turbopath(output_dir)
+    return ModifiedModalitiy(
+        modality_name=name,
+        image_path=patient_dir / f"{name}.nii.gz",
+        roi_path=patient_dir / f"{name}_roi.nii.gz",
+        biopsy_path=patient_dir / f"{name}_biopsy.nii.gz",
+        normalized_bet_output_path=output_dir / f"{name}_bet.nii.gz",
+        normalized_bet_output_path_roi=output_dir / f"{name}_roi_bet.nii.gz",
+        normalized_bet_output_path_biopsy=output_dir / f"{name}_biopsy_bet.nii.gz",
+        normalizer=FastPercentileNormalizer(
+            lower_percentile=0.1,
+            upper_percentile=99.9,
+            lower_limit=0,
+            upper_limit=1,
+        ),
+    )
+
+
+# operations, each run in a fresh process ------------------------------------------------------------------------------
+
+
+def bench_register(patient_dir: str, work_dir: str) -> Dict[str, Dict[str, float]]:
+    """Register a moving modality to the center modality; the matrix is reused by the transform benchmarks."""
+    registrator = ModifiedANTsRegistrator()
+    return {
+        "registrator.register": _measure(
+            lambda: registrator.register(
+                fixed_image_path=os.path.join(patient_dir, f"{CENTER}.nii.gz"),
+                moving_image_path=os.path.join(patient_dir, f"{MOVING[0]}.nii.gz"),
+                transformed_image_path=os.path.join(work_dir, "registered.nii.gz"),
+                matrix_path=os.path.join(work_dir, "registered.mat"),
+                log_file_path=os.path.join(work_dir, "registered.log"),
+            )
+        )
+    }
+
+
+def bench_transform(patient_dir: str, work_dir: str) -> Dict[str, Dict[str, float]]:
+    registrator = ModifiedANTsRegistrator()
+    return {
+        "registrator.transform": _measure(
+            lambda: registrator.transform(
+                fixed_image_path=os.path.join(patient_dir, f"{CENTER}.nii.gz"),
+                moving_image_path=os.path.join(patient_dir, f"{MOVING[0]}.nii.gz"),
+                transformed_image_path=os.path.join(work_dir, "transformed.nii.gz"),
+                matrix_path=os.path.join(work_dir, "registered.mat"),
+                log_file_path=os.path.join(work_dir, "transformed.log"),
+            )
+        )
+    }
+
+
+def bench_transform_binaries(patient_dir: str, work_dir: str) -> Dict[str, Dict[str, float]]:
+    registrator = ModifiedANTsRegistrator()
+    return {
+        "registrator.transform_binaries": _measure(
+            lambda: registrator.transform_binaries(
+                fixed_image_path=os.path.join(patient_dir, f"{CENTER}.nii.gz"),
+                moving_image_paths=[
+                    os.path.join(patient_dir, f"{MOVING[0]}_roi.nii.gz"),
+                    os.path.join(patient_dir, f"{MOVING[0]}_biopsy.nii.gz"),
+                ],
+                transformed_image_paths=[
+                    os.path.join(work_dir, "transformed_roi.nii.gz"),
+                    os.path.join(work_dir, "transformed_biopsy.nii.gz"),
+                ],
+                matrix_path=os.path.join(work_dir, "registered.mat"),
+                log_file_path=os.path.join(work_dir, "transformed_binaries.log"),
+            )
+        )
+    }
+
+
+def bench_normalize(patient_dir: str, work_dir: str) -> Dict[str, Dict[str, float]]:
+    # normalize works in place, so it runs on a copy of the input
+    image_path = os.path.join(work_dir, f"{CENTER}.nii.gz")
+    shutil.copyfile(os.path.join(patient_dir, f"{CENTER}.nii.gz"), image_path)
+    modality = _modality(patient_dir, CENTER, os.path.join(work_dir, "outputs"))
+    modality.current_image = turbopath(image_path)
+    return {
+        "modality.normalize": _measure(
+            lambda: modality.normalize(temporary_directory=os.path.join(work_dir, "normalize"))
+        )
+    }
+
+
+def bench_run(patient_dir: str, work_dir: str, atlas_path: str) -> Dict[str, Dict[str, float]]:
+    """Run the whole pipeline; every stage is measured from the completion of the previous one."""
+    brainles_dir = os.path.join(work_dir, "brainles")
+    preprocessor = ModifiedPreprocessor(
+        center_modality=_modality(patient_dir, CENTER, os.path.join(brainles_dir, "normalized_bet")),
+        moving_modalities=[
+            _modality(patient_dir, name, os.path.join(brainles_dir, "normalized_bet")) for name in MOVING
+        ],
+        registrator=ModifiedANTsRegistrator(),
+        brain_extractor=PhantomBrainExtractor(),
+        atlas_image_path=atlas_path,
+        temp_folder=os.path.join(work_dir, "temp"),
+        use_gpu=False,
+        atlas_cache_dir=os.path.join(work_dir, "prepared-atlas"),
+    )
+
+    results, marks = {}, [(time.perf_counter(), _bytes_written())]
+    save_stage = preprocessor._save_stage
+
+    def timed_save_stage(stage, *args, **kwargs):
+        save_stage(stage, *args, **kwargs)
+        now, written = time.perf_counter(), _bytes_written()
+        results[f"stage.{stage}"] = {
+            "wall_s": now - marks[-1][0],
+            "peak_rss_mb": _peak_rss_mb(),
+            "bytes_written": written - marks[-1][1] if written is not None else None,
+        }
+        marks.append((now, written))
+
+    preprocessor._save_stage = timed_save_stage
+    results["preprocessor.run"] = _measure(
+        lambda: preprocessor.run(
+            save_dir_coregistration=os.path.join(brainles_dir, "co-registration"),
+            save_dir_atlas_registration=os.path.join(brainles_dir, "atlas-registration"),
+            save_dir_atlas_correction=os.path.join(brainles_dir, "atlas-correction"),
+            save_dir_brain_extraction=os.path.join(brainles_dir, "brain-extraction"),
+            log_file=os.path.join(work_dir, "preprocessing.log"),
+            resume=False,
+        )
+    )
+    return results
+
+
+def _isolated(fn: Callable, *args) -> Dict[str, Dict[str, float]]:
+    # a fresh process per operation, so that the peak RSS belongs to that operation alone
+    with get_context("spawn").Pool(1) as pool:
+        return pool.apply(fn, args)
+
+
+# suite ----------------------------------------------------------------------------------------------------------------
+
+
+def run_suite(resolutions: List[str], patients: int, work_dir: str) -> Dict[str, Dict[str, Dict[str, float]]]:
+    """
+    Generate the synthetic cohort and benchmark every operation at every resolution.
+
+    Returns:
+        Dict[str, Dict[str, Dict[str, float]]]: Metrics per resolution and operation; over several patients the
+            mean wall time and bytes written and the maximum peak RSS are reported.
+    """
+    report = {}
+    for resolution in resolutions:
+        atlas_path = os.path.join(work_dir, resolution, "atlas", "t1_atlas.nii.gz")
+        make_atlas(atlas_path, resolution)
+        runs = []
+        for index in range(patients):
+            patient_dir = os.path.join(work_dir, resolution, "data", f"phantom_{index:03d}")
+            make_patient(patient_dir, resolution, seed=index)
+            case_dir = os.path.join(work_dir, resolution, "runs", f"phantom_{index:03d}")
+            os.makedirs(case_dir, exist_ok=True)
+            metrics = {}
+            for fn in (bench_register, bench_transform, bench_transform_binaries, bench_normalize):
+                metrics.update(_isolated(fn, patient_dir, case_dir))
+            metrics.update(_isolated(bench_run, patient_dir, case_dir, atlas_path))
+            runs.append(metrics)
+            print(f"{resolution} phantom_{index:03d}: preprocessor.run {metrics['preprocessor.run']['wall_s']:.1f}s")
+
+        report[resolution] = {}
+        for operation in runs[0]:
+            values = {metric: [run[operation][metric] for run in runs] for metric in METRICS}
+            report[resolution][operation] = {
+                "wall_s": sum(values["wall_s"]) / len(runs),
+                "peak_rss_mb": max(values["peak_rss_mb"]),
+                "bytes_written": (
+                    sum(values["bytes_written"]) / len(runs) if None not in values["bytes_written"] else None
+                ),
+            }
+    return report
+
+
+def compare(
+    report: Dict[str, Dict[str, Dict[str, float]]],
+    baseline: Dict[str, Dict[str, Dict[str, float]]],
+    tolerance: float,
+    min_wall_s: float = 0.5,
+) -> List[str]:
+    """
+    Find metrics that regressed by more than `tolerance` (relative) compared to the baseline.
+
+    Wall times below `min_wall_s` in the baseline are compared against `min_wall_s`, so that timer noise of very
+    short operations does not fail the suite.
+
+    Returns:
+        List[str]: One line per regression.
+    """
+    regressions = []
+    for resolution, operations in report.items():
+        for operation, metrics in operations.items():
+            reference = baseline.get(resolution, {}).get(operation)
+            if reference is None:
+                continue
+            for metric in METRICS:
+                value, expected = metrics.get(metric), reference.get(metric)
+                if value is None or expected is None:
+                    continue
+                if metric == "wall_s":
+                    expected = max(expected, min_wall_s)
+                if value > expected * (1 + tolerance):
+                    regressions.append(
+                        f"{resolution} {operation} {metric}: {value:.3g} > {expected:.3g} (+{tolerance:.0%})"
+                    )
+    return regressions
+
+
+def print_report(report: Dict[str, Dict[str, Dict[str, float]]]) -> None:
+    print(f"{' Synthetic cohort benchmark ':=^80}")
+    for resolution, operations in report.items():
+        shape, spacing = RESOLUTIONS[resolution]
+        print(f"{resolution}: {'x'.join(map(str, shape))} voxels at {spacing} mm")
+        print(f"  {'operation':<36} {'wall [s]':>9} {'peak RSS [MB]':>14} {'written [MB]':>13}")
+        for operation, metrics in operations.items():
+            written = metrics["bytes_written"]
+            print(
+                f"  {operation:<36} {metrics['wall_s']:>9.2f} {metrics['peak_rss_mb']:>14.0f} "
+                f"{written / (1 << 20) if written is not None else float('nan'):>13.1f}"
+            )
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description="Benchmark the preprocessing on a synthetic phantom cohort.")
+    parser.add_argument('--resolutions', type=str, nargs='+', default=["low", "medium"], choices=list(RESOLUTIONS))
+    parser.add_argument('--patients', type=int, default=2, help='number of phantom patients per resolution')
+    parser.add_argument('--work_dir', type=str, default=None,
+                        help='folder of the cohort and the results (default: a temporary folder)')
+    parser.add_argument('--output', type=str, default=None, help='write the report as json')
+    parser.add_argument('--baseline', type=str, default=None,
+                        help='json report to compare against; a regression exits with status 1')
+    parser.add_argument('--save_baseline', type=str, default=None, help='write the report as the new baseline')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='allowed relative regression per metric')
+
+    args = parser.parse_args()
+
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix="synthetic-cohort-")
+    try:
+        report = run_suite(args.resolutions, args.patients, work_dir)
+    finally:
+        if args.work_dir is None:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    print_report(report)
+    for path in (args.output, args.save_baseline):
+        if path is not None:
+            with open(path, "w") as f:
+                json.dump(report, f, indent=2)
+
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            regressions = compare(report, json.load(f), args.tolerance)
+        if regressions:
+            print(f"{' Regressions ':=^80}")
+            print("\n".join(regressions))
+            sys.exit(1)
+        print("No regressions against the baseline.")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,12 +1,117 @@
 # TODO add typing and docs
 import datetime
+import itertools
 import os
 import shutil
+import threading
+from collections import OrderedDict
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
 
 import ants
+import numpy as np
+import pandas as pd
 from auxiliary.turbopath import turbopath
 
 from brainles_preprocessing.registration.registrator import Registrator
+from modified.profiles import REGISTRATION_PROFILES, registration_profile  # noqa: F401 (re-exported)
+
+
+def points_path(image_path: str) -> str:
+    """Path of the point set stored next to a point-transformed mask, e.g. `t1_biopsy_points.csv`."""
+    image_path = str(image_path)
+    for extension in (".nii.gz", ".nii"):
+        if image_path.endswith(extension):
+            image_path = image_path[: -len(extension)]
+            break
+    return f"{image_path}_points.csv"
+
+
+def _physical(image: ants.ANTsImage, indices: np.ndarray) -> np.ndarray:
+    """Physical coordinates of voxel indices (one row per voxel) of an image."""
+    return np.asarray(image.origin) + (indices * np.asarray(image.spacing)) @ np.asarray(image.direction).T
+
+
+def _continuous_index(image: ants.ANTsImage, points: np.ndarray) -> np.ndarray:
+    """Continuous voxel indices of physical coordinates (one row per point) in an image."""
+    to_index = np.linalg.inv(np.asarray(image.direction) * np.asarray(image.spacing))
+    return (points - np.asarray(image.origin)) @ to_index.T
+
+
+class FileCache:
+    """
+    Bounded LRU cache of objects decoded from files, keyed by path, modification time and size.
+
+    A file that is rewritten in place gets a new key, so stale entries are never returned; they are evicted
+    like any other least recently used entry.
+
+    Args:
+        maxsize (int, optional): Maximum number of cached objects. 0 disables caching.
+
+    Example:
+        >>> cache = FileCache(maxsize=4)
+        >>> image = cache.get("atlas.nii.gz", ants.image_read)
+        >>> cache.info()
+        {'hits': 0, 'misses': 1, 'size': 1, 'maxsize': 4}
+    """
+
+    def __init__(self, maxsize: int = 8) -> None:
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._entries: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(path: str) -> Tuple[str, int, int]:
+        stat = os.stat(path)
+        return os.path.abspath(path), stat.st_mtime_ns, stat.st_size
+
+    def get(self, path: str, load: Callable[[str], object]) -> object:
+        """
+        Return the cached object of a file, loading it on a miss.
+
+        Args:
+            path (str): Path to the file.
+            load (Callable[[str], object]): Decodes the file, e.g. `ants.image_read`.
+
+        Returns:
+            object: The decoded file content. Callers must not modify it.
+        """
+        key = self._key(path)
+        with self._lock:
+            if key in self._entries:
+                self.hits += 1
+                self._entries.move_to_end(key)
+                return self._entries[key]
+            self.misses += 1
+        value = load(path)
+        with self._lock:
+            if self.maxsize > 0:
+                self._entries[key] = value
+                self._entries.move_to_end(key)
+                while len(self._entries) > self.maxsize:
+                    self._entries.popitem(last=False)
+        return value
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    def info(self) -> dict:
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "size": len(self._entries),
+                "maxsize": self.maxsize,
+            }
+
+    def __getstate__(self) -> dict:
+        # decoded images hold pointers into the backend and are not sent to other processes
+        return {"maxsize": self.maxsize, "hits": 0, "misses": 0}
+
+    def __setstate__(self, state: dict) -> None:
+        self.__init__(state["maxsize"])
 
 
 class ModifiedANTsRegistrator(Registrator):
@@ -15,6 +120,9 @@ class ModifiedANTsRegistrator(Registrator):
         registration_params: dict = None,
         transformation_params: dict = None,
         threshold: float = 0.5,
+        in_memory: bool = False,
+        cache_size: int = 8,
+        profile: Optional[str] = None,
     ):
         """
         Initialize an ANTsRegistrator instance.
@@ -24,6 +132,15 @@ class ModifiedANTsRegistrator(Registrator):
           Defaults to None, which implies using default registration parameters with a rigid transformation.
         - transformation_params (dict, optional): Dictionary of parameters for the transformation method.
           Defaults to an empty dictionary.
+        - threshold (float, optional): Values above the threshold are set to 1 when transforming a binary mask.
+          Transformed masks are uint8 images.
+        - in_memory (bool, optional): Keep transformed images in memory instead of writing them.
+          Later calls that read one of these paths use the live image; `flush` writes them when a file is needed.
+        - cache_size (int, optional): Number of decoded fixed images kept in an LRU cache. The same center or
+          atlas-space image is the fixed image of every mask and moving modality of a stage. 0 disables the cache.
+        - profile (str, optional): Named registration profile ("fast", "balanced" or "accurate") setting the
+          shrink factors, smoothing, iterations and metric sampling rate. Keys of registration_params take precedence,
+          here and over the profile of a `register` call.
 
         The registration_params dictionary may include the following keys:
         - type_of_transform (str, optional): Type of transformation to use (default is "Rigid").
@@ -36,6 +153,10 @@ class ModifiedANTsRegistrator(Registrator):
         # Set default registration parameters
         default_registration_params = {"type_of_transform": "Rigid"}
         self.registration_params = registration_params or default_registration_params
+        # explicit parameters beat every profile, also the one of a register call
+        self._explicit_registration_params = dict(self.registration_params)
+        if profile is not None:
+            self.registration_params = {**registration_profile(profile), **self.registration_params}
 
         # Set default transformation parameters
         self.transformation_params = transformation_params or {}
@@ -43,6 +164,111 @@ class ModifiedANTsRegistrator(Registrator):
         # threshold for ROI post-processing
         self.threshold = threshold
 
+        # transformed images held in memory by absolute path, and those of them not written yet;
+        # private as it does not change any result (stage manifests ignore private attributes)
+        self._in_memory = in_memory
+        self._images: Dict[str, ants.ANTsImage] = {}
+        self._unwritten = set()
+        self._images_lock = threading.Lock()
+
+        # decoded fixed images by path, mtime and size; private as it does not change any result
+        self._fixed_images = FileCache(maxsize=cache_size)
+
+    def cache_info(self) -> dict:
+        """
+        Hit and miss counters of the fixed image cache.
+
+        Returns:
+            dict: hits, misses, current size and maximum size of the cache.
+        """
+        return self._fixed_images.info()
+
+    def __getstate__(self) -> dict:
+        # copies sent to worker processes write their results, the live images stay in this process
+        state = self.__dict__.copy()
+        state["_in_memory"] = False
+        state["_images"] = {}
+        state["_unwritten"] = set()
+        del state["_images_lock"]
+        return state
+
+    def __setstate__(self, state: dict) -> None:
+        self.__dict__.update(state)
+        self._images_lock = threading.Lock()
+
+    def flush(self, paths: Optional[Iterable[str]] = None, directory: Optional[str] = None) -> None:
+        """
+        Write images that are only held in memory. They stay in memory for later reads.
+
+        Args:
+            paths (Iterable[str], optional): Write these paths if they are held in memory.
+            directory (str, optional): Write all held images below this directory.
+            If neither is given, all held images are written.
+        """
+        with self._images_lock:
+            if paths is None and directory is None:
+                selected = set(self._unwritten)
+            else:
+                selected = {os.path.abspath(path) for path in paths or () if path is not None}
+                if directory is not None:
+                    directory = os.path.abspath(directory)
+                    selected |= {
+                        path
+                        for path in self._unwritten
+                        if os.path.commonpath([directory, path]) == directory
+                    }
+            for path in selected & self._unwritten:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                ants.image_write(self._images[path], path)
+                self._unwritten.discard(path)
+
+    def preload(self, image_path: str, image: ants.ANTsImage) -> None:
+        """
+        Serve reads of an existing file from an already decoded image, e.g. a prepared atlas.
+
+        Args:
+            image_path (str): Path of the file.
+            image (ants.ANTsImage): The decoded content of the file.
+        """
+        with self._images_lock:
+            self._images[os.path.abspath(image_path)] = image
+
+    def discard(self, paths: Optional[Iterable[str]] = None) -> None:
+        """
+        Drop images from memory without writing them.
+
+        Args:
+            paths (Iterable[str], optional): Paths to drop. Defaults to all held images.
+        """
+        with self._images_lock:
+            if paths is None:
+                self._images.clear()
+                self._unwritten.clear()
+                return
+            for path in paths:
+                if path is not None:
+                    self._images.pop(os.path.abspath(path), None)
+                    self._unwritten.discard(os.path.abspath(path))
+
+    def _read(self, image_path: str, cache: bool = False) -> ants.ANTsImage:
+        with self._images_lock:
+            image = self._images.get(os.path.abspath(image_path))
+        if image is not None:
+            return image
+        if cache:
+            # ANTs clones its inputs, so a cached image is never modified
+            return self._fixed_images.get(str(image_path), ants.image_read)
+        return ants.image_read(image_path)
+
+    def _write(self, image: ants.ANTsImage, image_path: str) -> None:
+        if self._in_memory:
+            with self._images_lock:
+                self._images[os.path.abspath(image_path)] = image
+                self._unwritten.add(os.path.abspath(image_path))
+        else:
+            os.makedirs(os.path.dirname(image_path), exist_ok=True)
+            ants.image_write(image, image_path)
+
     def register(
         self,
         fixed_image_path: str,
@@ -50,6 +276,7 @@ class ModifiedANTsRegistrator(Registrator):
         transformed_image_path: str,
         matrix_path: str,
         log_file_path: str,
+        profile: Optional[str] = None,
         **kwargs,
     ) -> None:
         """
@@ -61,29 +288,36 @@ class ModifiedANTsRegistrator(Registrator):
             transformed_image_path (str): Path to the transformed image (output).
             matrix_path (str): Path to the transformation matrix (output).
             log_file_path (str): Path to the log file.
+            profile (str, optional): Named registration profile for this call only, e.g. "fast" for coregistration.
+                It replaces the profile of the registrator; explicit registration_params still take precedence.
             **kwargs: Additional registration parameters to update the instantiated defaults.
         """
         # we update the transformation parameters with the provided kwargs
 
         start_time = datetime.datetime.now()
 
-        registration_kwargs = {**self.registration_params, **kwargs}
+        # kwargs > explicit registration_params > profile of the call > profile of the registrator
+        registration_kwargs = {
+            **self.registration_params,
+            **(registration_profile(profile) if profile is not None else {}),
+            **self._explicit_registration_params,
+            **kwargs,
+        }
         transformed_image_path = turbopath(transformed_image_path)
 
         matrix_path = turbopath(matrix_path)
         if matrix_path.suffix != ".mat":
             matrix_path = matrix_path.with_suffix(".mat")
 
-        fixed_image = ants.image_read(fixed_image_path)
-        moving_image = ants.image_read(moving_image_path)
+        fixed_image = self._read(fixed_image_path, cache=True)
+        moving_image = self._read(moving_image_path)
         registration_result = ants.registration(
             fixed=fixed_image,
             moving=moving_image,
             **registration_kwargs,
         )
         transformed_image = registration_result["warpedmovout"]
-        os.makedirs(transformed_image_path.parent, exist_ok=True)
-        ants.image_write(transformed_image, transformed_image_path)
+        self._write(transformed_image, transformed_image_path)
         os.makedirs(matrix_path.parent, exist_ok=True)
         shutil.copyfile(registration_result["fwdtransforms"][0], matrix_path)
 
@@ -108,7 +342,7 @@ class ModifiedANTsRegistrator(Registrator):
         fixed_image_path: str,
         moving_image_path: str,
         transformed_image_path: str,
-        matrix_path: str,
+        matrix_path: str | List[str],
         log_file_path: str,
         is_binary: bool = False,
         **kwargs,
@@ -120,7 +354,8 @@ class ModifiedANTsRegistrator(Registrator):
             fixed_image_path (str): Path to the fixed image.
             moving_image_path (str): Path to the moving image.
             transformed_image_path (str): Path to the transformed image (output).
-            matrix_path (str): Path to the transformation matrix.
+            matrix_path (str | List[str]): Path to the transformation matrix, or a list of matrices that is
+                composed and applied in a single resampling (ANTs order: the last matrix is applied first).
             log_file_path (str): Path to the log file.
             is_binary (bool): Whether to apply a ROI or Biopsy.
             **kwargs: Additional transformation parameters to update the instantiated defaults.
@@ -129,26 +364,22 @@ class ModifiedANTsRegistrator(Registrator):
 
         # we update the transformation parameters with the provided kwargs
         transform_kwargs = {**self.transformation_params, **kwargs}
-        fixed_image = ants.image_read(fixed_image_path)
-        moving_image = ants.image_read(moving_image_path)
+        fixed_image = self._read(fixed_image_path, cache=True)
+        moving_image = self._read(moving_image_path)
         transformed_image_path = turbopath(transformed_image_path)
-        os.makedirs(transformed_image_path.parent, exist_ok=True)
-
-        matrix_path = turbopath(matrix_path)
-        if matrix_path.suffix != ".mat":
-            matrix_path = matrix_path.with_suffix(".mat")
-        transformed_image = ants.apply_transforms(
-            fixed=fixed_image,
-            moving=moving_image,
-            transformlist=[matrix_path],
-            **transform_kwargs,
-        )
 
+        transformlist = self._transformlist(matrix_path)
+        matrix_path = transformlist[0] if len(transformlist) == 1 else transformlist
         if is_binary:
-            transformed_image = ants.threshold_image(transformed_image,
-                                                     low_thresh=self.threshold, high_thresh=1.0,
-                                                     inval=1.0, outval=0.0)
-        ants.image_write(transformed_image, transformed_image_path)
+            (transformed_image,) = self._transform_masks(fixed_image, [moving_image], transformlist, transform_kwargs)
+        else:
+            transformed_image = ants.apply_transforms(
+                fixed=fixed_image,
+                moving=moving_image,
+                transformlist=transformlist,
+                **transform_kwargs,
+            )
+        self._write(transformed_image, transformed_image_path)
 
         end_time = datetime.datetime.now()
 
@@ -166,6 +397,271 @@ class ModifiedANTsRegistrator(Registrator):
             end_time=end_time,
         )
 
+    def transform_binaries(
+        self,
+        fixed_image_path: str,
+        moving_image_paths: List[str],
+        transformed_image_paths: List[str],
+        matrix_path: str | List[str],
+        log_file_path: str,
+        **kwargs,
+    ) -> None:
+        """
+        Apply a transformation to a stack of binary masks (e.g. ROI and biopsy) in a single resampling.
+
+        The masks are merged into one multi-component image, so the fixed image and the matrices are read and
+        the interpolation is set up once for all of them. Every channel is thresholded on its own afterwards.
+        Only the bounding box of the masks is resampled (see `_transform_masks`).
+
+        Args:
+            fixed_image_path (str): Path to the fixed image.
+            moving_image_paths (List[str]): Paths to the binary masks, all in the same space.
+            transformed_image_paths (List[str]): Path to the transformed mask (output), one per moving mask.
+            matrix_path (str | List[str]): Path to the transformation matrix, or a list of matrices that is
+                composed and applied in a single resampling (ANTs order: the last matrix is applied first).
+            log_file_path (str): Path to the log file.
+            **kwargs: Additional transformation parameters to update the instantiated defaults.
+        """
+        if len(moving_image_paths) != len(transformed_image_paths):
+            raise ValueError("Expected one transformed image path per moving image path")
+
+        start_time = datetime.datetime.now()
+
+        transform_kwargs = {**self.transformation_params, **kwargs}
+        fixed_image = self._read(fixed_image_path, cache=True)
+        masks = [self._read(path) for path in moving_image_paths]
+        transformed_image_paths = [turbopath(path) for path in transformed_image_paths]
+
+        transformlist = self._transformlist(matrix_path)
+        matrix_path = transformlist[0] if len(transformlist) == 1 else transformlist
+        channels = self._transform_masks(fixed_image, masks, transformlist, transform_kwargs)
+        for channel, transformed_image_path in zip(channels, transformed_image_paths):
+            self._write(channel, transformed_image_path)
+
+        end_time = datetime.datetime.now()
+
+        self._log_to_file(
+            log_file_path=log_file_path,
+            fixed_image_path=fixed_image_path,
+            moving_image_path=", ".join(str(path) for path in moving_image_paths),
+            transformed_image_path=", ".join(str(path) for path in transformed_image_paths),
+            matrix_path=matrix_path,
+            operation_name="binary transformation",
+            start_time=start_time,
+            end_time=end_time,
+        )
+
+    def transform_points(
+        self,
+        fixed_image_path: str,
+        moving_image_path: str,
+        transformed_image_path: str,
+        matrix_path: str | List[str],
+        log_file_path: str,
+        **kwargs,
+    ) -> None:
+        """
+        Transform a sparse mask (e.g. biopsy points) by transforming the coordinates of its marked voxels.
+
+        The marked voxels are taken from the point set stored next to the moving mask by a previous call
+        (see `points_path`), or extracted from the mask. Their physical coordinates and labels are mapped with the
+        inverse of the image transform, stored next to the output, and rasterized onto the fixed image grid by
+        nearest voxel. Unlike resampling and thresholding, no point is lost to interpolation, and the stored
+        coordinates are not rounded between stages.
+
+        Args:
+            fixed_image_path (str): Path to the fixed image.
+            moving_image_path (str): Path to the moving mask.
+            transformed_image_path (str): Path to the rasterized mask (output); the points are stored next to it.
+            matrix_path (str | List[str]): Path to the transformation matrix, or a list of matrices in the order
+                `transform` takes them.
+            log_file_path (str): Path to the log file.
+            **kwargs: Additional parameters for `ants.apply_transforms_to_points`.
+        """
+        start_time = datetime.datetime.now()
+
+        fixed_image = self._read(fixed_image_path, cache=True)
+        transformed_image_path = turbopath(transformed_image_path)
+        transformlist = self._transformlist(matrix_path)
+        matrix_path = transformlist[0] if len(transformlist) == 1 else transformlist
+
+        points = self._read_points(moving_image_path)
+        axes = ["x", "y", "z", "t"][: fixed_image.dimension]
+        # images are resampled with the transform from the fixed to the moving space, points travel the other way
+        transformed = ants.apply_transforms_to_points(
+            dim=fixed_image.dimension,
+            points=points[axes],
+            transformlist=transformlist[::-1],
+            whichtoinvert=[True] * len(transformlist),
+            **kwargs,
+        )
+        transformed["label"] = points["label"].values
+        os.makedirs(transformed_image_path.parent, exist_ok=True)
+        transformed.to_csv(points_path(transformed_image_path), index=False)
+        self._write(self._rasterize(transformed, fixed_image), transformed_image_path)
+
+        end_time = datetime.datetime.now()
+
+        self._log_to_file(
+            log_file_path=log_file_path,
+            fixed_image_path=fixed_image_path,
+            moving_image_path=moving_image_path,
+            transformed_image_path=transformed_image_path,
+            matrix_path=matrix_path,
+            operation_name="point transformation",
+            start_time=start_time,
+            end_time=end_time,
+        )
+
+    def _transform_masks(
+        self,
+        fixed_image: ants.ANTsImage,
+        masks: List[ants.ANTsImage],
+        transformlist: List[str],
+        transform_kwargs: dict,
+    ) -> List[ants.ANTsImage]:
+        """
+        Resample binary masks onto the grid of the fixed image and threshold them to uint8.
+
+        A lesion covers a few percent of the field of view, so only the bounding box of the nonzero voxels is
+        resampled: the box is cropped from the masks, its corners are mapped into the fixed image to find the
+        sub-grid they can reach, and the result is padded back into the full grid. Voxels outside that sub-grid
+        only sample zeros, so the output equals a resampling of the full grid (the transforms are linear).
+
+        Args:
+            fixed_image (ants.ANTsImage): The fixed image.
+            masks (List[ants.ANTsImage]): Binary masks on one grid.
+            transformlist (List[str]): Matrices in ANTs order.
+            transform_kwargs (dict): Parameters for `ants.apply_transforms`.
+
+        Returns:
+            List[ants.ANTsImage]: The transformed masks, one per mask.
+        """
+        region = self._mask_region(fixed_image, masks, transformlist)
+        if region is None:
+            # nothing marked, or nothing that lands inside the fixed image
+            return [self._pad(None, fixed_image, None) for _ in masks]
+        fixed_lower, fixed_upper, moving_lower, moving_upper = region
+
+        cropped = [ants.crop_indices(mask, moving_lower, moving_upper) for mask in masks]
+        transform_kwargs = dict(transform_kwargs)
+        if len(cropped) > 1:
+            # components of a vector image are interpolated independently and not reoriented by a linear transform
+            moving_image = ants.merge_channels(cropped)
+            transform_kwargs["imagetype"] = 1
+        else:
+            moving_image = cropped[0]
+        transformed_image = ants.apply_transforms(
+            fixed=ants.crop_indices(fixed_image, fixed_lower, fixed_upper),
+            moving=moving_image,
+            transformlist=transformlist,
+            **transform_kwargs,
+        )
+
+        channels = ants.split_channels(transformed_image) if len(cropped) > 1 else [transformed_image]
+        return [self._pad(self._threshold(channel), fixed_image, fixed_lower) for channel in channels]
+
+    @staticmethod
+    def _mask_region(
+        fixed_image: ants.ANTsImage,
+        masks: List[ants.ANTsImage],
+        transformlist: List[str],
+        margin: int = 2,
+    ) -> Optional[Tuple[List[int], List[int], List[int], List[int]]]:
+        """
+        Index bounds (lower inclusive, upper exclusive) of the nonzero voxels of the masks, widened by `margin`
+        voxels for the interpolation kernel, and of the part of the fixed image the bounding box maps to.
+
+        Returns:
+            Optional[Tuple[List[int], List[int], List[int], List[int]]]: Fixed lower and upper and moving lower
+                and upper bounds, or None if the masks are empty or map outside the fixed image.
+        """
+        nonzero = np.zeros(masks[0].shape, dtype=bool)
+        for mask in masks:
+            nonzero |= mask.numpy() != 0
+        indices = np.argwhere(nonzero)
+        if len(indices) == 0:
+            return None
+        shape = np.asarray(masks[0].shape)
+        moving_lower = np.maximum(indices.min(axis=0) - margin, 0)
+        moving_upper = np.minimum(indices.max(axis=0) + margin + 1, shape)
+
+        # the image of a box under a linear transform is the convex hull of the images of its corners
+        corners = np.array(list(itertools.product(*zip(moving_lower, moving_upper - 1))))
+        axes = ["x", "y", "z", "t"][: fixed_image.dimension]
+        mapped = ants.apply_transforms_to_points(
+            dim=fixed_image.dimension,
+            points=pd.DataFrame(_physical(masks[0], corners), columns=axes),
+            transformlist=transformlist[::-1],
+            whichtoinvert=[True] * len(transformlist),
+        )
+        fixed_indices = _continuous_index(fixed_image, mapped[axes].values)
+        fixed_lower = np.maximum(np.floor(fixed_indices.min(axis=0)).astype(int) - margin, 0)
+        fixed_upper = np.minimum(np.ceil(fixed_indices.max(axis=0)).astype(int) + margin + 1, fixed_image.shape)
+        if np.any(fixed_upper <= fixed_lower):
+            return None
+        return fixed_lower.tolist(), fixed_upper.tolist(), moving_lower.tolist(), moving_upper.tolist()
+
+    @staticmethod
+    def _pad(
+        image: Optional[ants.ANTsImage],
+        fixed_image: ants.ANTsImage,
+        lower: Optional[List[int]],
+    ) -> ants.ANTsImage:
+        """uint8 image on the grid of `fixed_image` with `image` placed at the index `lower`, zero elsewhere."""
+        array = np.zeros(fixed_image.shape, dtype=np.uint8)
+        if image is not None:
+            array[tuple(slice(start, start + size) for start, size in zip(lower, image.shape))] = image.numpy()
+        return ants.from_numpy(
+            array, origin=fixed_image.origin, spacing=fixed_image.spacing, direction=fixed_image.direction
+        )
+
+    def _read_points(self, mask_path: str) -> pd.DataFrame:
+        """Physical coordinates and labels of the marked voxels of a mask."""
+        if os.path.exists(points_path(mask_path)):
+            return pd.read_csv(points_path(mask_path))
+        mask = self._read(mask_path)
+        array = mask.numpy()
+        indices = np.argwhere(array != 0)
+        points = pd.DataFrame(_physical(mask, indices), columns=["x", "y", "z", "t"][: mask.dimension])
+        points["label"] = array[tuple(indices.T)]
+        return points
+
+    @staticmethod
+    def _rasterize(points: pd.DataFrame, image: ants.ANTsImage) -> ants.ANTsImage:
+        """uint8 mask on the grid of `image` with every point's label at its nearest voxel; points outside are dropped."""
+        axes = ["x", "y", "z", "t"][: image.dimension]
+        indices = np.rint(_continuous_index(image, points[axes].values)).astype(int)
+        inside = np.all((indices >= 0) & (indices < np.asarray(image.shape)), axis=1)
+        array = np.zeros(image.shape, dtype=np.uint8)
+        array[tuple(indices[inside].T)] = points["label"].values[inside]
+        return ants.from_numpy(array, origin=image.origin, spacing=image.spacing, direction=image.direction)
+
+    def _threshold(self, image: ants.ANTsImage) -> ants.ANTsImage:
+        """
+        Binarize an interpolated mask into a uint8 image, 1 where `threshold <= value <= 1`.
+
+        The interpolation itself is float32 (ANTs interpolates in the pixel type of the output, and a linear
+        interpolation of a uint8 mask would round away the fractions the threshold is applied to), so the float
+        input cannot be avoided. The comparison is done on a view of it and yields one byte per voxel directly, without
+        the float32 copy `ants.threshold_image` would make before the cast. Masks are kept as uint8, a quarter of the
+        size of float32 masks in memory and on disk.
+        """
+        values = image.view()
+        mask = ((values >= self.threshold) & (values <= 1.0)).view(np.uint8)
+        return ants.from_numpy(mask, origin=image.origin, spacing=image.spacing, direction=image.direction)
+
+    @staticmethod
+    def _transformlist(matrix_path: str | List[str]) -> List[str]:
+        matrix_paths = [matrix_path] if isinstance(matrix_path, (str, os.PathLike)) else matrix_path
+        transformlist = []
+        for path in matrix_paths:
+            path = turbopath(path)
+            if path.suffix != ".mat":
+                path = path.with_suffix(".mat")
+            transformlist.append(path)
+        return transformlist
+
     @staticmethod
     def _log_to_file(
         log_file_path: str,
@@ -199,23 +695,3 @@ class ModifiedANTsRegistrator(Registrator):
             f.write(f"end time: {end_time} \n")
             f.write(f"duration: {duration_formatted}\n")
 
-
-if __name__ == "__main__":
-    # TODO move this into unit tests
-    reg = ANTsRegistrator()
-
-    reg.register(
-        fixed_image_path="../example/example_data/TCGA-DU-7294/AX_T1_POST_GD_FLAIR_TCGA-DU-7294_TCGA-DU-7294_GE_TCGA-DU-7294_AX_T1_POST_GD_FLAIR_RM_13_t1c.nii.gz",
-        moving_image_path="../example/example_data/TCGA-DU-7294/AX_T2_FR-FSE_RF2_150_TCGA-DU-7294_TCGA-DU-7294_GE_TCGA-DU-7294_AX_T2_FR-FSE_RF2_150_RM_4_t2.nii.gz",
-        transformed_image_path="example/example_ants/transformed_image.nii.gz",
-        matrix_path="example/example_ants_matrix/matrix",
-        log_file_path="example/example_ants/log.txt",
-    )
-
-    reg.transform(
-        fixed_image_path="../example/example_data/TCGA-DU-7294/AX_T1_POST_GD_FLAIR_TCGA-DU-7294_TCGA-DU-7294_GE_TCGA-DU-7294_AX_T1_POST_GD_FLAIR_RM_13_t1c.nii.gz",
-        moving_image_path="../example/example_data/OtherEXampleFromTCIA/T1_AX_OtherEXampleTCIA_TCGA-FG-6692_Si_TCGA-FG-6692_T1_AX_SE_10_se2d1_t1.nii.gz",
-        transformed_image_path="example/example_ants_transformed/transformed_image.nii.gz",
-        matrix_path="example/example_ants_matrix/matrix.mat",
-        log_file_path="example/example_ants/log.txt",
-    )
@@ -0,0 +1,82 @@
+import os
+import tempfile
+import threading
+from typing import Dict, Optional, Tuple
+
+import ants
+from auxiliary.turbopath import turbopath
+
+from modified.manifest import file_digest
+
+
+class PreparedAtlas:
+    """
+    Registration-ready copy of an atlas image, shared by all patients.
+
+    The atlas is converted to float32 (the pixel type ANTs registers with) and stored uncompressed under
+    `cache_dir`, in a folder named after the digest of the atlas file, so every process after the first one
+    reads it without decompressing or casting. The decoded image is kept in memory for the lifetime of the
+    process.
+
+    Args:
+        atlas_image_path (str): Path to the atlas image.
+        cache_dir (str, optional): Directory of prepared atlases. Defaults to a folder in the system temp directory.
+
+    Example:
+        >>> atlas = prepare_atlas("registration/atlas/t1_brats_space.nii")
+        >>> registrator.preload(atlas.image_path, atlas.image)
+        >>> registrator.register(fixed_image_path=atlas.image_path, ...)
+    """
+
+    file_name = "atlas_float32.nii"
+
+    def __init__(self, atlas_image_path: str, cache_dir: Optional[str] = None) -> None:
+        self.atlas_image_path = turbopath(atlas_image_path)
+        cache_dir = cache_dir or os.path.join(tempfile.gettempdir(), "prepared-atlas")
+        self.image_path = turbopath(
+            os.path.join(cache_dir, file_digest(self.atlas_image_path)[:16], self.file_name)
+        )
+        self._image = None
+        self._lock = threading.Lock()
+
+    @property
+    def image(self) -> ants.ANTsImage:
+        """The float32 atlas, built or read on first access."""
+        with self._lock:
+            if self._image is None:
+                if os.path.exists(self.image_path):
+                    self._image = ants.image_read(self.image_path)
+                else:
+                    self._image = ants.image_read(self.atlas_image_path).clone("float")
+                    os.makedirs(self.image_path.parent, exist_ok=True)
+                    # write next to the target and rename, so concurrent processes never read a partial file
+                    temp_path = f"{self.image_path}.{os.getpid()}.nii"
+                    ants.image_write(self._image, temp_path)
+                    os.replace(temp_path, self.image_path)
+            return self._image
+
+
+_prepared: Dict[Tuple[str, int, int, Optional[str]], PreparedAtlas] = {}
+_prepared_lock = threading.Lock()
+
+
+def prepare_atlas(atlas_image_path: str, cache_dir: Optional[str] = None) -> PreparedAtlas:
+    """
+    Get the prepared atlas of an atlas image, once per process.
+
+    Args:
+        atlas_image_path (str): Path to the atlas image.
+        cache_dir (str, optional): Directory of prepared atlases.
+
+    Returns:
+        PreparedAtlas: The prepared atlas; its image is already built or read.
+    """
+    stat = os.stat(atlas_image_path)
+    key = (os.path.abspath(atlas_image_path), stat.st_mtime_ns, stat.st_size, cache_dir)
+    with _prepared_lock:
+        if key not in _prepared:
+            _prepared[key] = PreparedAtlas(atlas_image_path, cache_dir=cache_dir)
+        atlas = _prepared[key]
+    # build or read it now, before patients register against it concurrently
+    atlas.image
+    return atlas
@@ -0,0 +1,249 @@
+import queue
+import threading
+from concurrent.futures import Future
+from itertools import combinations
+from multiprocessing.managers import BaseManager
+from typing import List, Optional, Tuple
+
+import numpy as np
+import torch
+from brainles_hd_bet.config import config
+from brainles_hd_bet.data_loading import load_and_preprocess, save_segmentation_nifti
+from brainles_hd_bet.predict_case import pad_patient_3D
+from brainles_hd_bet.run import apply_bet
+from brainles_hd_bet.utils import SetNetworkToVal, get_params_fname, maybe_download_parameters
+
+from brainles_preprocessing.brain_extraction.brain_extractor import BrainExtractor
+
+
+class HDBetService(BrainExtractor):
+    """
+    Long-lived HD-BET brain extractor that keeps the network and its weights loaded.
+
+    `HDBetExtractor` rebuilds the network and reloads all weights on every call. This service loads them once,
+    on first use, and reuses them for every following extraction. Volumes with the same preprocessed shape
+    (e.g. the atlas-space center images of different patients) are predicted together in one batched forward
+    pass; the network uses instance normalization, so batching does not change the result of a single volume.
+
+    Concurrent `extract` calls (from several patients run in threads, or from several processes via
+    `BrainExtractionManager`) are queued and coalesced into batches of up to `batch_size` volumes.
+
+    Args:
+        mode (str, optional): "accurate" (ensemble of 5 networks) or "fast" (single network).
+        device (int | str, optional): CUDA device id or "cpu". Falls back to "cpu" if CUDA is not available.
+        do_tta (bool, optional): Test time augmentation by mirroring along all axes.
+        batch_size (int, optional): Maximum number of volumes predicted in one forward pass.
+        max_wait (float, optional): Seconds to wait for more requests before running an incomplete batch.
+            With the default 0, a batch consists of the requests that queued up while the previous one ran.
+        num_threads (int, optional): Threads of the torch CPU backend. Defaults to the torch default (all cores).
+
+    Example:
+        >>> brain_extractor = HDBetService(device="cpu", batch_size=4)
+        >>> brain_extractor.extract_batch(
+        ...     input_image_paths=["p1/atlas__t1c.nii.gz", "p2/atlas__t1c.nii.gz"],
+        ...     masked_image_paths=["p1/atlas_bet_t1c.nii.gz", "p2/atlas_bet_t1c.nii.gz"],
+        ...     brain_mask_paths=["p1/atlas_bet_t1c_mask.nii.gz", "p2/atlas_bet_t1c_mask.nii.gz"],
+        ... )
+    """
+
+    def __init__(
+        self,
+        mode: str = "accurate",
+        device: int | str = 0,
+        do_tta: bool = True,
+        batch_size: int = 4,
+        max_wait: float = 0.0,
+        num_threads: Optional[int] = None,
+    ) -> None:
+        if mode not in ("fast", "accurate"):
+            raise ValueError(f"Unknown value for mode: {mode}. Expected: fast or accurate")
+        # fallback to CPU if CUDA is not available
+        if not torch.cuda.is_available() and device != "cpu":
+            device = "cpu"
+
+        self.mode = mode
+        self.device = device
+        self.do_tta = do_tta
+        self.batch_size = batch_size
+        self.max_wait = max_wait
+        self.num_threads = num_threads
+
+        self._net = None
+        self._params = None
+        self._config = None
+        self._load_lock = threading.Lock()
+        self._predict_lock = threading.Lock()
+        self._requests = queue.Queue()
+        self._worker = None
+
+    def settings(self) -> dict:
+        """
+        The settings that determine the extracted masks, e.g. for stage manifests.
+
+        A method rather than attributes, so that it can also be read through a `BrainExtractionManager` proxy.
+
+        Returns:
+            dict: Class name, mode and test time augmentation.
+        """
+        return {"class": type(self).__name__, "mode": self.mode, "do_tta": self.do_tta}
+
+    def extract(
+        self,
+        input_image_path: str,
+        masked_image_path: str,
+        brain_mask_path: str,
+        log_file_path: Optional[str] = None,
+        mode: Optional[str] = None,
+    ) -> None:
+        """
+        Skullstrip an image, batched together with concurrent requests.
+
+        Args:
+            input_image_path (str): Path to the input image.
+            masked_image_path (str): Path to the skullstripped image (output).
+            brain_mask_path (str): Path to the brain mask (output).
+            log_file_path (str, optional): Unused, for compatibility with `BrainExtractor`.
+            mode (str, optional): Must match the service mode if given; the loaded weights define the mode.
+        """
+        if mode is not None and mode != self.mode:
+            raise ValueError(f"HDBetService was loaded in {self.mode} mode, got {mode}")
+
+        request = Future()
+        self._requests.put(
+            ((str(input_image_path), str(masked_image_path), str(brain_mask_path)), request)
+        )
+        with self._load_lock:
+            if self._worker is None:
+                self._worker = threading.Thread(target=self._serve, daemon=True)
+                self._worker.start()
+        request.result()
+
+    def extract_batch(
+        self,
+        input_image_paths: List[str],
+        masked_image_paths: List[str],
+        brain_mask_paths: List[str],
+    ) -> None:
+        """
+        Skullstrip several images, predicting images of equal shape in one forward pass.
+
+        Args:
+            input_image_paths (List[str]): Paths to the input images.
+            masked_image_paths (List[str]): Paths to the skullstripped images (output).
+            brain_mask_paths (List[str]): Paths to the brain masks (output).
+        """
+        cases = [load_and_preprocess(str(path)) for path in input_image_paths]
+
+        batches = {}
+        for index, (data, _) in enumerate(cases):
+            batches.setdefault(data.shape, []).append(index)
+
+        for indices in batches.values():
+            for start in range(0, len(indices), self.batch_size):
+                chunk = indices[start : start + self.batch_size]
+                segmentations = self._predict([cases[index][0] for index in chunk])
+                for index, segmentation in zip(chunk, segmentations):
+                    save_segmentation_nifti(
+                        segmentation, cases[index][1], str(brain_mask_paths[index])
+                    )
+                    apply_bet(
+                        str(input_image_paths[index]),
+                        str(brain_mask_paths[index]),
+                        str(masked_image_paths[index]),
+                    )
+
+    def _serve(self) -> None:
+        """Worker thread: collect queued requests into batches and run them."""
+        while True:
+            requests = [self._requests.get()]
+            while len(requests) < self.batch_size:
+                try:
+                    if self.max_wait > 0:
+                        requests.append(self._requests.get(timeout=self.max_wait))
+                    else:
+                        requests.append(self._requests.get_nowait())
+                except queue.Empty:
+                    break
+
+            paths, futures = zip(*requests)
+            try:
+                self.extract_batch(*zip(*paths))
+            except Exception as error:
+                for future in futures:
+                    future.set_exception(error)
+            else:
+                for future in futures:
+                    future.set_result(None)
+
+    def _load(self) -> Tuple[torch.nn.Module, list, config]:
+        """Build the network and load the weights, once."""
+        with self._load_lock:
+            if self._net is None:
+                folds = [0] if self.mode == "fast" else range(5)
+                for fold in folds:
+                    maybe_download_parameters(fold)
+                self._params = [
+                    torch.load(get_params_fname(fold), map_location=lambda storage, loc: storage)
+                    for fold in folds
+                ]
+                if self.num_threads is not None:
+                    torch.set_num_threads(self.num_threads)
+                self._config = config()
+                net, _ = self._config.get_network(self._config.val_use_train_mode, None)
+                self._net = net.cpu() if self.device == "cpu" else net.cuda(self.device)
+        return self._net, self._params, self._config
+
+    def _predict(self, volumes: List[np.ndarray]) -> List[np.ndarray]:
+        """
+        Segment volumes of equal shape, equivalent to `predict_case_3D_net` per volume and ensemble member.
+
+        Args:
+            volumes (List[np.ndarray]): Preprocessed volumes, each of shape (1, x, y, z).
+
+        Returns:
+            List[np.ndarray]: Brain segmentation per volume.
+        """
+        net, params, cf = self._load()
+
+        padded = []
+        for volume in volumes:
+            data, old_shape = pad_patient_3D(
+                volume[0], cf.net_input_must_be_divisible_by, cf.val_min_size
+            )
+            padded.append(data[None])
+        batch = torch.from_numpy(np.stack(padded).astype(np.float32))
+        if self.device != "cpu":
+            batch = batch.cuda(self.device)
+
+        mirror_axes = cf.da_mirror_axes if self.do_tta else ()
+        mirrors = [
+            axes for n in range(len(mirror_axes) + 1) for axes in combinations(mirror_axes, n)
+        ]
+
+        # mean over ensemble members and mirrors, as run_hd_bet does per volume
+        softmax = 0
+        with self._predict_lock, torch.no_grad():
+            for p in params:
+                net.load_state_dict(p)
+                net.eval()
+                net.apply(SetNetworkToVal(False, False))
+                for axes in mirrors:
+                    prediction = net(torch.flip(batch, axes) if axes else batch)
+                    prediction = torch.flip(prediction, axes) if axes else prediction
+                    softmax = softmax + prediction.cpu().numpy()
+        softmax = softmax[:, :, : old_shape[0], : old_shape[1], : old_shape[2]]
+        return list(np.argmax(softmax, axis=1))
+
+
+class BrainExtractionManager(BaseManager):
+    """
+    Hosts one `HDBetService` in a server process so that worker processes can share the loaded model.
+
+    Example:
+        >>> with BrainExtractionManager() as manager:
+        ...     brain_extractor = manager.HDBetService(device="cpu")
+        ...     # pass brain_extractor (a picklable proxy) to the worker processes
+    """
+
+
+BrainExtractionManager.register("HDBetService", HDBetService)
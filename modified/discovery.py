@@ -0,0 +1,114 @@
+import json
+import os
+import re
+from typing import Callable, Dict, List, Optional
+
+MODALITIES = ("t1c", "t2", "t1", "fla")
+BINARY_TYPES = ("roi", "biopsy")
+
+# a file belongs to the modality / mask its name ends with, exactly like the glob "*t1c.nii.gz", "*t1c_roi.nii.gz", ...;
+# no modality name is a suffix of another, so a file matches at most one bucket
+_PATTERN = re.compile(rf"({'|'.join(MODALITIES)})(?:_({'|'.join(BINARY_TYPES)}))?\.nii\.gz$")
+
+
+def bucket_keys() -> List[str]:
+    """Keys of `scan_exam`: "t1c", ..., "t1c_roi", ..., "t1c_biopsy", ..."""
+    return [*MODALITIES] + [f"{modality}_{kind}" for kind in BINARY_TYPES for modality in MODALITIES]
+
+
+def scan_exam(exam_dir: str) -> Dict[str, List[str]]:
+    """
+    Classify the files of an exam folder into modality, ROI and biopsy buckets with a single directory listing.
+
+    Args:
+        exam_dir (str): Path to the exam folder.
+
+    Returns:
+        Dict[str, List[str]]: Sorted file paths per key of `bucket_keys`, e.g. {"t1c": [...], "t1c_roi": [...]}.
+    """
+    buckets = {key: [] for key in bucket_keys()}
+    with os.scandir(exam_dir) as entries:
+        for entry in entries:
+            match = _PATTERN.search(entry.name)
+            if match is None or not entry.is_file():
+                continue
+            modality, kind = match.groups()
+            buckets[modality if kind is None else f"{modality}_{kind}"].append(entry.path)
+    return {key: sorted(paths) for key, paths in buckets.items()}
+
+
+class DataIndex:
+    """
+    Index of the exam folders below a data folder and of their files, optionally persisted between runs.
+
+    Every folder is listed once. With an index file, the listing of a folder is reused on a rerun as long as the
+    modification time of the folder is unchanged (adding, removing or renaming a file changes it), so only changed
+    folders are listed again; on a network filesystem, a stat is much cheaper than a listing.
+
+    Args:
+        data_dir (str): Folder with one subfolder per exam.
+        index_path (str, optional): JSON file the index is kept in between runs.
+
+    Example:
+        >>> index = DataIndex("/path/to/data", index_path="/path/to/data/.index.json")
+        >>> for exam_dir in index.exams():
+        ...     files = index.files(exam_dir)
+        >>> index.save()
+    """
+
+    version = 1
+
+    def __init__(self, data_dir: str, index_path: Optional[str] = None) -> None:
+        self.data_dir = os.path.abspath(data_dir)
+        self.index_path = index_path
+        self._entries: Dict[str, dict] = {}
+        self._dirty = False
+        if index_path is not None:
+            self._entries = self._load(index_path)
+
+    def _load(self, index_path: str) -> Dict[str, dict]:
+        try:
+            with open(index_path) as f:
+                index = json.load(f)
+        except (OSError, ValueError):
+            return {}
+        if index.get("version") != self.version or index.get("data_dir") != self.data_dir:
+            return {}
+        return index["entries"]
+
+    def _entry(self, path: str, scan: Callable[[str], object]) -> object:
+        mtime_ns = os.stat(path).st_mtime_ns
+        entry = self._entries.get(path)
+        if entry is None or entry["mtime_ns"] != mtime_ns:
+            entry = {"mtime_ns": mtime_ns, "content": scan(path)}
+            self._entries[path] = entry
+            self._dirty = True
+        return entry["content"]
+
+    def exams(self) -> List[str]:
+        """Sorted paths of the exam folders, without hidden folders."""
+
+        def scan(path: str) -> List[str]:
+            with os.scandir(path) as entries:
+                # hidden folders (e.g. a work queue or a cache) are not exams
+                return sorted(entry.path for entry in entries if entry.is_dir() and not entry.name.startswith("."))
+
+        return self._entry(self.data_dir, scan)
+
+    def files(self, exam_dir: str) -> Dict[str, List[str]]:
+        """Files of an exam folder, as returned by `scan_exam`."""
+        return self._entry(os.path.abspath(exam_dir), scan_exam)
+
+    def save(self) -> None:
+        """Write the index file, if there is one and anything was listed again."""
+        if self.index_path is None or not self._dirty:
+            return
+        # forget exam folders that were removed
+        live = {self.data_dir, *self._entries.get(self.data_dir, {}).get("content", [])}
+        self._entries = {path: entry for path, entry in self._entries.items() if path in live}
+        os.makedirs(os.path.dirname(os.path.abspath(self.index_path)), exist_ok=True)
+        temp_path = f"{self.index_path}.{os.getpid()}.tmp"
+        with open(temp_path, "w") as f:
+            json.dump({"version": self.version, "data_dir": self.data_dir, "entries": self._entries}, f)
+        os.replace(temp_path, self.index_path)
+        self._dirty = False
@@ -0,0 +1,130 @@
+import hashlib
+import json
+import os
+from typing import Dict, List, Optional
+
+from auxiliary.turbopath import turbopath
+
+
+def file_digest(path: str, chunk_size: int = 1 << 20) -> str:
+    """
+    Compute the SHA-256 digest of a file's content.
+
+    Args:
+        path (str): Path to the file.
+        chunk_size (int, optional): Number of bytes read at a time.
+
+    Returns:
+        str: Hex digest of the file content.
+    """
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class StageManifest:
+    """
+    Records the inputs, parameters and outputs of one preprocessing stage next to its saved results.
+
+    A stage can be skipped on a rerun if its manifest was written with the same input digests and
+    parameters and every output file it recorded still exists.
+
+    Args:
+        save_dir (str): Directory the stage results are saved to.
+
+    Example:
+        >>> manifest = StageManifest("/path/to/patient_brainles/co-registration")
+        >>> if not manifest.matches(inputs, parameters):
+        ...     run_stage()
+        ...     manifest.write(inputs, parameters, outputs)
+    """
+
+    file_name = "manifest.json"
+
+    def __init__(self, save_dir: str) -> None:
+        self.path = turbopath(save_dir) / self.file_name
+
+    def load(self) -> Optional[dict]:
+        """
+        Read the manifest from disk.
+
+        Returns:
+            Optional[dict]: The manifest content, or None if it is missing or unreadable.
+        """
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def matches(self, inputs: Dict[str, str], parameters: dict) -> bool:
+        """
+        Check whether the stage can be skipped.
+
+        Args:
+            inputs (Dict[str, str]): Content digests of the stage inputs.
+            parameters (dict): Parameters the stage would run with.
+
+        Returns:
+            bool: True if inputs and parameters are unchanged and all recorded outputs exist.
+        """
+        manifest = self.load()
+        if manifest is None:
+            return False
+        if manifest["inputs"] != inputs or manifest["parameters"] != _jsonable(parameters):
+            return False
+        return all(
+            path is None or os.path.exists(path)
+            for outputs in manifest["outputs"].values()
+            for path in outputs.values()
+        )
+
+    @property
+    def outputs(self) -> Dict[str, Dict[str, Optional[str]]]:
+        return self.load()["outputs"]
+
+    @property
+    def transforms(self) -> Dict[str, List[str]]:
+        return self.load().get("transforms", {})
+
+    def invalidate(self) -> None:
+        """Remove the manifest so that partially rewritten outputs are never trusted."""
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def write(
+        self,
+        inputs: Dict[str, str],
+        parameters: dict,
+        outputs: Dict[str, Dict[str, Optional[str]]],
+        transforms: Optional[Dict[str, List[str]]] = None,
+    ) -> None:
+        """
+        Write the manifest after the stage results have been saved.
+
+        Args:
+            inputs (Dict[str, str]): Content digests of the stage inputs.
+            parameters (dict): Parameters the stage ran with.
+            outputs (Dict[str, Dict[str, Optional[str]]]): Saved output paths per modality.
+            transforms (Dict[str, List[str]], optional): Matrices from the input files to the stage's space
+                per modality, most recent first.
+        """
+        os.makedirs(self.path.parent, exist_ok=True)
+        with open(self.path, "w") as f:
+            json.dump(
+                {
+                    "inputs": inputs,
+                    "parameters": _jsonable(parameters),
+                    "outputs": outputs,
+                    "transforms": transforms or {},
+                },
+                f,
+                indent=2,
+            )
+
+
+def _jsonable(value) -> dict:
+    # round-trip through json so tuples, paths etc. compare equal to what was loaded from disk
+    return json.loads(json.dumps(value, sort_keys=True, default=str))
@@ -0,0 +1,78 @@
+import errno
+import os
+import shutil
+from collections import Counter
+from typing import Dict
+
+# ioctl request of Linux to share the extents of a file (copy-on-write), e.g. on btrfs and xfs
+_FICLONE = 0x40049409
+
+
+def _reflink(src: str, dst: str) -> None:
+    import fcntl
+
+    with open(src, "rb") as source, open(dst, "wb") as destination:
+        try:
+            fcntl.ioctl(destination.fileno(), _FICLONE, source.fileno())
+        except OSError:
+            destination.close()
+            os.remove(dst)
+            raise
+
+
+def materialize(src: str, dst: str) -> str:
+    """
+    Make `dst` a file with the content of `src`, writing as little as possible.
+
+    Tries a reflink (copy-on-write clone, an independent file that shares the data blocks), then a hardlink
+    (same file under a second name), and copies if neither works, e.g. across filesystems. An existing `dst`
+    is replaced, never written through, so a file linked to it elsewhere keeps its content.
+
+    Callers must not rewrite `src` in place afterwards, since a hardlinked `dst` would change with it.
+
+    Args:
+        src (str): Source file.
+        dst (str): Destination file.
+
+    Returns:
+        str: The method used: "reflink", "hardlink" or "copy" ("same" if `src` is `dst`).
+    """
+    src, dst = os.fspath(src), os.fspath(dst)
+    if os.path.abspath(src) == os.path.abspath(dst):
+        return "same"
+    if os.path.lexists(dst):
+        os.remove(dst)
+    try:
+        _reflink(src, dst)
+        return "reflink"
+    except (ImportError, OSError):
+        pass
+    try:
+        os.link(src, dst)
+        return "hardlink"
+    except OSError as error:
+        if error.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK, errno.ENOTSUP, errno.EOPNOTSUPP):
+            raise
+    shutil.copyfile(src, dst)
+    return "copy"
+
+
+def materialize_tree(src: str, dst: str) -> Dict[str, int]:
+    """
+    Materialize every file below `src` at the same relative path below `dst`, like `shutil.copytree` with
+    `dirs_exist_ok=True`.
+
+    Args:
+        src (str): Source directory.
+        dst (str): Destination directory.
+
+    Returns:
+        Dict[str, int]: Number of files per method.
+    """
+    methods = Counter()
+    for root, _, files in os.walk(src):
+        target = os.path.join(dst, os.path.relpath(root, src))
+        os.makedirs(target, exist_ok=True)
+        for name in files:
+            methods[materialize(os.path.join(root, name), os.path.join(target, name))] += 1
+    return dict(methods)
@@ -1,13 +1,25 @@
+from __future__ import annotations
+
 import os
-import shutil
-from typing import List, Optional
+from typing import List, Optional, TYPE_CHECKING
 
-from auxiliary.nifti.io import read_nifti, write_nifti
 from auxiliary.normalization.normalizer_base import Normalizer
 from auxiliary.turbopath import turbopath
 
-from brainles_preprocessing.brain_extraction.brain_extractor import BrainExtractor
-from brainles_preprocessing.registration.registrator import Registrator
+from modified.materialize import materialize
+from modified.nifti import apply_mask, read_array, write_array
+
+if TYPE_CHECKING:
+    # the brainles_preprocessing packages import HD-BET (torch) and every registration backend
+    from brainles_preprocessing.brain_extraction.brain_extractor import BrainExtractor
+    from brainles_preprocessing.registration.registrator import Registrator
+
+INTERMEDIATE_FORMATS = ("nii.gz", "nii")
+
+
+def nifti_extension(path: str) -> str:
+    """File extension of a NIfTI file: ".nii.gz" or ".nii"."""
+    return ".nii.gz" if str(path).endswith(".nii.gz") else ".nii"
 
 
 class ModifiedModalitiy:
@@ -70,9 +82,15 @@ class ModifiedModalitiy:
         self.current_roi = self.roi_path
         self.current_biopsy = self.biopsy_path
 
+        # matrices mapping the input files to the current space, most recent first (ANTs transform list order)
+        self.transforms: List[str] = []
+
         self.normalizer = normalizer
         self.atlas_correction = atlas_correction
 
+        # file format of the intermediate files, set by the preprocessor; outputs are always written as given
+        self.intermediate_format = "nii.gz"
+
         # check that atleast one output is generated
         if (
             raw_bet_output_path is None
@@ -130,6 +148,15 @@ class ModifiedModalitiy:
             for path in [self.raw_bet_output_path, self.normalized_bet_output_path]
         )
 
+    @property
+    def binary_types(self) -> List[str]:
+        """Types of the binary masks given for this modality, e.g. ["roi", "biopsy"]."""
+        return [
+            binary_type
+            for binary_type in ("roi", "biopsy")
+            if getattr(self, f"{binary_type}_path") is not None
+        ]
+
     def normalize(
         self,
         temporary_directory: str,
@@ -145,31 +172,35 @@ class ModifiedModalitiy:
         Returns:
             None
         """
-        # Backup the unnormalized file
+        # Backup the unnormalized file; the normalized image replaces the file below instead of rewriting it,
+        # so the backups can share its data
+        extension = nifti_extension(self.current_image)
         if store_unnormalized is not None:
             os.makedirs(store_unnormalized, exist_ok=True)
-            shutil.copyfile(
-                src=self.current_image,
-                dst=f"{store_unnormalized}/unnormalized__{self.modality_name}.nii.gz",
+            materialize(
+                self.current_image,
+                f"{store_unnormalized}/unnormalized__{self.modality_name}{extension}",
             )
 
         if temporary_directory is not None:
             unnormalized_dir = f"{temporary_directory}/unnormalized"
             os.makedirs(unnormalized_dir, exist_ok=True)
-            shutil.copyfile(
-                src=self.current_image,
-                dst=f"{unnormalized_dir}/unnormalized__{self.modality_name}.nii.gz",
+            materialize(
+                self.current_image,
+                f"{unnormalized_dir}/unnormalized__{self.modality_name}{extension}",
             )
 
         # Normalize the image
         if self.normalizer is not None:
-            image = read_nifti(self.current_image)
+            image = read_array(self.current_image)
             normalized_image = self.normalizer.normalize(image=image)
-            write_nifti(
-                input_array=normalized_image,
-                output_nifti_path=self.current_image,
-                reference_nifti_path=self.current_image,
+            normalized_path = f"{self.current_image}.normalized{extension}"
+            write_array(
+                normalized_image,
+                normalized_path,
+                reference_path=self.current_image,
             )
+            os.replace(normalized_path, self.current_image)
 
     def register(
         self,
@@ -177,6 +208,8 @@ class ModifiedModalitiy:
         fixed_image_path: str,
         registration_dir: str,
         moving_image_name: str,
+        composite: bool = False,
+        profile: Optional[str] = None,
     ) -> str:
         """
         Register the current modality to a fixed image using the specified registrator.
@@ -186,11 +219,14 @@ class ModifiedModalitiy:
             fixed_image_path (str): Path to the fixed image.
             registration_dir (str): Directory to store registration results.
             moving_image_name (str): Name of the moving image.
+            composite (bool, optional): Resample the registered image from the input image with all transforms
+                so far instead of keeping the resampling of the current image.
+            profile (str, optional): Named registration profile, for registrators that support profiles.
 
         Returns:
             str: Path to the registration matrix.
         """
-        registered = os.path.join(registration_dir, f"{moving_image_name}.nii.gz")
+        registered = os.path.join(registration_dir, f"{moving_image_name}.{self.intermediate_format}")
         registered_matrix = os.path.join(
             registration_dir, f"{moving_image_name}"
         )  # note, add file ending depending on registration backend!
@@ -202,7 +238,17 @@ class ModifiedModalitiy:
             transformed_image_path=registered,
             matrix_path=registered_matrix,
             log_file_path=registered_log,
+            **({"profile": profile} if profile is not None else {}),
         )
+        self.transforms = [registered_matrix, *self.transforms]
+        if composite and len(self.transforms) > 1:
+            registrator.transform(
+                fixed_image_path=fixed_image_path,
+                moving_image_path=self.image_path,
+                transformed_image_path=registered,
+                matrix_path=self.transforms,
+                log_file_path=registered_log,
+            )
 
         self.current_image = registered
         return registered_matrix
@@ -227,13 +273,17 @@ class ModifiedModalitiy:
         if self.bet:
             brain_masked = os.path.join(
                 brain_masked_dir_path,
-                f"brain_masked__{self.modality_name}.nii.gz",
-            )
-            brain_extractor.apply_mask(
-                input_image_path=self.current_image,
-                mask_image_path=atlas_mask_path,
-                masked_image_path=brain_masked,
+                f"brain_masked__{self.modality_name}.{self.intermediate_format}",
             )
+            if nifti_extension(self.current_image) == ".nii":
+                # uncompressed intermediates are masked memory-mapped instead of decoded
+                apply_mask(self.current_image, atlas_mask_path, brain_masked)
+            else:
+                brain_extractor.apply_mask(
+                    input_image_path=self.current_image,
+                    mask_image_path=atlas_mask_path,
+                    masked_image_path=brain_masked,
+                )
             self.current_image = brain_masked
 
     def transform(
@@ -243,6 +293,7 @@ class ModifiedModalitiy:
         registration_dir_path: str,
         moving_image_name: str,
         transformation_matrix_path: str,
+        composite: bool = False,
     ) -> None:
         """
         Transform the current modality using the specified registrator and transformation matrix.
@@ -253,20 +304,23 @@ class ModifiedModalitiy:
             registration_dir_path (str): Directory to store transformation results.
             moving_image_name (str): Name of the moving image.
             transformation_matrix_path (str): Path to the transformation matrix.
+            composite (bool, optional): Resample the input image with all transforms so far instead of the
+                current image with this transform only.
 
         Returns:
             None
         """
-        transformed = os.path.join(registration_dir_path, f"{moving_image_name}.nii.gz")
+        transformed = os.path.join(registration_dir_path, f"{moving_image_name}.{self.intermediate_format}")
         transformed_log = os.path.join(
             registration_dir_path, f"{moving_image_name}.log"
         )
 
+        self.transforms = [transformation_matrix_path, *self.transforms]
         registrator.transform(
             fixed_image_path=fixed_image_path,
-            moving_image_path=self.current_image,
+            moving_image_path=self.image_path if composite else self.current_image,
             transformed_image_path=transformed,
-            matrix_path=transformation_matrix_path,
+            matrix_path=self.transforms if composite else transformation_matrix_path,
             log_file_path=transformed_log,
         )
         self.current_image = transformed
@@ -278,7 +332,8 @@ class ModifiedModalitiy:
             registration_dir_path: str,
             moving_binary_name: str,
             transformation_matrix_path: str,
-            binary_type: str
+            binary_type: str,
+            composite: bool = False,
     ) -> None:
         """
         Transform the current modality using the specified registrator and transformation matrix.
@@ -290,6 +345,8 @@ class ModifiedModalitiy:
             moving_binary_name (str): Name of the moving image.
             transformation_matrix_path (str): Path to the transformation matrix.
             binary_type (str): Type of the binary mask: roi or biopsy
+            composite (bool, optional): Resample the input mask with all transforms of the image so far
+                (which already include this step's matrix) and threshold once.
 
         Returns:
             None
@@ -297,7 +354,10 @@ class ModifiedModalitiy:
 
         assert binary_type in ["roi", "biopsy"]
 
-        transformed = os.path.join(registration_dir_path, f"{moving_binary_name}.nii.gz")
+        if composite:
+            transformation_matrix_path = self.transforms
+
+        transformed = os.path.join(registration_dir_path, f"{moving_binary_name}.{self.intermediate_format}")
         transformed_log = os.path.join(
             registration_dir_path, f"{moving_binary_name}.log"
         )
@@ -305,7 +365,7 @@ class ModifiedModalitiy:
         if binary_type == "roi":
             registrator.transform(
                 fixed_image_path=fixed_image_path,
-                moving_image_path=self.current_roi,
+                moving_image_path=self.roi_path if composite else self.current_roi,
                 transformed_image_path=transformed,
                 matrix_path=transformation_matrix_path,
                 log_file_path=transformed_log,
@@ -315,7 +375,7 @@ class ModifiedModalitiy:
         elif binary_type == "biopsy":
             registrator.transform(
                 fixed_image_path=fixed_image_path,
-                moving_image_path=self.current_biopsy,
+                moving_image_path=self.biopsy_path if composite else self.current_biopsy,
                 transformed_image_path=transformed,
                 matrix_path=transformation_matrix_path,
                 log_file_path=transformed_log,
@@ -325,6 +385,99 @@ class ModifiedModalitiy:
         else:
             raise ValueError(f"binary_type {binary_type} not supported")
 
+    def transform_binaries(
+            self,
+            registrator: Registrator,
+            fixed_image_path: str,
+            registration_dir_path: str,
+            binary_prefix: str,
+            transformation_matrix_path: str,
+            binary_types: Optional[List[str]] = None,
+            composite: bool = False,
+            biopsy_mode: str = "volume",
+    ) -> None:
+        """
+        Transform all binary masks of the modality together with one resampling of the stacked masks.
+
+        Falls back to one `transform_binary` per mask if the registrator cannot transform stacked masks.
+
+        Args:
+            registrator (Registrator): The registrator object.
+            fixed_image_path (str): Path to the fixed image.
+            registration_dir_path (str): Directory to store transformation results.
+            binary_prefix (str): Prefix of the transformed mask names, followed by the mask name.
+            transformation_matrix_path (str): Path to the transformation matrix.
+            binary_types (List[str], optional): Masks to transform. Defaults to all masks of the modality.
+            composite (bool, optional): Resample the input masks with all transforms of the image so far
+                (which already include this step's matrix) and threshold once.
+            biopsy_mode (str, optional): "volume" resamples the biopsy mask like the ROI, "points" transforms the
+                coordinates of its marked voxels instead (if the registrator supports it), so no point is lost.
+
+        Returns:
+            None
+        """
+        if biopsy_mode not in ("volume", "points"):
+            raise ValueError(f"biopsy_mode {biopsy_mode} not supported")
+        binary_types = self.binary_types if binary_types is None else binary_types
+        transform_points = getattr(registrator, "transform_points", None)
+        if biopsy_mode == "points" and transform_points is not None and "biopsy" in binary_types:
+            binary_types = [binary_type for binary_type in binary_types if binary_type != "biopsy"]
+            transformed = os.path.join(
+                registration_dir_path, f"{binary_prefix}{self.biopsy_name}.{self.intermediate_format}"
+            )
+            transform_points(
+                fixed_image_path=fixed_image_path,
+                moving_image_path=self.biopsy_path if composite else self.current_biopsy,
+                transformed_image_path=transformed,
+                matrix_path=self.transforms if composite else transformation_matrix_path,
+                log_file_path=os.path.join(registration_dir_path, f"{binary_prefix}{self.biopsy_name}.log"),
+            )
+            self.current_biopsy = transformed
+
+        if not binary_types:
+            return
+
+        transform_binaries = getattr(registrator, "transform_binaries", None)
+        if transform_binaries is None:
+            for binary_type in binary_types:
+                self.transform_binary(
+                    registrator=registrator,
+                    fixed_image_path=fixed_image_path,
+                    registration_dir_path=registration_dir_path,
+                    moving_binary_name=f"{binary_prefix}{getattr(self, f'{binary_type}_name')}",
+                    transformation_matrix_path=transformation_matrix_path,
+                    binary_type=binary_type,
+                    composite=composite,
+                )
+            return
+
+        if composite:
+            transformation_matrix_path = self.transforms
+
+        transformed = {
+            binary_type: os.path.join(
+                registration_dir_path,
+                f"{binary_prefix}{getattr(self, f'{binary_type}_name')}.{self.intermediate_format}",
+            )
+            for binary_type in binary_types
+        }
+        transformed_log = os.path.join(
+            registration_dir_path, f"{binary_prefix}{self.modality_name}_binaries.log"
+        )
+
+        transform_binaries(
+            fixed_image_path=fixed_image_path,
+            moving_image_paths=[
+                getattr(self, f"{binary_type}_path" if composite else f"current_{binary_type}")
+                for binary_type in binary_types
+            ],
+            transformed_image_paths=list(transformed.values()),
+            matrix_path=transformation_matrix_path,
+            log_file_path=transformed_log,
+        )
+        for binary_type, path in transformed.items():
+            setattr(self, f"current_{binary_type}", path)
+
     def extract_brain_region(
         self,
         brain_extractor: BrainExtractor,
@@ -342,10 +495,10 @@ class ModifiedModalitiy:
         """
         bet_log = os.path.join(bet_dir_path, "brain-extraction.log")
         atlas_bet_cm = os.path.join(
-            bet_dir_path, f"atlas_bet_{self.modality_name}.nii.gz"
+            bet_dir_path, f"atlas_bet_{self.modality_name}.{self.intermediate_format}"
         )
         atlas_mask_path = os.path.join(
-            bet_dir_path, f"atlas_bet_{self.modality_name}_mask.nii.gz"
+            bet_dir_path, f"atlas_bet_{self.modality_name}_mask.{self.intermediate_format}"
         )
 
         brain_extractor.extract(
@@ -363,21 +516,45 @@ class ModifiedModalitiy:
         output_path: str,
         normalization=False,
     ) -> None:
-        os.makedirs(output_path.parent, exist_ok=True)
-
         if normalization is False:
-            shutil.copyfile(
-                self.current_image,
-                output_path,
-            )
+            self.save_current_outputs(raw_output_path=output_path)
         elif normalization is True:
-            image = read_nifti(self.current_image)
-            print("current image", self.current_image)
-            normalized_image = self.normalizer.normalize(image=image)
-            write_nifti(
-                input_array=normalized_image,
-                output_nifti_path=output_path,
-                reference_nifti_path=self.current_image,
+            self.save_current_outputs(normalized_output_path=output_path)
+
+    def save_current_outputs(
+        self,
+        raw_output_path: Optional[str] = None,
+        normalized_output_path: Optional[str] = None,
+    ) -> None:
+        """
+        Save the raw and the normalized variant of the current image, decoding it at most once.
+
+        The raw output is linked (or copied) when it has the format of the current image; otherwise it is written
+        from the same decoded array the normalized output is computed from.
+
+        Args:
+            raw_output_path (str, optional): Path of the raw output.
+            normalized_output_path (str, optional): Path of the normalized output.
+        """
+        image = None
+        if raw_output_path is not None:
+            os.makedirs(raw_output_path.parent, exist_ok=True)
+            if nifti_extension(self.current_image) == nifti_extension(raw_output_path):
+                materialize(self.current_image, raw_output_path)
+            else:
+                image = read_array(self.current_image)
+                write_array(
+                    image,
+                    raw_output_path,
+                    reference_path=self.current_image,
+                )
+        if normalized_output_path is not None:
+            os.makedirs(normalized_output_path.parent, exist_ok=True)
+            image = read_array(self.current_image) if image is None else image
+            write_array(
+                self.normalizer.normalize(image=image),
+                normalized_output_path,
+                reference_path=self.current_image,
             )
 
     def save_current_binary(
@@ -396,17 +573,17 @@ class ModifiedModalitiy:
         else:
             raise ValueError
 
-        if normalization is False:
-            shutil.copyfile(
-                current_file,
+        # masks are not normalized, both variants are the current mask itself
+        self._copy_output(current_file, output_path)
+
+    @staticmethod
+    def _copy_output(src: str, output_path: str) -> None:
+        # uncompressed intermediates are compressed when the output is .nii.gz, and vice versa
+        if nifti_extension(src) == nifti_extension(output_path):
+            materialize(src, output_path)
+        else:
+            write_array(
+                read_array(src),
                 output_path,
-            )
-        elif normalization is True:
-            image = read_nifti(current_file)
-            print("current image", current_file)
-            # normalized_image = self.normalizer.normalize(image=image)
-            write_nifti(
-                input_array=image,
-                output_nifti_path=output_path,
-                reference_nifti_path=current_file,
+                reference_path=src,
             )
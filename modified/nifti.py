@@ -0,0 +1,66 @@
+from typing import Optional
+
+import nibabel as nib
+import numpy as np
+import SimpleITK as sitk
+from auxiliary.nifti.io import read_nifti
+
+
+def read_array(path: str) -> np.ndarray:
+    """
+    Voxel data of a NIfTI file in the axis order of `auxiliary.nifti.io.read_nifti` (z, y, x).
+
+    Uncompressed (.nii) files are memory-mapped read-only instead of decoded into memory: the array is a view of the
+    file, and pages are only read when touched and can be dropped again by the OS under memory pressure. Files with
+    intensity scaling are scaled into a new array. Compressed files are read with `read_nifti`.
+
+    Args:
+        path (str): Path to the NIfTI file.
+
+    Returns:
+        np.ndarray: The voxel data; read-only if memory-mapped.
+    """
+    if not str(path).endswith(".nii"):
+        return read_nifti(str(path))
+    image = nib.load(str(path), mmap="r")
+    # nibabel indexes x, y, z like the file, SimpleITK z, y, x; the transpose is a view
+    return np.asanyarray(image.dataobj).T
+
+
+def write_array(array: np.ndarray, output_path: str, reference_path: Optional[str] = None) -> None:
+    """
+    Write voxel data in the axis order of `read_array` as a NIfTI file, like `auxiliary.nifti.io.write_nifti`.
+
+    Only the header of the reference is read for the origin, spacing and direction, not its voxel data.
+
+    Args:
+        array (np.ndarray): The voxel data; boolean arrays are written as uint8.
+        output_path (str): Path to the NIfTI file (output).
+        reference_path (str, optional): Path to a NIfTI file with the same grid.
+    """
+    if array.dtype == bool:
+        array = array.astype(np.uint8)
+    image = sitk.GetImageFromArray(np.ascontiguousarray(array))
+    if reference_path is not None:
+        reader = sitk.ImageFileReader()
+        reader.SetFileName(str(reference_path))
+        reader.ReadImageInformation()
+        image.SetOrigin(reader.GetOrigin())
+        image.SetSpacing(reader.GetSpacing())
+        image.SetDirection(reader.GetDirection())
+    sitk.WriteImage(image, str(output_path))
+
+
+def apply_mask(input_path: str, mask_path: str, output_path: str) -> None:
+    """
+    Multiply an image with a brain mask, like `BrainExtractor.apply_mask`, reading both through `read_array`.
+
+    Args:
+        input_path (str): Path to the image.
+        mask_path (str): Path to the mask on the grid of the image.
+        output_path (str): Path to the masked image (output).
+    """
+    image, mask = read_array(input_path), read_array(mask_path)
+    if image.shape != mask.shape:
+        raise ValueError("Input image and mask must have the same dimensions.")
+    write_array(image * mask, output_path, reference_path=input_path)
@@ -0,0 +1,113 @@
+import os
+import threading
+from typing import Dict, List, Optional
+
+
+class Prefetcher:
+    """
+    Reads the input files of upcoming patients in a background thread, so that they are in the page cache of the
+    node when the patient starts instead of being fetched from (network) storage on the critical path.
+
+    The files are read, not decoded: decoding happens in the worker process that preprocesses the patient, and an
+    array decoded here could not be handed to it without a copy. `schedule` is called with the patients that come
+    next, in order, whenever the batch advances. At most `depth` of them are read ahead, and only while the files
+    read for patients that have not started yet stay within `max_bytes`.
+
+    Args:
+        depth (int, optional): Number of upcoming patients to read ahead.
+        max_bytes (int, optional): Cap on the bytes read ahead for patients that have not started yet.
+        chunk_size (int, optional): Bytes per read call.
+
+    Example:
+        >>> prefetcher = Prefetcher(depth=2)
+        >>> for index, input_dir in enumerate(input_dirs):
+        ...     prefetcher.schedule({exam: files_of(exam) for exam in input_dirs[index + 1 :]})
+        ...     process(input_dir)
+        >>> prefetcher.close()
+    """
+
+    def __init__(self, depth: int = 1, max_bytes: int = 2 << 30, chunk_size: int = 8 << 20) -> None:
+        self.depth = depth
+        self.max_bytes = max_bytes
+        self.chunk_size = chunk_size
+        self.bytes_read = 0
+        self._upcoming: Dict[str, List[str]] = {}
+        # bytes read ahead per patient that has not started yet
+        self._prefetched: Dict[str, int] = {}
+        self._closed = False
+        self._condition = threading.Condition()
+        self._thread = threading.Thread(target=self._run, name="prefetcher", daemon=True)
+        self._thread.start()
+
+    def schedule(self, upcoming: Dict[str, List[str]]) -> None:
+        """
+        Set the patients that come next.
+
+        Args:
+            upcoming (Dict[str, List[str]]): Input files per upcoming patient, in processing order; only the first
+                `depth` are used. Patients that are no longer upcoming have started, and their files no longer
+                count against `max_bytes`.
+        """
+        with self._condition:
+            self._upcoming = dict(list(upcoming.items())[: self.depth])
+            self._prefetched = {key: size for key, size in self._prefetched.items() if key in self._upcoming}
+            self._condition.notify_all()
+
+    def close(self) -> None:
+        """Stop reading ahead."""
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+        self._thread.join()
+
+    def __enter__(self) -> "Prefetcher":
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+    def _next(self) -> Optional[str]:
+        """The first upcoming patient that is not read yet and fits into the cap, or None."""
+        held = sum(self._prefetched.values())
+        for key, paths in self._upcoming.items():
+            if key in self._prefetched:
+                continue
+            if held > 0 and held + _size(paths) > self.max_bytes:
+                return None
+            return key
+        return None
+
+    def _run(self) -> None:
+        while True:
+            with self._condition:
+                while not self._closed and (key := self._next()) is None:
+                    self._condition.wait()
+                if self._closed:
+                    return
+                paths = self._upcoming[key]
+                # reserved before reading, so the patient is not picked twice
+                self._prefetched[key] = _size(paths)
+            for path in paths:
+                self._read(path)
+
+    def _read(self, path: str) -> None:
+        try:
+            with open(path, "rb", buffering=0) as f:
+                while not self._closed:
+                    chunk = f.read(self.chunk_size)
+                    if not chunk:
+                        break
+                    self.bytes_read += len(chunk)
+        except OSError:
+            # the patient reports missing or unreadable inputs itself
+            pass
+
+
+def _size(paths: List[str]) -> int:
+    size = 0
+    for path in paths:
+        try:
+            size += os.path.getsize(path)
+        except OSError:
+            pass
+    return size
@@ -1,4 +1,8 @@
-from functools import wraps
+from __future__ import annotations
+
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import copy
+from functools import lru_cache, partial, wraps
 import logging
 import os
 from pathlib import Path
@@ -7,15 +11,26 @@ import signal
 import subprocess
 import sys
 import tempfile
+import time
 import traceback
 from datetime import datetime
-from typing import List, Optional
+from multiprocessing import get_context
+from typing import Any, Callable, Dict, Iterable, List, Optional, TYPE_CHECKING
 
 from auxiliary.turbopath import turbopath
 
-from brainles_preprocessing.brain_extraction.brain_extractor import BrainExtractor
-from modified.modality import ModifiedModalitiy
-from brainles_preprocessing.registration.registrator import Registrator
+from modified.atlas import prepare_atlas
+from modified.manifest import StageManifest, file_digest
+from modified.materialize import materialize, materialize_tree
+from modified.modality import INTERMEDIATE_FORMATS, ModifiedModalitiy, nifti_extension
+from modified.task_graph import TaskGraph
+from modified.tracing import Tracer, counter_deltas, resource_counters
+from modified.writer import WriteBatch
+
+if TYPE_CHECKING:
+    # the brainles_preprocessing packages import HD-BET (torch) and every registration backend
+    from brainles_preprocessing.brain_extraction.brain_extractor import BrainExtractor
+    from brainles_preprocessing.registration.registrator import Registrator
 
 logger = logging.getLogger(__name__)
 
@@ -33,6 +48,23 @@ class ModifiedPreprocessor:
         temp_folder (str, optional): Path to a temporary folder for storing intermediate results.
         use_gpu (Optional[bool]): Use GPU for processing if True, CPU if False, or automatically detect if None.
         limit_cuda_visible_devices (Optional[str]): Limit CUDA visible devices to a specific GPU ID.
+        max_workers (int, optional): Number of pipeline tasks run concurrently. 1 (default) runs them one after
+            the other; larger values run registrations and transformations in a process pool of that size.
+        composite_transforms (bool, optional): Compose the transforms of all stages and resample every image, ROI
+            and biopsy once from its input file instead of resampling the previous stage's result.
+        atlas_cache_dir (str, optional): Directory of the prepared float32 atlas shared by all patients
+            (default is a folder in the system temp directory).
+        registration_profiles (Dict[str, str], optional): Registration profile per stage ("coregistration",
+            "atlas-registration", "atlas-correction"), e.g. {"coregistration": "fast"}. Stages without a profile
+            use the registrator's parameters.
+        intermediate_format (str, optional): File format of the intermediate files, "nii.gz" (default) or "nii".
+            Uncompressed intermediates are not gzipped by one step and decompressed by the next; the outputs of
+            the modalities are written in the format of their output paths either way.
+        biopsy_mode (str, optional): "volume" (default) resamples and thresholds biopsy masks like ROIs, "points"
+            transforms the coordinates of the marked voxels and rasterizes them on the target grid.
+        defer_writes (bool, optional): Collect the output and stage saves of `run` in `pending_writes` instead of
+            writing them, for a `WriterPool` to write while the next patient is computed. The temp folder is
+            removed by the batch after the writes.
 
     """
 
@@ -47,6 +79,13 @@ class ModifiedPreprocessor:
         temp_folder: Optional[str] = None,
         use_gpu: Optional[bool] = None,
         limit_cuda_visible_devices: Optional[str] = None,
+        max_workers: int = 1,
+        composite_transforms: bool = False,
+        atlas_cache_dir: Optional[str] = None,
+        registration_profiles: Optional[Dict[str, str]] = None,
+        intermediate_format: str = "nii.gz",
+        biopsy_mode: str = "volume",
+        defer_writes: bool = False,
     ):
         self._setup_logger()
 
@@ -72,6 +111,35 @@ class ModifiedPreprocessor:
         self.atlas_dir = os.path.join(self.temp_folder, "atlas-space")
         os.makedirs(self.atlas_dir, exist_ok=True)
 
+        # (temporary directory, save directory) pairs of the stages saved so far
+        self._saved_dirs = []
+
+        self.max_workers = max_workers
+        self._process_pool = None
+
+        self.composite_transforms = composite_transforms
+        self.atlas_cache_dir = atlas_cache_dir
+        self.registration_profiles = registration_profiles or {}
+
+        if intermediate_format not in INTERMEDIATE_FORMATS:
+            raise ValueError(
+                f"Unknown intermediate format: {intermediate_format}. Expected one of: {', '.join(INTERMEDIATE_FORMATS)}"
+            )
+        self.intermediate_format = intermediate_format
+        for modality in self.all_modalities:
+            modality.intermediate_format = intermediate_format
+
+        if biopsy_mode not in ("volume", "points"):
+            raise ValueError(f"Unknown biopsy mode: {biopsy_mode}. Expected one of: volume, points")
+        self.biopsy_mode = biopsy_mode
+
+        # spans of every stage and task of the last run
+        self.tracer = Tracer()
+
+        self.defer_writes = defer_writes
+        # writes of the last run, with defer_writes
+        self.pending_writes: Optional[WriteBatch] = None
+
     def _configure_gpu(
         self, use_gpu: Optional[bool], limit_cuda_visible_devices: Optional[str] = None
     ):
@@ -87,9 +155,10 @@ class ModifiedPreprocessor:
                 os.environ["CUDA_VISIBLE_DEVICES"] = limit_cuda_visible_devices
 
     @staticmethod
+    @lru_cache(maxsize=None)
     def _cuda_is_available():
         """
-        Checks if CUDA is available on the system by attempting to run 'nvidia-smi'.
+        Checks if CUDA is available on the system by attempting to run 'nvidia-smi', once per process.
 
         Returns:
             bool: True if 'nvidia-smi' can be executed successfully, indicating CUDA is available.
@@ -192,6 +261,8 @@ class ModifiedPreprocessor:
         save_dir_atlas_correction: Optional[str] = None,
         save_dir_brain_extraction: Optional[str] = None,
         log_file: Optional[str] = None,
+        resume: bool = False,
+        trace_file: Optional[str] = None,
     ):
         """
         Execute the preprocessing pipeline, encompassing coregistration, atlas-based registration,
@@ -203,15 +274,26 @@ class ModifiedPreprocessor:
             save_dir_atlas_correction (str, optional): Directory path to save atlas correction results.
             save_dir_brain_extraction (str, optional): Directory path to save brain extraction results.
             log_file (str, optional): Path to save the log file. Defaults to a timestamped file in the current directory.
+            resume (bool, optional): Skip stages whose manifest in the save directory shows unchanged inputs and
+                parameters and whose outputs still exist.
+            trace_file (str, optional): Write the spans of every stage and task (wall time, CPU time, bytes read
+                and written, RSS delta) to this file in the Chrome trace format.
 
-        This method orchestrates the entire preprocessing workflow by sequentially performing:
+        This method orchestrates the entire preprocessing workflow by performing:
 
         1. Coregistration: Aligning moving modalities to the central modality.
         2. Atlas Registration: Aligning the central modality to a predefined atlas.
         3. Atlas Correction: Applying additional correction in atlas space if specified.
         4. Brain Extraction: Optionally extracting brain regions using specified masks.
 
+        The steps are expressed as a task graph per modality (register, transform, transform_binaries, extract,
+        apply_mask, save). With `max_workers > 1`, tasks that do not depend on each other run concurrently,
+        e.g. the moving modalities are coregistered in parallel and brain extraction of the center modality
+        overlaps with the atlas correction of the moving modalities.
+
         Results are saved in the specified directories, allowing for modular and configurable output storage.
+        Every stage with a save directory also writes a `manifest.json` there, which is what `resume` checks.
+        With `defer_writes`, the images are prepared in the temp folder and the writes are left in `pending_writes`.
         """
         self._set_log_file(log_file=log_file)
         logger.info(f"{' Starting preprocessing ':=^80}")
@@ -220,390 +302,840 @@ class ModifiedPreprocessor:
             f"Received center modality: {self.center_modality.modality_name} and moving modalities: "
             f"{', '.join([modality.modality_name for modality in self.moving_modalities])}"
         )
-        logger.info(f"{' Starting Coregistration ':-^80}")
-
-        # Step 1. Coregistration ---------------------------------------------------------------------------------------
-        # Coregister moving modalities to center modality
-        coregistration_dir = os.path.join(self.temp_folder, "coregistration")
-        os.makedirs(coregistration_dir, exist_ok=True)
-        logger.info(
-            f"Coregistering {len(self.moving_modalities)} moving modalities to center modality..."
-        )
-        for moving_modality in self.moving_modalities:
-            file_name = f"co__{self.center_modality.modality_name}__{moving_modality.modality_name}"
-            logger.info(
-                f"Registering modality {moving_modality.modality_name} (file={file_name}) to center modality..."
-            )
-
-            transformation_matrix = moving_modality.register(
-                registrator=self.registrator,
-                fixed_image_path=self.center_modality.current_image,
-                registration_dir=coregistration_dir,
-                moving_image_name=file_name,
+        self._saved_dirs = []
+        self._stage_tasks = {}
+        self.tracer.clear()
+        # spans are only measured for a trace file
+        self.tracer.enabled = trace_file is not None
+        self.pending_writes = WriteBatch() if self.defer_writes else None
+
+        stages = [
+            (
+                "coregistration",
+                os.path.join(self.temp_folder, "coregistration"),
+                save_dir_coregistration,
+                self._add_coregistration_tasks,
+                {},
+            ),
+            (
+                "atlas-registration",
+                self.atlas_dir,
+                save_dir_atlas_registration,
+                self._add_atlas_registration_tasks,
+                {"atlas": self.atlas_image_path},
+            ),
+            (
+                "atlas-correction",
+                os.path.join(self.temp_folder, "atlas-correction"),
+                save_dir_atlas_correction,
+                self._add_atlas_correction_tasks,
+                {},
+            ),
+        ]
+        brain_extraction = any(modality.bet for modality in self.all_modalities)
+        if brain_extraction:
+            stages.append(
+                (
+                    "brain-extraction",
+                    os.path.join(self.temp_folder, "brain-extraction"),
+                    save_dir_brain_extraction,
+                    self._add_brain_extraction_tasks,
+                    {},
+                )
             )
+        else:
+            logger.info("Skipping optional brain extraction.")
 
-            # moving ROI
-            if moving_modality.roi_name is not None:
-                moving_binary_name = f"co__{self.center_modality.modality_name}__{moving_modality.roi_name}"
-                logger.info(
-                    f"Transforming ROI {moving_modality.roi_name} (file={moving_modality.roi_name}) to co-registered space..."
-                )
-                moving_modality.transform_binary(
-                    registrator=self.registrator,
-                    fixed_image_path=moving_modality.current_image,
-                    registration_dir_path=coregistration_dir,
-                    moving_binary_name=moving_binary_name,
-                    transformation_matrix_path=transformation_matrix,
-                    binary_type='roi'
-                )
+        graph = TaskGraph()
+        self._last_task = {modality.modality_name: None for modality in self.all_modalities}
+        self._states = {"input": self._snapshot()}
+        self._transforms = {}
+        previous, reusing = "input", resume
+        for stage, stage_dir, save_dir, add_tasks, extra_inputs in stages:
+            os.makedirs(stage_dir, exist_ok=True)
+            # only a prefix of stages can be reused, everything after a recomputed stage is recomputed too
+            reusing = reusing and self._reuse_stage(stage, previous, save_dir, extra_inputs)
+            if not reusing:
+                logger.info(f"{' Scheduling ' + stage + ' ':-^80}")
+                add_tasks(graph, stage, previous, stage_dir)
+                self._add_stage_end(graph, stage, previous, stage_dir, save_dir, extra_inputs)
+            if stage == "atlas-correction":
+                # images that are not skullstripped
+                self._add_output_tasks(graph, skullstripped=False)
+            previous = stage
+        # images that are skullstripped
+        self._add_output_tasks(graph, skullstripped=True)
 
-            # moving biopsy
-            if moving_modality.biopsy_name is not None:
-                moving_binary_name = f"co__{self.center_modality.modality_name}__{moving_modality.biopsy_name}"
-                logger.info(
-                    f"Transforming biopsy {moving_modality.biopsy_name} (file={moving_modality.biopsy_name}) to co-registered space..."
-                )
-                moving_modality.transform_binary(
-                    registrator=self.registrator,
-                    fixed_image_path=moving_modality.current_image,
-                    registration_dir_path=coregistration_dir,
-                    moving_binary_name=moving_binary_name,
-                    transformation_matrix_path=transformation_matrix,
-                    binary_type='biopsy'
-                )
+        try:
+            with self.tracer.span("run", category="run"):
+                if self.max_workers > 1:
+                    with ThreadPoolExecutor(self.max_workers + 1) as threads, ProcessPoolExecutor(
+                        self.max_workers, mp_context=get_context("spawn")
+                    ) as processes:
+                        self._process_pool = processes
+                        graph.run(threads)
+                else:
+                    graph.run()
+        except BaseException:
+            if self.pending_writes is not None:
+                # the stages that completed are saved as they would be without deferral, so resume can reuse them
+                error = self.pending_writes.run(cleanup=False)
+                if error is not None:
+                    logger.error(f"Saving the completed stages failed:\n{error}")
+                self.pending_writes = None
+            raise
+        finally:
+            self._process_pool = None
+            # intermediates the registrator still holds in memory belong to the temp folder
+            discard = getattr(self.registrator, "discard", None)
+            if discard is not None:
+                discard()
+            if trace_file is not None:
+                self.tracer.write(trace_file, process_name=self.center_modality.image_path.parent.name)
+
+        cache_info = getattr(self.registrator, "cache_info", None)
+        if cache_info is not None:
+            logger.info(f"Fixed image cache: {cache_info()}")
+        logger.info(f"{' Preprocessing complete ':=^80}")
+        if self.pending_writes is not None:
+            # the deferred writes read the temp folder
+            self.pending_writes.cleanup.append(partial(shutil.rmtree, str(self.temp_folder), ignore_errors=True))
+        else:
+            shutil.rmtree(self.temp_folder, ignore_errors=True)
 
-        # center_modality remains as-is
-        # image
-        shutil.copyfile(
-            src=self.center_modality.image_path,
-            dst=os.path.join(
-                coregistration_dir,
-                f"atlas__{self.center_modality.modality_name}.nii.gz",
-            ),
-        )
-        # roi
-        if self.center_modality.roi_name is not None:
-            shutil.copyfile(
-                src=self.center_modality.roi_path,
-                dst=os.path.join(
+    def _add_coregistration_tasks(
+        self, graph: TaskGraph, stage: str, previous: str, coregistration_dir: str
+    ) -> None:
+        """Coregister moving modalities (and their ROI / biopsy) to the center modality."""
+        center_name = self.center_modality.modality_name
+        for moving_modality in self.moving_modalities:
+            file_name = f"co__{center_name}__{moving_modality.modality_name}"
+            register = self._add_step(
+                graph,
+                stage,
+                moving_modality,
+                "register",
+                partial(
+                    self._register,
+                    stage,
+                    moving_modality,
+                    lambda: self._states[previous][center_name]["image"],
                     coregistration_dir,
-                    f"atlas__{self.center_modality.roi_name}.nii.gz",
+                    file_name,
+                    f"Registering modality {moving_modality.modality_name} (file={file_name}) to center modality...",
                 ),
             )
-        # biopsy
-        if self.center_modality.biopsy_name is not None:
-            shutil.copyfile(
-                src=self.center_modality.biopsy_path,
-                dst=os.path.join(
-                    coregistration_dir,
-                    f"atlas__{self.center_modality.biopsy_name}.nii.gz",
-                ),
+            self._add_binary_steps(
+                graph,
+                stage,
+                moving_modality,
+                register,
+                coregistration_dir,
+                prefix=f"co__{center_name}__",
+                space="co-registered space",
             )
 
-        # from temporary folder to coregistration folder under the data dir
-        self._save_output(
-            src=coregistration_dir,
-            save_dir=save_dir_coregistration,
-        )
-        logger.info(
-            f"Coregistration complete. Output saved to {save_dir_coregistration}"
+        # center_modality remains as-is
+        self._add_step(
+            graph,
+            stage,
+            self.center_modality,
+            "copy",
+            partial(self._copy_center, coregistration_dir, "atlas__", original=True),
         )
 
-        # Step 2. Atlas Registration -----------------------------------------------------------------------------------
-        # Register center MRI to atlas
-        logger.info(f"{' Starting atlas registration ':-^80}")
-        logger.info(f"Registering center modality to atlas...")
-        center_file_name = f"atlas__{self.center_modality.modality_name}"
-        transformation_matrix = self.center_modality.register(
-            registrator=self.registrator,
-            fixed_image_path=self.atlas_image_path,
-            registration_dir=self.atlas_dir,
-            moving_image_name=center_file_name,
+    def _add_atlas_registration_tasks(
+        self, graph: TaskGraph, stage: str, previous: str, atlas_dir: str
+    ) -> None:
+        """Register the center modality to the atlas and transform everything else with the same matrix."""
+        center_name = self.center_modality.modality_name
+        # registration casts the atlas to float32 for every patient, a prepared copy is cast and decoded once
+        atlas = prepare_atlas(self.atlas_image_path, cache_dir=self.atlas_cache_dir)
+        preload = getattr(self.registrator, "preload", None)
+        if preload is not None:
+            preload(atlas.image_path, atlas.image)
+        register = self._add_step(
+            graph,
+            stage,
+            self.center_modality,
+            "register",
+            partial(
+                self._register,
+                stage,
+                self.center_modality,
+                lambda: atlas.image_path,
+                atlas_dir,
+                f"atlas__{center_name}",
+                "Registering center modality to atlas...",
+            ),
+        )
+        self._add_binary_steps(
+            graph,
+            stage,
+            self.center_modality,
+            register,
+            atlas_dir,
+            prefix="atlas__",
+            space="atlas space",
         )
-        logger.info(f"Atlas registration complete. Output saved to {self.atlas_dir}")
+        center_checkpoint = self._add_checkpoint(graph, stage, self.center_modality)
 
-        # Transform center ROI and biopsy to atlas
-        if self.center_modality.roi_name is not None:
-            moving_binary_name = f"atlas__{self.center_modality.roi_name}"
-            logger.info(
-                f"Transforming ROI {self.center_modality.roi_name} (file={moving_binary_name}) to atlas space..."
+        for moving_modality in self.moving_modalities:
+            file_name = f"atlas__{moving_modality.modality_name}"
+            transform = self._add_step(
+                graph,
+                stage,
+                moving_modality,
+                "transform",
+                partial(
+                    self._transform,
+                    moving_modality,
+                    lambda: self._states[stage][center_name]["image"],
+                    atlas_dir,
+                    file_name,
+                    register,
+                    graph,
+                ),
+                deps=[center_checkpoint],
             )
-            self.center_modality.transform_binary(
-                registrator=self.registrator,
-                fixed_image_path=self.center_modality.current_image,
-                registration_dir_path=self.atlas_dir,
-                moving_binary_name=moving_binary_name,
-                transformation_matrix_path=transformation_matrix,
-                binary_type='roi'
+            self._add_binary_steps(
+                graph,
+                stage,
+                moving_modality,
+                register,
+                atlas_dir,
+                prefix="atlas__",
+                space="atlas space",
+                deps=[transform],
             )
-        if self.center_modality.biopsy_name is not None:
-            moving_binary_name = f"atlas__{self.center_modality.biopsy_name}"
-            logger.info(
-                f"Transforming ROI {self.center_modality.biopsy_name} (file={moving_binary_name}) to atlas space..."
+
+    def _add_atlas_correction_tasks(
+        self, graph: TaskGraph, stage: str, previous: str, atlas_correction_dir: str
+    ) -> None:
+        """Optionally re-register moving modalities to the center modality in atlas space."""
+        center_name = self.center_modality.modality_name
+        for moving_modality in self.moving_modalities:
+            if not moving_modality.atlas_correction:
+                logger.info(
+                    f"Skipping optional atlas correction for modality {moving_modality.modality_name}."
+                )
+                continue
+            file_name = f"atlas_corrected__{center_name}__{moving_modality.modality_name}"
+            register = self._add_step(
+                graph,
+                stage,
+                moving_modality,
+                "register",
+                partial(
+                    self._register,
+                    stage,
+                    moving_modality,
+                    lambda: self._states[previous][center_name]["image"],
+                    atlas_correction_dir,
+                    file_name,
+                    f"Applying optional atlas correction for modality {moving_modality.modality_name}",
+                ),
+                # not part of the graph if the atlas registration was reused
+                deps=[graph.get(f"{previous}/{center_name}/checkpoint")],
             )
-            self.center_modality.transform_binary(
-                registrator=self.registrator,
-                fixed_image_path=self.center_modality.current_image,
-                registration_dir_path=self.atlas_dir,
-                moving_binary_name=moving_binary_name,
-                transformation_matrix_path=transformation_matrix,
-                binary_type='biopsy'
+            self._add_binary_steps(
+                graph,
+                stage,
+                moving_modality,
+                register,
+                atlas_correction_dir,
+                prefix=f"atlas_corrected__{center_name}__",
+                space="corrected atlas space",
             )
 
-        # Transform moving modalities to atlas
-        logger.info(
-            f"Transforming {len(self.moving_modalities)} moving modalities to atlas space..."
+        # Center MRI atlas correction
+        # Actually, nothing happens. Just for renaming.
+        if self.center_modality.atlas_correction:
+            self._add_step(
+                graph,
+                stage,
+                self.center_modality,
+                "copy",
+                partial(self._copy_center, atlas_correction_dir, "atlas_corrected__", original=False),
+            )
+
+    def _add_brain_extraction_tasks(
+        self, graph: TaskGraph, stage: str, previous: str, bet_dir: str
+    ) -> None:
+        """Extract the brain of the center modality and apply its mask to the moving modalities."""
+        brain_masked_dir = os.path.join(bet_dir, "brain_masked")
+        os.makedirs(brain_masked_dir, exist_ok=True)
+
+        center = self.center_modality
+        extract = self._add_step(
+            graph,
+            stage,
+            center,
+            "extract",
+            partial(self._extract, bet_dir),
+            # the skull outputs are saved from the current image, which the extraction moves on
+            deps=[graph.get(f"outputs/{center.modality_name}/skull")],
         )
         for moving_modality in self.moving_modalities:
-            moving_file_name = f"atlas__{moving_modality.modality_name}"
-            logger.info(
-                f"Transforming modality {moving_modality.modality_name} (file={moving_file_name}) to atlas space..."
+            self._add_step(
+                graph,
+                stage,
+                moving_modality,
+                "apply_mask",
+                partial(self._apply_mask, moving_modality, brain_masked_dir, extract, graph),
+                deps=[extract, graph.get(f"outputs/{moving_modality.modality_name}/skull")],
             )
-            moving_modality.transform(
-                registrator=self.registrator,
-                fixed_image_path=self.center_modality.current_image,
-                registration_dir_path=self.atlas_dir,
-                moving_image_name=moving_file_name,
-                transformation_matrix_path=transformation_matrix,
+
+    def _add_binary_steps(
+        self,
+        graph: TaskGraph,
+        stage: str,
+        modality: ModifiedModalitiy,
+        register: str,
+        stage_dir: str,
+        prefix: str,
+        space: str,
+        deps: List[str] = (),
+    ) -> None:
+        """Add a transform_binaries task warping the ROI and biopsy of a modality together, if present."""
+        if modality.binary_types:
+            self._add_step(
+                graph,
+                stage,
+                modality,
+                "transform_binaries",
+                partial(
+                    self._transform_binaries,
+                    modality,
+                    stage_dir,
+                    prefix,
+                    register,
+                    graph,
+                    space,
+                ),
+                deps=[register, *deps],
+                chain=False,
             )
 
-            if moving_modality.roi_name is not None:
-                moving_binary_name = f"atlas__{moving_modality.roi_name}"
-                logger.info(
-                    f"Transforming ROI {moving_modality.roi_name} (file={moving_binary_name}) to atlas space..."
-                )
-                moving_modality.transform_binary(
-                    registrator=self.registrator,
-                    fixed_image_path=moving_modality.current_image,
-                    registration_dir_path=self.atlas_dir,
-                    moving_binary_name=moving_binary_name,
-                    transformation_matrix_path=transformation_matrix,
-                    binary_type='roi'
-                )
-            if moving_modality.biopsy_name is not None:
-                moving_binary_name = f"atlas__{moving_modality.biopsy_name}"
-                logger.info(
-                    f"Transforming biopsy {moving_modality.biopsy_name} (file={moving_binary_name}) to atlas space..."
-                )
-                moving_modality.transform_binary(
-                    registrator=self.registrator,
-                    fixed_image_path=moving_modality.current_image,
-                    registration_dir_path=self.atlas_dir,
-                    moving_binary_name=moving_binary_name,
-                    transformation_matrix_path=transformation_matrix,
-                    binary_type='biopsy'
-                )
+    def _add_output_tasks(self, graph: TaskGraph, skullstripped: bool) -> None:
+        """Add the tasks that save the user-facing outputs of each modality."""
+        for modality in self.all_modalities:
+            if skullstripped:
+                name, save = "bet", self._save_bet_outputs
+            elif (
+                modality.raw_skull_output_path is not None
+                or modality.normalized_skull_output_path is not None
+            ):
+                name, save = "skull", self._save_skull_outputs
+            else:
+                continue
+            graph.add(
+                f"outputs/{modality.modality_name}/{name}",
+                self._traced(partial(save, modality), f"save_{name}", "outputs", modality=modality.modality_name),
+                deps=[self._last_task[modality.modality_name]],
+            )
 
-        self._save_output(
-            src=self.atlas_dir,
-            save_dir=save_dir_atlas_registration,
+    def _add_step(
+        self,
+        graph: TaskGraph,
+        stage: str,
+        modality: ModifiedModalitiy,
+        step: str,
+        fn: Callable[[], Any],
+        deps: List[str] = (),
+        chain: bool = True,
+    ) -> str:
+        """
+        Add a task for one modality that runs after the previous task of the same modality.
+
+        With `chain=False` the task is not appended to the chain of the modality, i.e. later tasks
+        of the modality do not wait for it (they still wait for the stage checkpoint).
+        """
+        name = graph.add(
+            f"{stage}/{modality.modality_name}/{step}",
+            self._traced(fn, step, stage, modality=modality.modality_name),
+            deps=[self._last_task[modality.modality_name], *deps],
         )
-        logger.info(
-            f"Transformations complete. Output saved to {save_dir_atlas_registration}"
+        self._stage_tasks.setdefault((stage, modality.modality_name), []).append(name)
+        if chain:
+            self._last_task[modality.modality_name] = name
+        return name
+
+    def _add_checkpoint(self, graph: TaskGraph, stage: str, modality: ModifiedModalitiy) -> str:
+        """Record the state of a modality once all of its tasks of a stage are done."""
+        name = graph.add(
+            f"{stage}/{modality.modality_name}/checkpoint",
+            partial(self._checkpoint, stage, modality),
+            deps=[
+                self._last_task[modality.modality_name],
+                *self._stage_tasks.get((stage, modality.modality_name), []),
+            ],
         )
+        self._last_task[modality.modality_name] = name
+        return name
 
-        # Step 3. Atlas Correction -------------------------------------------------------------------------------------
-        logger.info(f"{' Checking optional atlas correction ':-^80}")
-        atlas_correction_dir = os.path.join(self.temp_folder, "atlas-correction")
-        os.makedirs(atlas_correction_dir, exist_ok=True)
+    def _add_stage_end(
+        self,
+        graph: TaskGraph,
+        stage: str,
+        previous: str,
+        stage_dir: str,
+        save_dir: Optional[str],
+        extra_inputs: Dict[str, str],
+    ) -> None:
+        """Checkpoint every modality and save the stage once all of its tasks are done."""
+        checkpoints = [
+            f"{stage}/{modality.modality_name}/checkpoint"
+            if f"{stage}/{modality.modality_name}/checkpoint" in graph
+            else self._add_checkpoint(graph, stage, modality)
+            for modality in self.all_modalities
+        ]
+        if save_dir is not None:
+            # outputs are about to be rewritten, never trust the old manifest again
+            StageManifest(save_dir).invalidate()
+        # stages are saved in order, so the images of the previous stage are written before they are dropped
+        graph.add(
+            f"{stage}/save",
+            self._traced(
+                partial(self._save_stage, stage, previous, stage_dir, save_dir, extra_inputs), "save", stage
+            ),
+            # there is no save task for the input or a reused stage
+            deps=[*checkpoints, graph.get(f"{previous}/save")],
+        )
 
-        for moving_modality in self.moving_modalities:
-            # MRI atlas correction
-            if moving_modality.atlas_correction:
-                logger.info(
-                    f"Applying optional atlas correction for modality {moving_modality.modality_name}"
-                )
-                moving_file_name = f"atlas_corrected__{self.center_modality.modality_name}__{moving_modality.modality_name}"
-                transformation_matrix = moving_modality.register(
-                    registrator=self.registrator,
-                    fixed_image_path=self.center_modality.current_image,
-                    registration_dir=atlas_correction_dir,
-                    moving_image_name=moving_file_name,
-                )
+    # tasks ------------------------------------------------------------------------------------------------------------
 
-                # ROI atlas correction
-                if moving_modality.roi_name is not None:
-                    logger.info(
-                        f"Applying optional atlas correction for modality {moving_modality.roi_name}"
-                    )
-                    moving_binary_name = f"atlas_corrected__{self.center_modality.modality_name}__{moving_modality.roi_name}"
-
-                    moving_modality.transform_binary(
-                        registrator=self.registrator,
-                        fixed_image_path=moving_modality.current_image,
-                        registration_dir_path=atlas_correction_dir,
-                        moving_binary_name=moving_binary_name,
-                        transformation_matrix_path=transformation_matrix,
-                        binary_type='roi'
-                    )
-                if moving_modality.biopsy_name is not None:
-                    logger.info(
-                        f"Applying optional atlas correction for modality {moving_modality.biopsy_name}"
-                    )
-                    moving_binary_name = f"atlas_corrected__{self.center_modality.modality_name}__{moving_modality.biopsy_name}"
-
-                    moving_modality.transform_binary(
-                        registrator=self.registrator,
-                        fixed_image_path=moving_modality.current_image,
-                        registration_dir_path=atlas_correction_dir,
-                        moving_binary_name=moving_binary_name,
-                        transformation_matrix_path=transformation_matrix,
-                        binary_type='biopsy'
-                    )
+    def _register(
+        self,
+        stage: str,
+        modality: ModifiedModalitiy,
+        fixed_image_path: Callable[[], str],
+        registration_dir: str,
+        moving_image_name: str,
+        message: str,
+    ) -> str:
+        logger.info(message)
+        return self._call(
+            modality,
+            "register",
+            registrator=self.registrator,
+            fixed_image_path=fixed_image_path(),
+            registration_dir=registration_dir,
+            moving_image_name=moving_image_name,
+            composite=self.composite_transforms,
+            profile=self.registration_profiles.get(stage),
+        )
 
-            else:
-                logger.info("Skipping optional atlas correction.")
+    def _transform(
+        self,
+        modality: ModifiedModalitiy,
+        fixed_image_path: Callable[[], str],
+        registration_dir_path: str,
+        moving_image_name: str,
+        register: str,
+        graph: TaskGraph,
+    ) -> None:
+        logger.info(
+            f"Transforming modality {modality.modality_name} (file={moving_image_name}) to atlas space..."
+        )
+        self._call(
+            modality,
+            "transform",
+            registrator=self.registrator,
+            fixed_image_path=fixed_image_path(),
+            registration_dir_path=registration_dir_path,
+            moving_image_name=moving_image_name,
+            transformation_matrix_path=graph.results[register],
+            composite=self.composite_transforms,
+        )
 
-        # Center MRI atlas correction
-        # Actually, nothing happens. Just for renaming.
-        if self.center_modality.atlas_correction:
-            shutil.copyfile(
-                src=self.center_modality.current_image,
-                dst=os.path.join(
-                    atlas_correction_dir,
-                    f"atlas_corrected__{self.center_modality.modality_name}.nii.gz",
-                ),
-            )
-            logger.info(
-                f"Atlas correction complete. Output saved to {save_dir_atlas_correction}"
-            )
+    def _transform_binaries(
+        self,
+        modality: ModifiedModalitiy,
+        registration_dir_path: str,
+        binary_prefix: str,
+        register: str,
+        graph: TaskGraph,
+        space: str,
+    ) -> None:
+        logger.info(
+            f"Transforming {' and '.join(modality.binary_types)} of {modality.modality_name} to {space}..."
+        )
+        self._call(
+            modality,
+            "transform_binaries",
+            registrator=self.registrator,
+            fixed_image_path=modality.current_image,
+            registration_dir_path=registration_dir_path,
+            binary_prefix=binary_prefix,
+            transformation_matrix_path=graph.results[register],
+            composite=self.composite_transforms,
+            biopsy_mode=self.biopsy_mode,
+        )
 
-            # Center ROI atlas correction
-            if self.center_modality.roi_name is not None:
-                shutil.copyfile(
-                    src=self.center_modality.current_roi,
-                    dst=os.path.join(
-                        atlas_correction_dir,
-                        f"atlas_corrected__{self.center_modality.roi_name}.nii.gz",
-                    ),
-                )
-                logger.info(
-                    f"Atlas correction for ROI complete. Output saved to {save_dir_atlas_correction}"
-                )
-            if self.center_modality.biopsy_name is not None:
-                shutil.copyfile(
-                    src=self.center_modality.current_biopsy,
-                    dst=os.path.join(
-                        atlas_correction_dir,
-                        f"atlas_corrected__{self.center_modality.biopsy_name}.nii.gz",
-                    ),
-                )
-                logger.info(
-                    f"Atlas correction for biopsy complete. Output saved to {save_dir_atlas_correction}"
-                )
+    def _copy_center(self, stage_dir: str, prefix: str, original: bool) -> None:
+        """Link (or copy) the center image, ROI and biopsy under the stage's naming scheme."""
+        center = self.center_modality
+        sources = [
+            (center.modality_name, center.image_path if original else center.current_image),
+            (center.roi_name, center.roi_path if original else center.current_roi),
+            (center.biopsy_name, center.biopsy_path if original else center.current_biopsy),
+        ]
+        self._materialize(paths=[src for _, src in sources])
+        for name, src in sources:
+            if name is not None:
+                materialize(src, os.path.join(stage_dir, f"{prefix}{name}{nifti_extension(src)}"))
+
+    def _extract(self, bet_dir: str) -> str:
+        logger.info("Extracting brain region for center modality...")
+        self._materialize(paths=[self.center_modality.current_image])
+        return self.center_modality.extract_brain_region(
+            brain_extractor=self.brain_extractor, bet_dir_path=bet_dir
+        )
 
-        self._save_output(
-            src=atlas_correction_dir,
-            save_dir=save_dir_atlas_correction,
+    def _apply_mask(
+        self,
+        modality: ModifiedModalitiy,
+        brain_masked_dir: str,
+        extract: str,
+        graph: TaskGraph,
+    ) -> None:
+        logger.info(f"Applying brain mask to {modality.modality_name}...")
+        self._materialize(paths=[modality.current_image])
+        modality.apply_mask(
+            brain_extractor=self.brain_extractor,
+            brain_masked_dir_path=brain_masked_dir,
+            atlas_mask_path=graph.results[extract],
         )
 
-        # now we save images that are not skullstripped
-        logger.info("Saving non skull-stripped images...")
-        for modality in self.all_modalities:
-            if modality.raw_skull_output_path is not None:
-                modality.save_current_image(
-                    modality.raw_skull_output_path,
-                    normalization=False,
-                )
-            if modality.normalized_skull_output_path is not None:
-                modality.save_current_image(
-                    modality.normalized_skull_output_path,
-                    normalization=True,
-                )
-        # Optional: Brain extraction
-        logger.info(f"{' Checking optional brain extraction ':-^80}")
-        brain_extraction = any(modality.bet for modality in self.all_modalities)
-        # print("brain extraction: ", brain_extraction)
+    def _checkpoint(self, stage: str, modality: ModifiedModalitiy) -> None:
+        self._states.setdefault(stage, {})[modality.modality_name] = self._modality_state(modality)
+        self._transforms.setdefault(stage, {})[modality.modality_name] = list(modality.transforms)
 
-        if brain_extraction:
-            logger.info("Starting brain extraction...")
-            bet_dir = os.path.join(self.temp_folder, "brain-extraction")
-            os.makedirs(bet_dir, exist_ok=True)
-            brain_masked_dir = os.path.join(bet_dir, "brain_masked")
-            os.makedirs(brain_masked_dir, exist_ok=True)
-            logger.info("Extracting brain region for center modality...")
-            atlas_mask = self.center_modality.extract_brain_region(
-                brain_extractor=self.brain_extractor, bet_dir_path=bet_dir
-            )
-            for moving_modality in self.moving_modalities:
-                logger.info(
-                    f"Applying brain mask to {moving_modality.modality_name}..."
-                )
-                moving_modality.apply_mask(
-                    brain_extractor=self.brain_extractor,
-                    brain_masked_dir_path=brain_masked_dir,
-                    atlas_mask_path=atlas_mask,
+    def _save_stage(
+        self,
+        stage: str,
+        previous: str,
+        stage_dir: str,
+        save_dir: Optional[str],
+        extra_inputs: Dict[str, str],
+    ) -> None:
+        """Save the stage results and write the stage manifest, then drop the previous stage from memory."""
+        if save_dir is not None:
+            self._materialize(directory=stage_dir)
+            self._materialize(paths=self._state_paths(self._states[previous]))
+            self._save_output(src=stage_dir, save_dir=save_dir)
+            # copied and hashed from the temp folder, which is not rewritten once the stage is saved
+            self._write(
+                partial(
+                    _write_stage,
+                    src=os.path.abspath(stage_dir),
+                    save_dir=os.path.abspath(save_dir),
+                    input_states=self._states[previous],
+                    extra_inputs=extra_inputs,
+                    parameters=self._stage_parameters(stage),
+                    outputs=self._saved_state(self._states[stage]),
+                    transforms={
+                        modality_name: [self._saved_path(path) for path in transforms]
+                        for modality_name, transforms in self._transforms[stage].items()
+                    },
                 )
-
-            self._save_output(
-                src=bet_dir,
-                save_dir=save_dir_brain_extraction,
             )
             logger.info(
-                f"Brain extraction complete. Output saved to {save_dir_brain_extraction}"
+                f"Stage {stage} complete. Output {'queued for' if self.defer_writes else 'saved to'} {save_dir}"
             )
+        # every task reading the previous stage's images is done once this stage is complete,
+        # except for images this stage passed on unchanged (e.g. ROIs are not skullstripped)
+        discard = getattr(self.registrator, "discard", None)
+        if discard is not None:
+            current = set(self._state_paths(self._states[stage]))
+            discard(paths=[path for path in self._state_paths(self._states[previous]) if path not in current])
+        self._trace_stage(stage)
+
+    def _save_skull_outputs(self, modality: ModifiedModalitiy) -> None:
+        self._materialize(paths=self._modality_state(modality).values())
+        # a copy, as the brain extraction moves the current image of the modality on
+        self._write(partial(_write_skull_outputs, copy.copy(modality)))
+
+    def _save_bet_outputs(self, modality: ModifiedModalitiy) -> None:
+        self._materialize(paths=self._modality_state(modality).values())
+        self._write(partial(_write_bet_outputs, copy.copy(modality)))
+
+    def _write(self, job: Callable[[], None]) -> None:
+        """Run a write, or with `defer_writes` add it to the pending writes."""
+        if self.pending_writes is not None:
+            self.pending_writes.jobs.append(job)
         else:
-            logger.info("Skipping optional brain extraction.")
+            job()
+
+    def _traced(self, fn: Callable[[], Any], name: str, category: str, **args) -> Callable[[], Any]:
+        """Wrap a task so that it runs in a tracing span."""
+
+        def traced():
+            with self.tracer.span(name, category=category, **args):
+                return fn()
+
+        return traced
+
+    def _trace_stage(self, stage: str) -> None:
+        """Add a span for a stage, from the start of its first task to now, with the totals of its tasks."""
+        spans = self.tracer.spans(category=stage)
+        if not spans:
+            return
+        start_us = min(span["ts"] for span in spans)
+        totals = {}
+        for key in ("cpu_s", "read_bytes", "written_bytes"):
+            values = [span["args"].get(key) for span in spans]
+            totals[key] = sum(values) if None not in values else None
+        self.tracer.add_span(stage, "stage", start_us, time.time() - start_us / 1e6, tasks=len(spans), **totals)
+
+    def _call(self, modality: ModifiedModalitiy, method: str, **kwargs) -> Any:
+        """
+        Call a modality method, in the process pool if there is one.
 
-        # now we save images that are skullstripped
-        logger.info("Saving skull-stripped images...")
-        for modality in self.all_modalities:
-            # 1. raw
-            if modality.raw_bet_output_path is not None:
-                # image
-                modality.save_current_image(
-                    modality.raw_bet_output_path,
-                    normalization=False,
-                )
-                # ROI does not need skullstripping and brain extraction
-                if modality.roi_name is not None:
-                    modality.save_current_binary(
-                        modality.raw_bet_output_path_roi,
-                        normalization=False,
-                        binary_type='roi'
-                    )
-                # biopsy
-                if modality.biopsy_name is not None:
-                    modality.save_current_binary(
-                        modality.raw_bet_output_path_biopsy,
-                        normalization=False,
-                        binary_type='biopsy'
-                    )
-
-            # 2. normalized
-            if modality.normalized_bet_output_path is not None:
-                # image
-                modality.save_current_image(
-                    modality.normalized_bet_output_path,
-                    normalization=True,
-                )
-                # ROI does not need skullstripping and brain extraction
-                if modality.roi_name is not None:
-                    modality.save_current_binary(
-                        modality.normalized_bet_output_path_roi,
-                        normalization=True,
-                        binary_type='roi'
-                    )
-                # biopsy
-                if modality.biopsy_name is not None:
-                    modality.save_current_binary(
-                        modality.normalized_bet_output_path_biopsy,
-                        normalization=True,
-                        binary_type='biopsy'
-                    )
+        The backend holds the GIL during registration, so only separate processes let registrations overlap.
+        The worker operates on a copy of the modality; the files it produced are adopted afterwards.
+        Only fields the call changed are adopted, as the masks of a modality are transformed concurrently with its image.
+        """
+        if self._process_pool is None:
+            return getattr(modality, method)(**kwargs)
+
+        # worker processes read from disk
+        self._materialize()
+        before = self._modality_state(modality)
+        transforms = modality.transforms
+        result, after, after_transforms, counters = self._process_pool.submit(
+            _run_modality_method, modality, method, kwargs
+        ).result()
+        # the work happened in the worker process, whose counters replace the idle ones of this process
+        self.tracer.annotate(**counters)
+        for kind, path in after.items():
+            if path != before[kind]:
+                setattr(modality, f"current_{kind}", path)
+        if after_transforms != transforms:
+            modality.transforms = after_transforms
+        return result
+
+    def _materialize(self, paths: Optional[Iterable[str]] = None, directory: Optional[str] = None) -> None:
+        """
+        Make sure images the registrator only holds in memory exist as files.
 
-        logger.info(f"{' Preprocessing complete ':=^80}")
-        shutil.rmtree(self.temp_folder, ignore_errors=True)
+        Needed before anything outside the registrator reads them: copies, brain extraction, output saving,
+        stage saving and digests, and worker processes. Without arguments all held images are written.
+        """
+        flush = getattr(self.registrator, "flush", None)
+        if flush is not None:
+            flush(paths=paths, directory=directory)
+
+    # manifests --------------------------------------------------------------------------------------------------------
+
+    def _reuse_stage(
+        self,
+        stage: str,
+        previous: str,
+        save_dir: Optional[str],
+        extra_inputs: Dict[str, str],
+    ) -> bool:
+        """Restore the saved results of a stage if its manifest is still valid."""
+        if save_dir is None:
+            return False
+        self._materialize(paths=self._state_paths(self._states[previous]))
+        manifest = StageManifest(save_dir)
+        if not manifest.matches(
+            inputs=self._input_digests(self._states[previous], extra_inputs),
+            parameters=self._stage_parameters(stage),
+        ):
+            return False
+        logger.info(f"Inputs and parameters of {stage} unchanged, reusing results in {save_dir}")
+        self._restore_state(manifest.outputs, manifest.transforms)
+        self._states[stage] = self._snapshot()
+        self._transforms[stage] = {
+            modality.modality_name: list(modality.transforms) for modality in self.all_modalities
+        }
+        return True
+
+    @staticmethod
+    def _input_digests(
+        states: Dict[str, Dict[str, Optional[str]]],
+        extra_inputs: Dict[str, str],
+    ) -> Dict[str, str]:
+        """Content digests of every image, ROI and biopsy of a snapshot plus any extra stage inputs."""
+        digests = {label: file_digest(path) for label, path in extra_inputs.items()}
+        for modality_name, state in states.items():
+            for kind, path in state.items():
+                if path is not None:
+                    digests[f"{modality_name}/{kind}"] = file_digest(path)
+        return digests
+
+    def _stage_parameters(self, stage: str) -> dict:
+        """Everything besides the input files that determines the outputs of a stage."""
+        parameters = {"intermediate_format": self.intermediate_format}
+        if stage == "brain-extraction":
+            settings = getattr(self.brain_extractor, "settings", None)
+            parameters["brain_extractor"] = (
+                # also through a manager proxy, whose type differs from the service
+                settings() if settings is not None else {"class": type(self.brain_extractor).__name__}
+            )
+            parameters["bet"] = {modality.modality_name: modality.bet for modality in self.all_modalities}
+            return parameters
+
+        parameters.update(
+            registrator=type(self.registrator).__name__,
+            registrator_parameters={
+                key: value
+                for key, value in vars(self.registrator).items()
+                if not key.startswith("_")
+            },
+            composite_transforms=self.composite_transforms,
+            registration_profile=self.registration_profiles.get(stage),
+            biopsy_mode=self.biopsy_mode,
+        )
+        if stage == "atlas-correction":
+            parameters["atlas_correction"] = {
+                modality.modality_name: modality.atlas_correction for modality in self.all_modalities
+            }
+        return parameters
+
+    @staticmethod
+    def _modality_state(modality: ModifiedModalitiy) -> Dict[str, Optional[str]]:
+        return {
+            "image": modality.current_image,
+            "roi": modality.current_roi,
+            "biopsy": modality.current_biopsy,
+        }
+
+    @staticmethod
+    def _state_paths(states: Dict[str, Dict[str, Optional[str]]]) -> List[str]:
+        return [path for state in states.values() for path in state.values() if path is not None]
+
+    def _snapshot(self) -> Dict[str, Dict[str, Optional[str]]]:
+        return {
+            modality.modality_name: self._modality_state(modality)
+            for modality in self.all_modalities
+        }
+
+    def _saved_state(
+        self, states: Dict[str, Dict[str, Optional[str]]]
+    ) -> Dict[str, Dict[str, Optional[str]]]:
+        """Files of a snapshot, pointing into the save directories instead of the temp folder."""
+        return {
+            modality_name: {
+                kind: self._saved_path(path) if path is not None else None
+                for kind, path in state.items()
+            }
+            for modality_name, state in states.items()
+        }
+
+    def _restore_state(
+        self,
+        outputs: Dict[str, Dict[str, Optional[str]]],
+        transforms: Dict[str, List[str]],
+    ) -> None:
+        for modality in self.all_modalities:
+            modality.transforms = list(transforms.get(modality.modality_name, []))
+            state = outputs[modality.modality_name]
+            modality.current_image = turbopath(state["image"])
+            modality.current_roi = turbopath(state["roi"]) if state["roi"] is not None else None
+            modality.current_biopsy = turbopath(state["biopsy"]) if state["biopsy"] is not None else None
+
+    def _saved_path(self, path: str) -> str:
+        # files in a saved temporary directory are referenced by their copy, which outlives the temp folder
+        path = os.path.abspath(path)
+        for src, save_dir in reversed(self._saved_dirs):
+            if os.path.commonpath([src, path]) == src:
+                return os.path.join(save_dir, os.path.relpath(path, src))
+        return path
 
     def _save_output(
         self,
         src: str,
         save_dir: Optional[str],
     ):
+        """Map the files of a temporary directory to their copies in `save_dir`; `_write_stage` copies them."""
         if save_dir is not None:
-            save_dir = turbopath(save_dir)
-            shutil.copytree(
-                src=src,
-                dst=save_dir,
-                dirs_exist_ok=True,
+            self._saved_dirs.append((os.path.abspath(src), os.path.abspath(save_dir)))
+
+
+def _run_modality_method(modality: ModifiedModalitiy, method: str, kwargs: dict):
+    """
+    Process pool entry point: call a method on a copy of a modality.
+
+    Returns the result, the new file state and transforms of the modality and the resource usage of the call.
+    """
+    before = resource_counters()
+    result = getattr(modality, method)(**kwargs)
+    counters = counter_deltas(before, resource_counters())
+    return result, ModifiedPreprocessor._modality_state(modality), modality.transforms, counters
+
+
+# writes ---------------------------------------------------------------------------------------------------------------
+# module functions, so that the pending writes of a run can be pickled to the writer pool of another process
+
+
+def _write_stage(
+    src: str,
+    save_dir: str,
+    input_states: Dict[str, Dict[str, Optional[str]]],
+    extra_inputs: Dict[str, str],
+    parameters: dict,
+    outputs: Dict[str, Dict[str, Optional[str]]],
+    transforms: Dict[str, List[str]],
+) -> None:
+    """Copy the temporary directory of a stage to its save directory, then write the stage manifest."""
+    # files of the temp folder are not rewritten once their stage is saved, so they can be linked
+    methods = materialize_tree(src=src, dst=turbopath(save_dir))
+    logger.debug(f"Saved {src} to {save_dir}: {methods}")
+    StageManifest(save_dir).write(
+        inputs=ModifiedPreprocessor._input_digests(input_states, extra_inputs),
+        parameters=parameters,
+        outputs=outputs,
+        transforms=transforms,
+    )
+
+
+def _write_skull_outputs(modality: ModifiedModalitiy) -> None:
+    modality.save_current_outputs(
+        raw_output_path=modality.raw_skull_output_path,
+        normalized_output_path=modality.normalized_skull_output_path,
+    )
+
+
+def _write_bet_outputs(modality: ModifiedModalitiy) -> None:
+    # image, raw and normalized from one decode
+    modality.save_current_outputs(
+        raw_output_path=modality.raw_bet_output_path,
+        normalized_output_path=modality.normalized_bet_output_path,
+    )
+    # 1. raw
+    if modality.raw_bet_output_path is not None:
+        # ROI does not need skullstripping and brain extraction
+        if modality.roi_name is not None:
+            modality.save_current_binary(
+                modality.raw_bet_output_path_roi,
+                normalization=False,
+                binary_type='roi'
+            )
+        # biopsy
+        if modality.biopsy_name is not None:
+            modality.save_current_binary(
+                modality.raw_bet_output_path_biopsy,
+                normalization=False,
+                binary_type='biopsy'
+            )
+
+    # 2. normalized
+    if modality.normalized_bet_output_path is not None:
+        # ROI does not need skullstripping and brain extraction
+        if modality.roi_name is not None:
+            modality.save_current_binary(
+                modality.normalized_bet_output_path_roi,
+                normalization=True,
+                binary_type='roi'
+            )
+        # biopsy
+        if modality.biopsy_name is not None:
+            modality.save_current_binary(
+                modality.normalized_bet_output_path_biopsy,
+                normalization=True,
+                binary_type='biopsy'
             )
@@ -0,0 +1,42 @@
+from typing import Dict
+
+# named speed/accuracy trade-offs of the rigid registration (multi-resolution schedule and metric sampling);
+# "accurate" spells out the antspyx defaults, run `python -m benchmarks.registration_profiles` for runtime and error;
+# kept out of modified/ANTs.py so that the command line can list them without importing ANTs
+REGISTRATION_PROFILES: Dict[str, dict] = {
+    "fast": {
+        "aff_iterations": (1000, 500, 100),
+        "aff_shrink_factors": (8, 4, 2),
+        "aff_smoothing_sigmas": (3, 2, 1),
+        "aff_random_sampling_rate": 0.05,
+    },
+    "balanced": {
+        "aff_iterations": (1000, 500, 250, 10),
+        "aff_shrink_factors": (6, 4, 2, 1),
+        "aff_smoothing_sigmas": (3, 2, 1, 0),
+        "aff_random_sampling_rate": 0.1,
+    },
+    "accurate": {
+        "aff_iterations": (2100, 1200, 1200, 10),
+        "aff_shrink_factors": (6, 4, 2, 1),
+        "aff_smoothing_sigmas": (3, 2, 1, 0),
+        "aff_random_sampling_rate": 0.2,
+    },
+}
+
+
+def registration_profile(profile: str) -> dict:
+    """
+    Get the registration parameters of a named profile.
+
+    Args:
+        profile (str): One of `REGISTRATION_PROFILES`, e.g. "fast", "balanced" or "accurate".
+
+    Returns:
+        dict: Parameters for `ants.registration`.
+    """
+    if profile not in REGISTRATION_PROFILES:
+        raise ValueError(
+            f"Unknown registration profile: {profile}. Expected one of: {', '.join(REGISTRATION_PROFILES)}"
+        )
+    return dict(REGISTRATION_PROFILES[profile])
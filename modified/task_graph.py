@@ -0,0 +1,97 @@
+from concurrent.futures import FIRST_COMPLETED, Executor, Future, wait
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+
+class TaskGraph:
+    """
+    Dependency graph of pipeline tasks.
+
+    Tasks are added in a valid execution order (dependencies first). Without an executor they run
+    one after the other in that order; with an executor every task is submitted as soon as all of its
+    dependencies are done, so independent tasks overlap.
+
+    Example:
+        >>> graph = TaskGraph()
+        >>> graph.add("register", register_t2)
+        >>> graph.add("transform_roi", transform_t2_roi, deps=["register"])
+        >>> with ThreadPoolExecutor(4) as executor:
+        ...     graph.run(executor)
+    """
+
+    def __init__(self) -> None:
+        self._tasks: Dict[str, Tuple[Callable[[], Any], List[str]]] = {}
+        self.results: Dict[str, Any] = {}
+
+    def __contains__(self, name: str) -> bool:
+        return name in self._tasks
+
+    def get(self, name: str) -> Optional[str]:
+        """The name if the task is part of the graph, else None, e.g. for a dependency on an optional task."""
+        return name if name in self._tasks else None
+
+    def add(
+        self,
+        name: str,
+        fn: Callable[[], Any],
+        deps: Iterable[Optional[str]] = (),
+    ) -> str:
+        """
+        Add a task.
+
+        Args:
+            name (str): Unique task name.
+            fn (Callable[[], Any]): Task body; its return value is stored in `results`.
+            deps (Iterable[Optional[str]]): Names of tasks that must finish first. None entries (e.g. for
+                tasks of a skipped stage) are ignored.
+
+        Returns:
+            str: The task name.
+
+        Raises:
+            ValueError: If the name is taken or a dependency is not part of the graph.
+        """
+        if name in self._tasks:
+            raise ValueError(f"Task {name} already exists")
+        deps = [dep for dep in deps if dep is not None]
+        unknown = [dep for dep in deps if dep not in self._tasks]
+        if unknown:
+            raise ValueError(f"Task {name} depends on unknown tasks: {', '.join(unknown)}")
+        self._tasks[name] = (fn, deps)
+        return name
+
+    def run(self, executor: Optional[Executor] = None) -> Dict[str, Any]:
+        """
+        Execute all tasks.
+
+        Args:
+            executor (Executor, optional): Executor to run ready tasks concurrently.
+
+        Returns:
+            Dict[str, Any]: Result of every task by name.
+
+        Raises:
+            Exception: The first exception raised by a task, after all running tasks have finished.
+        """
+        if executor is None:
+            for name, (fn, _) in self._tasks.items():
+                self.results[name] = fn()
+            return self.results
+
+        pending = dict(self._tasks)
+        running: Dict[Future, str] = {}
+        while pending or running:
+            for name, (fn, deps) in list(pending.items()):
+                if all(dep in self.results for dep in deps):
+                    running[executor.submit(fn)] = name
+                    del pending[name]
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                error = future.exception()
+                if error is not None:
+                    # let tasks that are already running finish before the caller cleans up after them
+                    wait(running)
+                    raise error
+                self.results[name] = future.result()
+        return self.results
@@ -0,0 +1,144 @@
+import os
+import queue
+import sys
+from typing import List, Optional
+
+# read by ITK (and so by ANTs) when its first multi-threaded filter runs, so it must be set before
+ITK_THREADS_ENV = "ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS"
+
+
+def available_cpus() -> List[int]:
+    """CPUs this process may run on."""
+    if hasattr(os, "sched_getaffinity"):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+
+class ThreadBudget:
+    """
+    Split of the CPUs of a node between parallel patient workers.
+
+    ANTs/ITK and torch each start one thread per core by default, so several workers running side by side
+    oversubscribe the node. A budget gives every worker process `itk_threads` ITK threads (shared by the task
+    processes of its patient, see `ModifiedPreprocessor.max_workers`), the torch CPU backend of HD-BET
+    `torch_threads` threads, and optionally pins every worker to its own set of CPUs.
+
+    Args:
+        workers (int): Number of patients processed in parallel.
+        itk_threads (int): ITK threads per worker process.
+        torch_threads (int, optional): Threads of the torch CPU backend. Defaults to the torch default.
+        cpu_sets (List[List[int]], optional): CPUs per worker, for pinning.
+
+    Example:
+        >>> budget = ThreadBudget.split(workers=4, task_workers=1, affinity=True)
+        >>> budget.apply(budget.cpu_sets[0])  # in the first worker process
+    """
+
+    def __init__(
+        self,
+        workers: int,
+        itk_threads: int,
+        torch_threads: Optional[int] = None,
+        cpu_sets: Optional[List[List[int]]] = None,
+    ) -> None:
+        self.workers = workers
+        self.itk_threads = itk_threads
+        self.torch_threads = torch_threads
+        self.cpu_sets = cpu_sets
+
+    def __repr__(self) -> str:
+        return (
+            f"ThreadBudget(workers={self.workers}, itk_threads={self.itk_threads}, "
+            f"torch_threads={self.torch_threads}, pinned={self.cpu_sets is not None})"
+        )
+
+    @classmethod
+    def split(
+        cls,
+        workers: int,
+        task_workers: int = 1,
+        cpus: Optional[List[int]] = None,
+        affinity: bool = False,
+        torch_threads: Optional[int] = None,
+    ) -> "ThreadBudget":
+        """
+        Split the CPUs evenly between the workers and the concurrent tasks of each worker.
+
+        Args:
+            workers (int): Number of patients processed in parallel.
+            task_workers (int, optional): Concurrent registration tasks within one patient.
+            cpus (List[int], optional): CPUs to split. Defaults to `available_cpus()`.
+            affinity (bool, optional): Pin every worker to its share of the CPUs.
+            torch_threads (int, optional): Threads of the torch CPU backend. Defaults to the share of one worker,
+                since the brain extractor serves one batch at a time.
+
+        Returns:
+            ThreadBudget: The budget.
+        """
+        cpus = available_cpus() if cpus is None else cpus
+        workers = max(1, workers)
+        share = max(1, len(cpus) // workers)
+        cpu_sets = None
+        if affinity:
+            # with more workers than CPUs, workers share CPUs round robin
+            cpu_sets = [
+                cpus[(index * share) % len(cpus) : (index * share) % len(cpus) + share] for index in range(workers)
+            ]
+        return cls(
+            workers=workers,
+            itk_threads=max(1, share // max(1, task_workers)),
+            torch_threads=torch_threads if torch_threads is not None else share,
+            cpu_sets=cpu_sets,
+        )
+
+    @classmethod
+    def candidates(
+        cls,
+        max_workers: int,
+        task_workers: int = 1,
+        cpus: Optional[List[int]] = None,
+        affinity: bool = False,
+        torch_threads: Optional[int] = None,
+    ) -> List["ThreadBudget"]:
+        """Budgets with 1, 2, 4, ... up to `max_workers` workers, each splitting all CPUs, to choose from by benchmark."""
+        budgets, workers = [], 1
+        while workers < max_workers:
+            budgets.append(cls.split(workers, task_workers, cpus, affinity, torch_threads))
+            workers *= 2
+        budgets.append(cls.split(max_workers, task_workers, cpus, affinity, torch_threads))
+        return budgets
+
+    def apply(self, cpus: Optional[List[int]] = None) -> None:
+        """
+        Configure the calling process as a worker of this budget.
+
+        Has to run before the first ITK filter of the process; child processes (e.g. task workers) inherit it.
+
+        Args:
+            cpus (List[int], optional): CPUs to pin the process to.
+        """
+        os.environ[ITK_THREADS_ENV] = str(self.itk_threads)
+        # read by OpenMP and BLAS when they load, so this reaches the task processes the worker spawns
+        os.environ["OMP_NUM_THREADS"] = str(self.itk_threads)
+        if self.torch_threads is not None and "torch" in sys.modules:
+            sys.modules["torch"].set_num_threads(self.torch_threads)
+        if cpus is not None and hasattr(os, "sched_setaffinity"):
+            os.sched_setaffinity(0, cpus)
+
+
+def init_worker(budget: ThreadBudget, cpu_sets=None) -> None:
+    """
+    `ProcessPoolExecutor` initializer applying a budget to each worker process.
+
+    Args:
+        budget (ThreadBudget): The budget.
+        cpu_sets (multiprocessing.Queue, optional): Queue holding `budget.cpu_sets`; every worker takes one set.
+    """
+    cpus = None
+    if cpu_sets is not None:
+        try:
+            cpus = cpu_sets.get(timeout=1)
+        except queue.Empty:
+            # a replacement for a worker that died runs unpinned
+            pass
+    budget.apply(cpus)
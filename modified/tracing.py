@@ -0,0 +1,210 @@
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Optional
+
+try:
+    import resource
+except ImportError:
+    # not available on Windows
+    resource = None
+
+_PAGE_SIZE = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096
+
+
+def resource_counters() -> Dict[str, Optional[int | float]]:
+    """
+    Current resource counters of this process.
+
+    Bytes read and written count what is passed to read/write calls (Linux `/proc/self/io`) and are None elsewhere.
+    RSS is None where neither `/proc/self/statm` nor the `resource` module is available (Windows).
+
+    Returns:
+        Dict[str, Optional[int | float]]: cpu_s, read_bytes, written_bytes and rss_bytes.
+    """
+    counters = {"cpu_s": time.process_time(), "read_bytes": None, "written_bytes": None}
+    try:
+        with open("/proc/self/io") as f:
+            io = dict(line.split(":") for line in f if ":" in line)
+        counters["read_bytes"] = int(io["rchar"])
+        counters["written_bytes"] = int(io["wchar"])
+    except (OSError, KeyError, ValueError):
+        pass
+    try:
+        with open("/proc/self/statm") as f:
+            counters["rss_bytes"] = int(f.read().split()[1]) * _PAGE_SIZE
+    except (OSError, IndexError, ValueError):
+        # peak instead of current RSS, in kilobytes on Linux
+        counters["rss_bytes"] = (
+            resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024 if resource is not None else None
+        )
+    return counters
+
+
+def counter_deltas(before: Dict, after: Dict) -> Dict[str, Optional[int | float]]:
+    """Difference of two `resource_counters` snapshots, as span arguments."""
+    names = {"cpu_s": "cpu_s", "read_bytes": "read_bytes", "written_bytes": "written_bytes", "rss_bytes": "rss_delta_bytes"}
+    return {
+        name: after[key] - before[key] if after.get(key) is not None and before.get(key) is not None else None
+        for key, name in names.items()
+    }
+
+
+class Tracer:
+    """
+    Collects timed spans of pipeline work and exports them in the Chrome trace event format.
+
+    Every span records its wall time and the change of CPU time, bytes read and written and RSS of the process
+    while it ran. The counters are process-wide, so spans that overlap (with `max_workers > 1`) share them; work done
+    in worker processes is added with `annotate`.
+
+    The exported file can be opened in chrome://tracing or https://ui.perfetto.dev.
+
+    Args:
+        enabled (bool, optional): Record spans. When disabled, `span` runs the block without measuring it.
+
+    Example:
+        >>> tracer = Tracer()
+        >>> with tracer.span("register", category="coregistration", modality="t2"):
+        ...     register()
+        >>> tracer.write("trace.json")
+    """
+
+    def __init__(self, enabled: bool = True) -> None:
+        self.enabled = enabled
+        self._events: List[dict] = []
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    @contextmanager
+    def span(self, name: str, category: str = "task", **args) -> Iterator[dict]:
+        """
+        Trace a block of work.
+
+        Args:
+            name (str): Span name, e.g. the step ("register", "transform", "save").
+            category (str, optional): Span category, e.g. the stage.
+            **args: Additional span arguments, e.g. the modality.
+
+        Yields:
+            dict: The span arguments, which the block may extend.
+        """
+        if not self.enabled:
+            yield dict(args)
+            return
+        stack = self._local.__dict__.setdefault("stack", [])
+        args = dict(args)
+        stack.append(args)
+        before, start_us, start = resource_counters(), time.time_ns() // 1000, time.perf_counter()
+        try:
+            yield args
+        finally:
+            duration = time.perf_counter() - start
+            stack.pop()
+            deltas = counter_deltas(before, resource_counters())
+            # counters of worker processes given by annotate replace the (idle) counters of this process
+            self.add_span(name, category, start_us, duration, **{**deltas, **args})
+
+    def annotate(self, **args) -> None:
+        """Add arguments to the innermost span of the calling thread, if there is one."""
+        stack = self._local.__dict__.get("stack")
+        if stack:
+            stack[-1].update(args)
+
+    def add_span(self, name: str, category: str, start_us: int, duration: float, **args) -> None:
+        """
+        Record a span that was measured elsewhere.
+
+        Args:
+            name (str): Span name.
+            category (str): Span category.
+            start_us (int): Start as microseconds since the epoch.
+            duration (float): Wall time in seconds.
+            **args: Span arguments.
+        """
+        if not self.enabled:
+            return
+        with self._lock:
+            self._events.append(
+                {
+                    "name": name,
+                    "cat": category,
+                    "ph": "X",
+                    "ts": start_us,
+                    "dur": int(duration * 1e6),
+                    "pid": os.getpid(),
+                    "tid": threading.get_ident(),
+                    "args": {"wall_s": duration, **args},
+                }
+            )
+
+    def spans(self, category: Optional[str] = None) -> List[dict]:
+        with self._lock:
+            return [event for event in self._events if category is None or event["cat"] == category]
+
+    def clear(self) -> None:
+        with self._lock:
+            self._events.clear()
+
+    def to_chrome_trace(self, process_name: Optional[str] = None) -> dict:
+        events = self.spans()
+        if process_name is not None:
+            events.insert(
+                0,
+                {"name": "process_name", "ph": "M", "pid": os.getpid(), "args": {"name": process_name}},
+            )
+        return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+    def write(self, path: str, process_name: Optional[str] = None) -> None:
+        """
+        Write the spans as a Chrome trace JSON file.
+
+        Args:
+            path (str): Trace file (output).
+            process_name (str, optional): Label of the process in trace viewers, e.g. the patient.
+        """
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with open(path, "w") as f:
+            json.dump(self.to_chrome_trace(process_name), f)
+
+
+def aggregate_traces(paths: List[str], output_path: str) -> dict:
+    """
+    Merge the traces of a batch into one Chrome trace with a summary per span.
+
+    Every patient trace becomes one process row. The summary sums, per category and name (e.g. coregistration /
+    register), the number of spans and their wall time, CPU time and bytes read and written over the batch.
+
+    Args:
+        paths (List[str]): Trace files of the patients; missing files are skipped.
+        output_path (str): Batch trace file (output).
+
+    Returns:
+        dict: The summary.
+    """
+    events, summary = [], {}
+    for pid, path in enumerate(paths, start=1):
+        try:
+            with open(path) as f:
+                trace = json.load(f)
+        except (OSError, ValueError):
+            continue
+        for event in trace["traceEvents"]:
+            events.append({**event, "pid": pid})
+            if event["ph"] != "X":
+                continue
+            totals = summary.setdefault(f"{event['cat']}/{event['name']}", {"count": 0})
+            totals["count"] += 1
+            for key in ("wall_s", "cpu_s", "read_bytes", "written_bytes"):
+                value = event["args"].get(key)
+                if value is not None:
+                    totals[key] = totals.get(key, 0) + value
+        if not any(event["ph"] == "M" for event in trace["traceEvents"]):
+            events.append({"name": "process_name", "ph": "M", "pid": pid, "args": {"name": str(path)}})
+
+    os.makedirs(os.path.dirname(os.path.abspath(output_path)), exist_ok=True)
+    with open(output_path, "w") as f:
+        json.dump({"traceEvents": events, "displayTimeUnit": "ms", "summary": summary}, f)
+    return summary
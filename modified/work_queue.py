@@ -0,0 +1,269 @@
+import json
+import os
+import socket
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Optional
+
+
+class WorkQueue:
+    """
+    Work queue of exams on a shared filesystem, drained by any number of processes on any number of nodes.
+
+    A process claims an exam by creating its lease file with `os.link`, which is atomic on NFS as well (unlike
+    SQLite's locking), so at most one process holds an exam. Leases are renewed by `heartbeat`, which touches the
+    lease file, and expire `lease_seconds` after its last modification, e.g. when the node crashed, so that another
+    process picks the exam up again. A renewal never rewrites the file, so it cannot overwrite the lease of a worker
+    that took the exam over. A takeover renames the expired lease away and verifies that the moved file is the one it
+    found expired (same inode and modification time); a lease renewed or replaced in between is put back. The final
+    status of an exam is recorded once; a status file is never overwritten. Expiry compares the clocks of the nodes,
+    which are assumed to be synchronized (NTP) to well within `lease_seconds`.
+
+    Folder layout:
+        queue_dir/leases/<exam>.json    held leases (worker; expiry from the modification time)
+        queue_dir/status/<exam>.json    final status ("succeeded" or "failed", worker, error)
+
+    Args:
+        queue_dir (str): Shared folder of the queue, outside the data folder (every folder there is an exam).
+        lease_seconds (float, optional): Time after which a lease that is not renewed expires.
+        poll_seconds (float, optional): Time between checks for expired leases once all other exams are claimed.
+
+    Example:
+        >>> queue = WorkQueue("/shared/data_queue")
+        >>> with queue.heartbeat():
+        ...     while (exam_dir := queue.claim(exam_dirs)) is not None:
+        ...         queue.complete(exam_dir, error=process(exam_dir))
+    """
+
+    def __init__(self, queue_dir: str, lease_seconds: float = 600.0, poll_seconds: float = 30.0) -> None:
+        self.queue_dir = queue_dir
+        self.lease_seconds = lease_seconds
+        self.poll_seconds = poll_seconds
+        self.worker = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self._suffix = self.worker.replace(":", "-")
+        self._lease_dir = os.path.join(queue_dir, "leases")
+        self._status_dir = os.path.join(queue_dir, "status")
+        os.makedirs(self._lease_dir, exist_ok=True)
+        os.makedirs(self._status_dir, exist_ok=True)
+        self._held: Dict[str, str] = {}
+        self._lock = threading.Lock()
+        self._cursor = 0
+
+    @staticmethod
+    def key(exam_dir: str) -> str:
+        """Name of an exam in the queue: its folder name."""
+        return os.path.basename(os.path.normpath(str(exam_dir)))
+
+    def _lease_path(self, exam_dir: str) -> str:
+        return os.path.join(self._lease_dir, f"{self.key(exam_dir)}.json")
+
+    def _status_path(self, exam_dir: str) -> str:
+        return os.path.join(self._status_dir, f"{self.key(exam_dir)}.json")
+
+    def _create(self, path: str, content: dict) -> bool:
+        """Create `path` with `content` unless it exists, atomically; returns whether it was created."""
+        temp_path = f"{path}.{self._suffix}.tmp"
+        with open(temp_path, "w") as f:
+            json.dump(content, f)
+        try:
+            os.link(temp_path, path)
+            return True
+        except FileExistsError:
+            return False
+        finally:
+            os.remove(temp_path)
+
+    @staticmethod
+    def _read(path: str) -> Optional[dict]:
+        try:
+            with open(path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _expired(self, stat: os.stat_result) -> bool:
+        return stat.st_mtime + self.lease_seconds < time.time()
+
+    def _lease(self) -> dict:
+        return {"worker": self.worker, "claimed": time.time()}
+
+    def _move_verified(self, lease_path: str, stat: os.stat_result) -> Optional[str]:
+        """
+        Move a lease away if it is still the file described by `stat`.
+
+        Returns:
+            Optional[str]: Where the lease was moved, or None if it was gone, or was renewed or replaced since `stat`
+                was taken (then it is put back).
+        """
+        moved_path = f"{lease_path}.{self._suffix}.moved"
+        try:
+            os.rename(lease_path, moved_path)
+        except FileNotFoundError:
+            return None
+        moved = os.stat(moved_path)
+        if (moved.st_ino, moved.st_mtime_ns) == (stat.st_ino, stat.st_mtime_ns):
+            return moved_path
+        # never put back over a lease created in the meantime
+        try:
+            os.link(moved_path, lease_path)
+        except FileExistsError:
+            pass
+        os.remove(moved_path)
+        return None
+
+    def _try_claim(self, exam_dir: str) -> Optional[bool]:
+        """Claim an exam; returns True if claimed, False if leased by a live worker, None if completed."""
+        if os.path.exists(self._status_path(exam_dir)):
+            return None
+        lease_path = self._lease_path(exam_dir)
+        try:
+            stat = os.stat(lease_path)
+        except FileNotFoundError:
+            stat = None
+        if stat is not None:
+            if not self._expired(stat):
+                return False
+            # of the workers that found the lease expired, only one moves the file they inspected
+            expired_path = self._move_verified(lease_path, stat)
+            if expired_path is None:
+                return False
+            os.remove(expired_path)
+        if not self._create(lease_path, self._lease()):
+            return False
+        # the exam may have been completed between the status check and the lease
+        if os.path.exists(self._status_path(exam_dir)):
+            os.remove(lease_path)
+            return None
+        with self._lock:
+            self._held[self.key(exam_dir)] = lease_path
+        return True
+
+    def claim(self, exam_dirs: List[str], wait: bool = True) -> Optional[str]:
+        """
+        Claim the next exam that is neither completed nor leased by a live worker.
+
+        Exams leased by other workers are waited for, since their lease may expire.
+
+        Args:
+            exam_dirs (List[str]): All exams of the cohort, in the same order in every process.
+            wait (bool, optional): Wait for the leases of other workers instead of returning None while there are
+                no other exams to claim.
+
+        Returns:
+            Optional[str]: The claimed exam, or None if every exam is completed or leased by this process (or,
+                without `wait`, leased at all).
+        """
+        while True:
+            # exams before the cursor were completed or leased when this process last looked
+            for index in range(self._cursor, len(exam_dirs)):
+                if self._try_claim(exam_dirs[index]):
+                    self._cursor = index + 1
+                    return exam_dirs[index]
+            self._cursor = len(exam_dirs)
+            leased_elsewhere = False
+            for exam_dir in exam_dirs:
+                if self.key(exam_dir) in self._held:
+                    continue
+                claimed = self._try_claim(exam_dir)
+                if claimed:
+                    return exam_dir
+                leased_elsewhere |= claimed is False
+            if not (wait and leased_elsewhere):
+                return None
+            time.sleep(self.poll_seconds)
+
+    def complete(self, exam_dir: str, error: Optional[str] = None) -> bool:
+        """
+        Record the final status of a claimed exam and release its lease.
+
+        Args:
+            exam_dir (str): The exam.
+            error (str, optional): The formatted traceback if the exam failed.
+
+        Returns:
+            bool: Whether this call recorded the status; False if it was already recorded.
+        """
+        status = {
+            "status": "failed" if error is not None else "succeeded",
+            "worker": self.worker,
+            "finished": time.time(),
+            "error": error,
+        }
+        recorded = self._create(self._status_path(exam_dir), status)
+        self.release(exam_dir)
+        return recorded
+
+    def release(self, exam_dir: str) -> None:
+        """Give up the lease of an exam without recording a status, e.g. on shutdown."""
+        with self._lock:
+            lease_path = self._held.pop(self.key(exam_dir), None)
+        if lease_path is None:
+            return
+        try:
+            stat = os.stat(lease_path)
+        except FileNotFoundError:
+            return
+        # moved and checked before it is removed, as the lease may have been taken over after it expired
+        moved_path = self._move_verified(lease_path, stat)
+        if moved_path is None:
+            return
+        lease = self._read(moved_path)
+        if lease is not None and lease["worker"] != self.worker:
+            try:
+                os.link(moved_path, lease_path)
+            except FileExistsError:
+                pass
+        os.remove(moved_path)
+
+    def renew(self) -> None:
+        """Extend the leases held by this process; a lease taken over by another worker after expiry is dropped."""
+        with self._lock:
+            held = dict(self._held)
+        for key, lease_path in held.items():
+            lease = self._read(lease_path)
+            if lease is not None and lease["worker"] == self.worker:
+                try:
+                    # a touch, not a rewrite: if the lease was taken over since it was read, this only extends the
+                    # lease of the new worker, and the next renewal drops it
+                    os.utime(lease_path)
+                    continue
+                except FileNotFoundError:
+                    pass
+            with self._lock:
+                self._held.pop(key, None)
+
+    @contextmanager
+    def heartbeat(self) -> Iterator[None]:
+        """Renew the held leases in a background thread every third of `lease_seconds`; release them on exit."""
+        stop = threading.Event()
+
+        def beat() -> None:
+            while not stop.wait(self.lease_seconds / 3):
+                self.renew()
+
+        thread = threading.Thread(target=beat, name="work-queue-heartbeat", daemon=True)
+        thread.start()
+        try:
+            yield
+        finally:
+            stop.set()
+            thread.join()
+            with self._lock:
+                held = list(self._held)
+            for key in held:
+                self.release(key)
+
+    def summary(self, exam_dirs: List[str]) -> Dict[str, int]:
+        """Number of exams per status ("succeeded", "failed", "leased", "pending") over all workers."""
+        counts = {"succeeded": 0, "failed": 0, "leased": 0, "pending": 0}
+        for exam_dir in exam_dirs:
+            status = self._read(self._status_path(exam_dir))
+            if status is not None:
+                counts[status["status"]] += 1
+            elif os.path.exists(self._lease_path(exam_dir)):
+                counts["leased"] += 1
+            else:
+                counts["pending"] += 1
+        return counts
@@ -0,0 +1,132 @@
+import threading
+import traceback
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from typing import Callable, Dict, List, Optional, Set, Tuple
+
+
+class WriteBatch:
+    """
+    The output writes of one patient, collected while it is computed and run later by a `WriterPool`.
+
+    Jobs are picklable callables (e.g. a `functools.partial` of a module function), so that a batch collected in
+    a worker process can be handed to the pool of the main process. They read the temporary folder of the patient,
+    which `cleanup` removes once every job succeeded.
+
+    Args:
+        jobs (List[Callable[[], None]], optional): Writes, run in order.
+        cleanup (List[Callable[[], None]], optional): Run after the writes if all of them succeeded.
+    """
+
+    def __init__(
+        self,
+        jobs: Optional[List[Callable[[], None]]] = None,
+        cleanup: Optional[List[Callable[[], None]]] = None,
+    ) -> None:
+        self.jobs = jobs if jobs is not None else []
+        self.cleanup = cleanup if cleanup is not None else []
+
+    def __len__(self) -> int:
+        return len(self.jobs)
+
+    def run(self, cleanup: bool = True) -> Optional[str]:
+        """
+        Run every job, also after one of them failed, then the cleanup unless a job failed.
+
+        Args:
+            cleanup (bool, optional): Run the cleanup.
+
+        Returns:
+            Optional[str]: The formatted tracebacks of the failed jobs, or None if all succeeded.
+        """
+        errors = []
+        for job in self.jobs:
+            try:
+                job()
+            except Exception:
+                errors.append(traceback.format_exc())
+        if errors:
+            # the temporary folder is kept for inspection, as after a failed run
+            return "\n".join(errors)
+        if cleanup:
+            for job in self.cleanup:
+                job()
+        return None
+
+
+class WriterPool:
+    """
+    Background threads that write the outputs of finished patients while the next patients are computed.
+
+    Gzip (zlib) and file copies release the GIL, so the writes of a patient overlap with the computation of the
+    next one even in the same process. `submit` blocks while `max_pending` batches are queued or being written,
+    which holds back the next patient when writing falls behind, so the temporary folders that wait to be written
+    (and the disk they take) stay bounded.
+
+    Args:
+        threads (int, optional): Number of batches written at the same time.
+        max_pending (int, optional): Number of batches queued or being written before `submit` blocks.
+
+    Example:
+        >>> with WriterPool(threads=2) as writer:
+        ...     for patient in patients:
+        ...         writer.submit(patient, compute(patient))
+        >>> writer.failures
+    """
+
+    def __init__(self, threads: int = 2, max_pending: int = 4) -> None:
+        self.threads = threads
+        self.max_pending = max(max_pending, threads)
+        self._executor = ThreadPoolExecutor(threads, thread_name_prefix="writer")
+        self._slots = threading.BoundedSemaphore(self.max_pending)
+        self._pending: Set[Future] = set()
+        self._lock = threading.Lock()
+        # formatted tracebacks of failed writes per patient
+        self.failures: Dict[str, str] = {}
+
+    def submit(self, patient: str, batch: WriteBatch) -> Future:
+        """
+        Queue the writes of a patient, waiting for a free slot first.
+
+        Args:
+            patient (str): Name of the patient, e.g. its exam directory.
+            batch (WriteBatch): The writes.
+
+        Returns:
+            Future: Resolves to (patient, traceback or None) once the batch is written.
+        """
+        self._slots.acquire()
+        with self._lock:
+            # under the lock, so a batch written right away is not discarded before it is added
+            future = self._executor.submit(self._write, patient, batch)
+            self._pending.add(future)
+        future.add_done_callback(self._done)
+        return future
+
+    def _write(self, patient: str, batch: WriteBatch) -> Tuple[str, Optional[str]]:
+        error = batch.run()
+        if error is not None:
+            with self._lock:
+                self.failures[patient] = error
+        return patient, error
+
+    def _done(self, future: Future) -> None:
+        with self._lock:
+            self._pending.discard(future)
+        self._slots.release()
+
+    def flush(self) -> None:
+        """Wait until every submitted batch is written."""
+        with self._lock:
+            pending = list(self._pending)
+        wait(pending)
+
+    def close(self) -> None:
+        """Write the queued batches and stop the threads."""
+        self.flush()
+        self._executor.shutdown(wait=True)
+
+    def __enter__(self) -> "WriterPool":
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
@@ -1,22 +1,47 @@
-import argparse
-from auxiliary.normalization.percentile_normalizer import PercentileNormalizer
-from auxiliary.turbopath import turbopath
-from tqdm import tqdm
+from __future__ import annotations
 
-from brainles_preprocessing.brain_extraction import HDBetExtractor
-from modified.modality import ModifiedModalitiy
-from modified.preprocessor import ModifiedPreprocessor
-# from brainles_preprocessing.registration import ANTsRegistrator
-from modified.ANTs import ModifiedANTsRegistrator
+import argparse
+import os
+import time
+import traceback
+from contextlib import nullcontext
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+from functools import partial
+from multiprocessing import get_context
+from typing import TYPE_CHECKING, Callable, Dict, List, Optional, Tuple
 
+from auxiliary.turbopath import turbopath
 
-def preprocess_exam_in_brats_style(args: argparse.Namespace, input_dir: str) -> None:
+from modified.discovery import MODALITIES, DataIndex, scan_exam
+from modified.prefetch import Prefetcher
+from modified.profiles import REGISTRATION_PROFILES
+from modified.threads import ThreadBudget, init_worker
+from modified.tracing import aggregate_traces
+from modified.work_queue import WorkQueue
+from modified.writer import WriteBatch, WriterPool
+
+# the backends (ANTs, torch for HD-BET, the preprocessing modules that import them) are imported where they are
+# first used, so that --help, discovery and worker processes that never skullstrip do not pay for them
+if TYPE_CHECKING:
+    from brainles_preprocessing.brain_extraction.brain_extractor import BrainExtractor
+
+
+def preprocess_exam_in_brats_style(
+    args: argparse.Namespace,
+    input_dir: str,
+    brain_extractor: Optional[BrainExtractor] = None,
+    files: Optional[Dict[str, List[str]]] = None,
+) -> Optional[WriteBatch]:
     """
     Perform BRATS (Brain Tumor Segmentation) style preprocessing on MRI exam data.
 
     Args:
         args (argparse.Namespace): Command line arguments.
         input_dir (str): Path to the directory containing raw MRI files for an exam.
+        brain_extractor (BrainExtractor, optional): Brain extractor shared across exams. Defaults to a new HDBetService.
+        files (Dict[str, List[str]], optional): Files of the exam as returned by `scan_exam`, e.g. from a
+            `DataIndex`. Defaults to listing `input_dir`.
 
     Raises:
         Exception: If any error occurs during the preprocessing.
@@ -35,8 +60,14 @@ def preprocess_exam_in_brats_style(args: argparse.Namespace, input_dir: str) ->
         input_dir (str): Path to the directory containing raw MRI files for an exam.
 
     Returns:
-        None
+        Optional[WriteBatch]: With `--writer_threads`, the writes of the outputs, for a `WriterPool`; otherwise None,
+            the outputs are written.
     """
+    from modified.ANTs import ModifiedANTsRegistrator
+    from modified.modality import ModifiedModalitiy
+    from modified.normalization import FastPercentileNormalizer
+    from modified.preprocessor import ModifiedPreprocessor
+
     input_dir = turbopath(input_dir)
     print("*** start ***")
     brainles_dir = turbopath(input_dir) + "/" + input_dir.name + "_brainles"
@@ -49,32 +80,17 @@ def preprocess_exam_in_brats_style(args: argparse.Namespace, input_dir: str) ->
             "return_raw or return_normalized."
         )
 
-    modality_files = {
-        "t1c": input_dir.files("*t1c.nii.gz"),
-        "t2": input_dir.files("*t2.nii.gz"),
-        "t1": input_dir.files("*t1.nii.gz"),
-        "fla": input_dir.files("*fla.nii.gz")
-    }
-
-    roi_files = {
-        "t1_roi": input_dir.files("*t1_roi.nii.gz"),
-        "t2_roi": input_dir.files("*t2_roi.nii.gz"),
-        "t1c_roi": input_dir.files("*t1c_roi.nii.gz"),
-        "fla_roi": input_dir.files("*fla_roi.nii.gz")
-    }
-
-    biopsy_files = {
-        "t1_biopsy": input_dir.files("*t1_biopsy.nii.gz"),
-        "t2_biopsy": input_dir.files("*t2_biopsy.nii.gz"),
-        "t1c_biopsy": input_dir.files("*t1c_biopsy.nii.gz"),
-        "fla_biopsy": input_dir.files("*fla_biopsy.nii.gz")
-    }
+    # one listing of the exam folder, classified into modality, ROI and biopsy files
+    files = scan_exam(input_dir) if files is None else files
+    modality_files = {modality: files[modality] for modality in MODALITIES}
+    roi_files = {f"{modality}_roi": files[f"{modality}_roi"] for modality in MODALITIES}
+    biopsy_files = {f"{modality}_biopsy": files[f"{modality}_biopsy"] for modality in MODALITIES}
 
     # Select the center modality based on priority
     used_modalities = []
     center_modality = None
     for modality_name in ["t1c", "t2", "t1", "flair"]:
-        if len(modality_files[modality_name]) == 1:
+        if len(modality_files.get(modality_name, [])) == 1:
             center_modality = modality_name
             center_file = modality_files[modality_name][0]
             used_modalities.append(modality_name)
@@ -85,7 +101,7 @@ def preprocess_exam_in_brats_style(args: argparse.Namespace, input_dir: str) ->
     print(f"Center modality: {center_modality}")
 
     # Define the center modality
-    percentile_normalizer = PercentileNormalizer(
+    percentile_normalizer = FastPercentileNormalizer(
         lower_percentile=0.1,
         upper_percentile=99.9,
         lower_limit=0,
@@ -119,11 +135,11 @@ def preprocess_exam_in_brats_style(args: argparse.Namespace, input_dir: str) ->
 
     # Define the moving modalities
     moving_modalities = []
-    for modality_name, files in modality_files.items():
-        if modality_name != center_modality and len(files) == 1:
+    for modality_name, modality_paths in modality_files.items():
+        if modality_name != center_modality and len(modality_paths) == 1:
 
             # mri
-            image_path = files[0]
+            image_path = modality_paths[0]
 
             # roi
             if len(roi_files[f'{modality_name}_roi']) == 1:
@@ -157,10 +173,25 @@ def preprocess_exam_in_brats_style(args: argparse.Namespace, input_dir: str) ->
     preprocessor = ModifiedPreprocessor(
         center_modality=center,
         moving_modalities=moving_modalities,
-        registrator=ModifiedANTsRegistrator(threshold=args.threshold),
-        brain_extractor=HDBetExtractor(),
-        temp_folder="temporary_directory",
+        registrator=ModifiedANTsRegistrator(threshold=args.threshold, in_memory=args.in_memory),
+        brain_extractor=brain_extractor if brain_extractor is not None else new_brain_extractor(args),
+        temp_folder=os.path.join(args.temp_dir, input_dir.name),
         limit_cuda_visible_devices="0",
+        max_workers=args.task_workers,
+        composite_transforms=args.composite_transforms,
+        atlas_cache_dir=os.path.join(args.temp_dir, "prepared-atlas"),
+        intermediate_format=args.intermediate_format,
+        biopsy_mode=args.biopsy_mode,
+        registration_profiles={
+            stage: profile
+            for stage, profile in (
+                ("coregistration", args.coregistration_profile),
+                ("atlas-registration", args.atlas_registration_profile),
+                ("atlas-correction", args.atlas_correction_profile),
+            )
+            if profile is not None
+        },
+        defer_writes=args.writer_threads > 0,
     )
 
     preprocessor.run(
@@ -168,7 +199,336 @@ def preprocess_exam_in_brats_style(args: argparse.Namespace, input_dir: str) ->
         save_dir_atlas_registration=brainles_dir + "/atlas-registration",
         save_dir_atlas_correction=brainles_dir + "/atlas-correction",
         save_dir_brain_extraction=brainles_dir + "/brain-extraction",
+        resume=args.resume,
+        trace_file=trace_path(input_dir) if args.batch_trace is not None else None,
+    )
+    return preprocessor.pending_writes
+
+
+def trace_path(input_dir: str) -> str:
+    """Path of the trace file of an exam, next to its stage folders."""
+    input_dir = turbopath(input_dir)
+    return str(input_dir / f"{input_dir.name}_brainles" / "trace.json")
+
+
+def new_brain_extractor(
+    args: argparse.Namespace,
+    factory: Optional[Callable[..., BrainExtractor]] = None,
+    num_threads: Optional[int] = None,
+) -> BrainExtractor:
+    """
+    Create the brain extraction service configured on the command line.
+
+    Args:
+        args (argparse.Namespace): Command line arguments.
+        factory (callable, optional): A manager's HDBetService proxy factory. Defaults to HDBetService.
+        num_threads (int, optional): Threads of the torch CPU backend.
+
+    Returns:
+        BrainExtractor: The brain extractor (or a proxy to it).
+    """
+    if factory is None:
+        from modified.brain_extraction import HDBetService as factory
+    device = int(args.bet_device) if args.bet_device.isdigit() else args.bet_device
+    return factory(device=device, batch_size=args.bet_batch_size, num_threads=num_threads)
+
+
+def run_patient(
+    args: argparse.Namespace,
+    input_dir: str,
+    brain_extractor: Optional[BrainExtractor] = None,
+    files: Optional[Dict[str, List[str]]] = None,
+) -> Tuple[str, Optional[str], Optional[WriteBatch]]:
+    """
+    Preprocess a single exam and capture any failure instead of raising it.
+
+    Args:
+        args (argparse.Namespace): Command line arguments.
+        input_dir (str): Path to the directory containing raw MRI files for an exam.
+        brain_extractor (BrainExtractor, optional): Brain extractor shared across exams.
+        files (Dict[str, List[str]], optional): Files of the exam as returned by `scan_exam`.
+
+    Returns:
+        Tuple[str, Optional[str], Optional[WriteBatch]]: The exam directory, the formatted traceback or None on
+            success, and the writes left to the writer pool, if any.
+    """
+    try:
+        writes = preprocess_exam_in_brats_style(
+            args=args, input_dir=input_dir, brain_extractor=brain_extractor, files=files
+        )
+    except Exception:
+        return str(input_dir), traceback.format_exc(), None
+    return str(input_dir), None, writes
+
+
+def drain_queue(
+    queue: Optional[WorkQueue],
+    input_dirs: List[str],
+    submit: Callable[[str], Future],
+    max_pending: int = 1,
+    limit: Optional[int] = None,
+    prefetch: Optional[Callable[[List[str]], None]] = None,
+    prefetch_depth: int = 0,
+    persist: Optional[Callable[[tuple], Future]] = None,
+) -> List[Tuple[str, Optional[str]]]:
+    """
+    Process exams claimed from a work queue shared with other processes until every exam is completed, or without
+    a queue the exams of `input_dirs` in order.
+
+    Args:
+        queue (WorkQueue, optional): The work queue.
+        input_dirs (List[str]): All exams of the cohort.
+        submit (Callable[[str], Future]): Starts `run_patient` for an exam.
+        max_pending (int, optional): Number of exams processed at the same time.
+        limit (int, optional): Maximum number of exams to claim.
+        prefetch (Callable[[List[str]], None], optional): Called with the claimed exams that wait for a worker,
+            in order, before an exam is started.
+        prefetch_depth (int, optional): Number of exams claimed ahead of the free workers, for `prefetch`.
+        persist (Callable[[tuple], Future], optional): Called with the result of `run_patient` once an exam is
+            computed, e.g. to hand its writes to a `WriterPool`; returns a future of (exam directory, traceback or
+            None). The exam is completed once that future is done. Defaults to completing the exam right away.
+
+    Returns:
+        List[Tuple[str, Optional[str]]]: (exam directory, traceback or None) per exam processed by this process.
+    """
+    from tqdm import tqdm
+
+    exams = iter(input_dirs)
+
+    def claim(block: bool) -> Optional[str]:
+        if queue is None:
+            return next(exams, None)
+        return queue.claim(input_dirs, wait=block)
+
+    total = None if queue is not None else len(input_dirs) if limit is None else min(limit, len(input_dirs))
+    # running futures and their exams
+    results, computing, writing, ready, claimed = [], {}, {}, [], 0
+
+    def record(input_dir: str, error: Optional[str]) -> None:
+        if queue is not None:
+            queue.complete(input_dir, error=error)
+        results.append((input_dir, error))
+        progress.update()
+
+    with queue.heartbeat() if queue is not None else nullcontext(), tqdm(total=total) as progress:
+        while True:
+            while len(computing) + len(ready) < max_pending + prefetch_depth and (limit is None or claimed < limit):
+                # only wait for the leases of other workers when there is nothing of our own to collect
+                input_dir = claim(block=not computing and not writing and not ready)
+                if input_dir is None:
+                    break
+                ready.append(input_dir)
+                claimed += 1
+            while ready and len(computing) < max_pending:
+                input_dir = ready.pop(0)
+                if prefetch is not None:
+                    prefetch(ready)
+                print("processing:", input_dir)
+                try:
+                    computing[submit(input_dir)] = input_dir
+                except Exception:
+                    record(input_dir, traceback.format_exc())
+            if not computing and not writing:
+                return results
+            done, _ = wait([*computing, *writing], return_when=FIRST_COMPLETED)
+            for future in done:
+                computed = future in computing
+                input_dir = computing.pop(future) if computed else writing.pop(future)
+                try:
+                    result = future.result()
+                except Exception:
+                    # e.g. BrokenProcessPool: the worker process died (killed for memory, segfault in ITK)
+                    result = (input_dir, traceback.format_exc(), None)
+                if computed and persist is not None:
+                    # blocks while the writer pool is full, which holds back the next exam
+                    writing[persist(result)] = input_dir
+                    continue
+                record(input_dir, result[1])
+
+
+def _completed(result) -> Future:
+    future = Future()
+    future.set_result(result)
+    return future
+
+
+def run_batch(
+    args: argparse.Namespace,
+    input_dirs: List[str],
+    exam_files: Dict[str, Dict[str, List[str]]],
+    budget: ThreadBudget,
+    queue: Optional[WorkQueue] = None,
+    limit: Optional[int] = None,
+) -> List[Tuple[str, Optional[str]]]:
+    """
+    Preprocess exams with `budget.workers` patients in parallel, each worker limited to its share of the CPUs.
+
+    With `--writer_threads`, the outputs of a patient are written by a `WriterPool` of this process while the
+    next patients are computed, and a patient counts as processed (or failed) once its outputs are written.
+
+    Args:
+        args (argparse.Namespace): Command line arguments.
+        input_dirs (List[str]): Exams to process; with a queue, all exams of the cohort.
+        exam_files (Dict[str, Dict[str, List[str]]]): Files of every exam, as returned by `scan_exam`.
+        budget (ThreadBudget): Workers and threads per worker.
+        queue (WorkQueue, optional): Work queue to claim the exams from.
+        limit (int, optional): Maximum number of exams to process.
+
+    Returns:
+        List[Tuple[str, Optional[str]]]: (exam directory, traceback or None) per processed exam.
+    """
+    # the input files of the next patients are read into the page cache while the current ones are processed
+    prefetcher = (
+        Prefetcher(depth=args.prefetch_depth, max_bytes=int(args.prefetch_memory * (1 << 20)))
+        if args.prefetch_depth > 0
+        else None
+    )
+    writer = WriterPool(threads=args.writer_threads, max_pending=args.writer_queue) if args.writer_threads > 0 else None
+
+    def prefetch(upcoming: List[str]) -> None:
+        if prefetcher is not None:
+            prefetcher.schedule(
+                {
+                    input_dir: [path for paths in exam_files[input_dir].values() for path in paths]
+                    for input_dir in upcoming
+                }
+            )
+
+    def persist(result: Tuple[str, Optional[str], Optional[WriteBatch]]) -> Future:
+        input_dir, error, writes = result
+        if writer is None or writes is None:
+            return _completed((input_dir, error))
+        return writer.submit(input_dir, writes)
+
+    drain = partial(
+        drain_queue,
+        queue,
+        input_dirs,
+        limit=limit,
+        prefetch=prefetch,
+        prefetch_depth=args.prefetch_depth,
+        persist=persist,
+    )
+
+    try:
+        if budget.workers <= 1:
+            budget.apply(budget.cpu_sets[0] if budget.cpu_sets is not None else None)
+            # one warm brain extractor for the whole batch
+            brain_extractor = new_brain_extractor(args, num_threads=budget.torch_threads)
+
+            def run(input_dir: str) -> Future:
+                return _completed(
+                    run_patient(
+                        args=args, input_dir=input_dir, brain_extractor=brain_extractor, files=exam_files[input_dir]
+                    )
+                )
+
+            return drain(run)
+
+        from modified.brain_extraction import BrainExtractionManager
+
+        # spawn instead of fork: ITK and torch thread pools do not survive a fork
+        context = get_context("spawn")
+
+        def new_executor() -> ProcessPoolExecutor:
+            cpu_sets = None
+            if budget.cpu_sets is not None:
+                cpu_sets = context.Queue()
+                for cpus in budget.cpu_sets:
+                    cpu_sets.put(cpus)
+            return ProcessPoolExecutor(
+                max_workers=budget.workers, mp_context=context, initializer=init_worker, initargs=(budget, cpu_sets)
+            )
+
+        executors = [new_executor()]
+        # the brain extractor lives in a server process and batches the requests of all workers
+        with BrainExtractionManager(ctx=context) as manager:
+            brain_extractor = new_brain_extractor(
+                args, factory=manager.HDBetService, num_threads=budget.torch_threads
+            )
+
+            def submit(input_dir: str) -> Future:
+                try:
+                    return executors[-1].submit(run_patient, args, input_dir, brain_extractor, exam_files[input_dir])
+                except BrokenProcessPool:
+                    # a worker process died; its exams are recorded as failed, the others get a new pool
+                    print("worker process died, restarting the process pool")
+                    executors[-1].shutdown(wait=False)
+                    executors.append(new_executor())
+                    return executors[-1].submit(run_patient, args, input_dir, brain_extractor, exam_files[input_dir])
+
+            try:
+                # the next exam starts as soon as a worker is free, its writes are left to the writer pool
+                return drain(submit, max_pending=budget.workers)
+            finally:
+                for executor in executors:
+                    executor.shutdown(wait=True)
+    finally:
+        # flush: the outputs of every computed patient are written before the batch returns, also on errors
+        if writer is not None:
+            writer.close()
+        if prefetcher is not None:
+            prefetcher.close()
+
+
+def auto_tune(
+    args: argparse.Namespace,
+    input_dirs: List[str],
+    exam_files: Dict[str, Dict[str, List[str]]],
+    queue: Optional[WorkQueue] = None,
+) -> Tuple[ThreadBudget, List[Tuple[str, Optional[str]]], int]:
+    """
+    Choose the split of workers and threads with the highest throughput on the first patients.
+
+    Every candidate of `ThreadBudget.candidates` (1, 2, 4, ... up to `--workers` workers) processes as many
+    patients as it has workers, all at once, and is rated by succeeded patients per wall time. The patients are
+    processed for real, so nothing is computed twice.
+
+    Args:
+        args (argparse.Namespace): Command line arguments.
+        input_dirs (List[str]): All exams.
+        exam_files (Dict[str, Dict[str, List[str]]]): Files of every exam.
+        queue (WorkQueue, optional): Work queue to claim the patients from.
+
+    Returns:
+        Tuple[ThreadBudget, List[Tuple[str, Optional[str]]], int]: The best budget, the results of the processed
+            patients and, without a queue, the number of exams processed from the start of `input_dirs`.
+    """
+    candidates = ThreadBudget.candidates(
+        args.workers, args.task_workers, affinity=args.cpu_affinity, torch_threads=args.bet_threads
     )
+    best, best_throughput, results, start = candidates[-1], -1.0, [], 0
+    for budget in candidates:
+        batch = input_dirs if queue is not None else input_dirs[start : start + budget.workers]
+        start_time = time.perf_counter()
+        batch_results = run_batch(args, batch, exam_files, budget, queue=queue, limit=budget.workers)
+        wall = time.perf_counter() - start_time
+        results.extend(batch_results)
+        start += len(batch_results) if queue is None else 0
+        if len(batch_results) < budget.workers:
+            # too few patients left to rate this candidate
+            break
+        throughput = sum(error is None for _, error in batch_results) / wall
+        print(f"auto-tune: {budget}: {throughput * 3600:.1f} patients/h")
+        if throughput > best_throughput:
+            best, best_throughput = budget, throughput
+    print(f"auto-tune: selected {best}")
+    return best, results, start
+
+
+def summarize(results: List[Tuple[str, Optional[str]]]) -> None:
+    """
+    Print a per-patient summary of a batch run.
+
+    Args:
+        results (List[Tuple[str, Optional[str]]]): (exam directory, traceback or None) per patient.
+    """
+    failed = [(input_dir, error) for input_dir, error in results if error is not None]
+    print(f"{' Summary ':=^80}")
+    print(f"succeeded: {len(results) - len(failed)} / {len(results)}")
+    for input_dir, error in failed:
+        print(f"failed: {input_dir}")
+        print(error)
 
 
 def main():
@@ -180,14 +540,86 @@ def main():
     parser.add_argument('--return_raw', type=str2bool, default=False)
     parser.add_argument('--return_normalized', type=str2bool, default=True)
     parser.add_argument('--threshold', type=float, default=0.5, help='ROI post-processing threshold')
+    parser.add_argument('--resume', type=str2bool, default=True,
+                        help='skip stages whose saved manifest shows unchanged inputs and parameters')
+    parser.add_argument('--workers', type=int, default=1, help='number of patients processed in parallel')
+    parser.add_argument('--task_workers', type=int, default=1,
+                        help='number of concurrent registration tasks within one patient')
+    parser.add_argument('--bet_device', type=str, default="0", help='CUDA device id or "cpu" for HD-BET')
+    parser.add_argument('--bet_batch_size', type=int, default=4,
+                        help='maximum number of patients skullstripped in one batched inference')
+    parser.add_argument('--in_memory', type=str2bool, default=False,
+                        help='pass transformed images between steps in memory, writing only what is saved')
+    parser.add_argument('--composite_transforms', type=str2bool, default=False,
+                        help='resample each image, ROI and biopsy once from its input with the composed transforms')
+    parser.add_argument('--coregistration_profile', type=str, default=None, choices=list(REGISTRATION_PROFILES),
+                        help='registration profile of the co-registration (default: registrator defaults)')
+    parser.add_argument('--atlas_registration_profile', type=str, default=None, choices=list(REGISTRATION_PROFILES),
+                        help='registration profile of the atlas registration (default: registrator defaults)')
+    parser.add_argument('--atlas_correction_profile', type=str, default=None, choices=list(REGISTRATION_PROFILES),
+                        help='registration profile of the atlas correction (default: registrator defaults)')
+    parser.add_argument('--intermediate_format', type=str, default="nii.gz", choices=["nii.gz", "nii"],
+                        help='file format of the intermediate files; "nii" skips gzip between steps')
+    parser.add_argument('--biopsy_mode', type=str, default="volume", choices=["volume", "points"],
+                        help='resample biopsy masks as volumes, or transform the coordinates of their marked voxels')
+    parser.add_argument('--batch_trace', type=str, default=None,
+                        help='Chrome trace of all patients with a per-step summary, e.g. log/batch_trace.json '
+                             '(default: no tracing)')
+    parser.add_argument('--temp_dir', type=str, default="temporary_directory",
+                        help='root of the per-patient temporary directories')
+    parser.add_argument('--data_index', type=str, default=None,
+                        help='JSON file keeping the folder listings of data_dir; reruns only list changed folders')
+    parser.add_argument('--queue_dir', type=str, default=None,
+                        help='shared folder of a work queue that several processes (on several nodes) drain together')
+    parser.add_argument('--lease_seconds', type=float, default=600,
+                        help='time after which the exam of a worker that stopped renewing its lease is taken over')
+    parser.add_argument('--cpu_affinity', type=str2bool, default=False,
+                        help='pin every worker to its own share of the CPUs')
+    parser.add_argument('--bet_threads', type=int, default=None,
+                        help='threads of HD-BET on the CPU (default: the CPU share of one worker)')
+    parser.add_argument('--auto_tune', type=str2bool, default=False,
+                        help='benchmark 1, 2, ... up to --workers workers on the first patients and keep the fastest')
+    parser.add_argument('--prefetch_depth', type=int, default=0,
+                        help='number of upcoming patients whose input files are read ahead (0: off)')
+    parser.add_argument('--prefetch_memory', type=float, default=2048,
+                        help='MB of input files read ahead for patients that have not started yet')
+    parser.add_argument('--writer_threads', type=int, default=0,
+                        help='threads writing the outputs of finished patients while the next ones run (0: inline)')
+    parser.add_argument('--writer_queue', type=int, default=4,
+                        help='patients whose outputs may wait to be written before the next patient is held back')
 
     args = parser.parse_args()
 
-    input_dirs = sorted(turbopath(args.data_dir).dirs())
+    # every folder is listed once, or not at all if the index shows it unchanged
+    index = DataIndex(args.data_dir, index_path=args.data_index)
+    input_dirs = [turbopath(input_dir) for input_dir in index.exams()]
+    exam_files = {input_dir: index.files(input_dir) for input_dir in input_dirs}
+    index.save()
+
+    # with a queue, any number of these processes (on any node) share the exams of data_dir
+    queue = WorkQueue(args.queue_dir, lease_seconds=args.lease_seconds) if args.queue_dir is not None else None
 
-    for input_dir in tqdm(input_dirs):
-        print("processing:", input_dir)
-        preprocess_exam_in_brats_style(args=args, input_dir=input_dir)
+    # split the CPUs between the workers instead of letting every ITK and torch call use all of them
+    if args.auto_tune:
+        budget, results, start = auto_tune(args, input_dirs, exam_files, queue=queue)
+    else:
+        budget = ThreadBudget.split(
+            args.workers, args.task_workers, affinity=args.cpu_affinity, torch_threads=args.bet_threads
+        )
+        results, start = [], 0
+    results += run_batch(args, input_dirs[start:] if queue is None else input_dirs, exam_files, budget, queue=queue)
+
+    summarize(results)
+    if queue is not None:
+        print(f"queue (all workers): {queue.summary(input_dirs)}")
+
+    if args.batch_trace is not None:
+        # one trace of the whole batch, with the time spent per stage and step summed over all patients
+        summary = aggregate_traces([trace_path(input_dir) for input_dir in input_dirs], args.batch_trace)
+        print(f"{' Time per step (batch total) ':=^80}")
+        for name, totals in sorted(summary.items(), key=lambda item: -item[1].get("wall_s", 0))[:15]:
+            print(f"{name:<50} {totals['count']:>6}x {totals.get('wall_s', 0):>12.1f}s")
+        print(f"Batch trace saved to {args.batch_trace}")
 
 
 if __name__ == "__main__":
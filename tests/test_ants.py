@@ -0,0 +1,225 @@
+import os
+
+import numpy as np
+import pytest
+
+ants = pytest.importorskip("ants")
+pd = pytest.importorskip("pandas")
+pytest.importorskip("brainles_preprocessing")
+
+from modified.ANTs import ModifiedANTsRegistrator, points_path  # noqa: E402
+
+
+def _image(array, spacing=(1.0, 1.0, 1.0), origin=(0.0, 0.0, 0.0)):
+    return ants.from_numpy(np.asarray(array, dtype=np.float32), origin=list(origin), spacing=list(spacing))
+
+
+def _save(image, path):
+    ants.image_write(image, str(path))
+    return str(path)
+
+
+def _translation(path, translation):
+    transform = ants.create_ants_transform(transform_type="AffineTransform", dimension=3, translation=translation)
+    ants.write_transform(transform, str(path))
+    return str(path)
+
+
+def _volume(shape=(16, 16, 16), seed=0):
+    return np.random.default_rng(seed).random(shape).astype(np.float32)
+
+
+def test_in_memory_results_are_written_on_flush(tmp_path):
+    fixed = _save(_image(_volume()), tmp_path / "fixed.nii.gz")
+    moving = _save(_image(_volume(seed=1)), tmp_path / "moving.nii.gz")
+    matrix = _translation(tmp_path / "identity.mat", (0.0, 0.0, 0.0))
+    transformed = str(tmp_path / "stage" / "transformed.nii.gz")
+
+    registrator = ModifiedANTsRegistrator(in_memory=True)
+    registrator.transform(fixed, moving, transformed, matrix, str(tmp_path / "transform.log"))
+    assert not os.path.exists(transformed)
+    # later steps read the live image
+    np.testing.assert_allclose(registrator._read(transformed).numpy(), ants.image_read(moving).numpy(), atol=1e-5)
+
+    registrator.flush(directory=str(tmp_path / "other"))
+    assert not os.path.exists(transformed)
+    registrator.flush(paths=[transformed])
+    np.testing.assert_array_equal(ants.image_read(transformed).numpy(), registrator._read(transformed).numpy())
+
+
+def test_discarded_images_are_not_written(tmp_path):
+    fixed = _save(_image(_volume()), tmp_path / "fixed.nii.gz")
+    matrix = _translation(tmp_path / "identity.mat", (0.0, 0.0, 0.0))
+    transformed = str(tmp_path / "transformed.nii.gz")
+
+    registrator = ModifiedANTsRegistrator(in_memory=True)
+    registrator.transform(fixed, fixed, transformed, matrix, str(tmp_path / "transform.log"))
+    registrator.discard(paths=[transformed])
+    registrator.flush()
+    assert not os.path.exists(transformed)
+
+
+def test_transformlist_normalizes_matrix_paths():
+    transformlist = ModifiedANTsRegistrator._transformlist(["atlas/atlas__t1c", "co/co__t1c__t2.mat"])
+    assert [str(path) for path in transformlist] == ["atlas/atlas__t1c.mat", "co/co__t1c__t2.mat"]
+    assert [str(path) for path in ModifiedANTsRegistrator._transformlist("co/co__t1c__t2")] == ["co/co__t1c__t2.mat"]
+
+
+def test_composed_matrices_resample_once(tmp_path):
+    fixed = _save(_image(_volume()), tmp_path / "fixed.nii.gz")
+    moving = _save(_image(_volume(seed=1)), tmp_path / "moving.nii.gz")
+    first = _translation(tmp_path / "first.mat", (1.0, 0.0, 0.0))
+    second = _translation(tmp_path / "second.mat", (0.0, 2.0, 0.0))
+    combined = _translation(tmp_path / "combined.mat", (1.0, 2.0, 0.0))
+
+    registrator = ModifiedANTsRegistrator()
+    registrator.transform(fixed, moving, str(tmp_path / "composed.nii.gz"), [first, second], str(tmp_path / "a.log"))
+    registrator.transform(fixed, moving, str(tmp_path / "single.nii.gz"), combined, str(tmp_path / "b.log"))
+    np.testing.assert_allclose(
+        ants.image_read(str(tmp_path / "composed.nii.gz")).numpy(),
+        ants.image_read(str(tmp_path / "single.nii.gz")).numpy(),
+        atol=1e-5,
+    )
+
+
+def _masks(shape=(20, 20, 20)):
+    roi = np.zeros(shape, dtype=np.float32)
+    roi[5:11, 6:12, 7:13] = 1
+    biopsy = np.zeros(shape, dtype=np.float32)
+    biopsy[8, 9, 10] = biopsy[12, 4, 6] = 1
+    return roi, biopsy
+
+
+def test_stacked_masks_match_separate_transforms(tmp_path):
+    fixed = _save(_image(np.zeros((20, 20, 20))), tmp_path / "fixed.nii.gz")
+    masks = [_save(_image(mask), tmp_path / f"{name}.nii.gz") for name, mask in zip(["roi", "biopsy"], _masks())]
+    matrix = _translation(tmp_path / "shift.mat", (0.3, 0.6, 0.0))
+
+    registrator = ModifiedANTsRegistrator()
+    stacked = [str(tmp_path / "stacked" / os.path.basename(mask)) for mask in masks]
+    registrator.transform_binaries(fixed, masks, stacked, matrix, str(tmp_path / "stacked.log"))
+    for mask, stacked_path in zip(masks, stacked):
+        separate = str(tmp_path / "separate" / os.path.basename(mask))
+        registrator.transform(fixed, mask, separate, matrix, str(tmp_path / "separate.log"), is_binary=True)
+        result = ants.image_read(stacked_path)
+        assert result.pixeltype == "unsigned char"
+        np.testing.assert_array_equal(result.numpy(), ants.image_read(separate).numpy())
+
+
+def test_stacked_masks_need_one_output_per_mask(tmp_path):
+    with pytest.raises(ValueError):
+        ModifiedANTsRegistrator().transform_binaries("fixed", ["roi", "biopsy"], ["roi"], "matrix", "log")
+
+
+def test_threshold_yields_uint8_within_bounds():
+    values = np.array([-0.5, 0.0, 0.49, 0.5, 0.75, 1.0, 1.01], dtype=np.float32).reshape(7, 1, 1)
+    image = _image(values, spacing=(2.0, 1.5, 1.0), origin=(10.0, -4.0, 3.0))
+
+    mask = ModifiedANTsRegistrator(threshold=0.5)._threshold(image)
+    assert mask.pixeltype == "unsigned char"
+    np.testing.assert_array_equal(mask.numpy().ravel(), [0, 0, 0, 1, 1, 1, 0])
+    assert mask.spacing == image.spacing and mask.origin == image.origin
+
+    mask = ModifiedANTsRegistrator(threshold=0.25)._threshold(image)
+    np.testing.assert_array_equal(mask.numpy().ravel(), [0, 0, 1, 1, 1, 1, 0])
+    # the interpolated input is left as it is
+    np.testing.assert_array_equal(image.numpy(), values)
+
+
+def test_points_path_replaces_the_nifti_extension():
+    assert points_path("co/t1_biopsy.nii.gz") == "co/t1_biopsy_points.csv"
+    assert points_path("co/t1_biopsy.nii") == "co/t1_biopsy_points.csv"
+    assert points_path("co/t1_biopsy") == "co/t1_biopsy_points.csv"
+
+
+def test_rasterize_places_labels_at_the_nearest_voxel():
+    image = _image(np.zeros((6, 6, 6)), spacing=(2.0, 2.0, 2.0), origin=(10.0, -4.0, 3.0))
+    origin, spacing = np.asarray(image.origin), np.asarray(image.spacing)
+    indices = np.array([[1, 2, 3], [5, 0, 4], [-1, 0, 0], [0, 6, 0]])
+    offsets = np.array([[0.7, -0.7, 0.0], [-0.9, 0.3, 0.9], [0.0, 0.0, 0.0], [0.0, 0.0, 0.0]])
+    points = pd.DataFrame(origin + indices * spacing + offsets, columns=["x", "y", "z"])
+    points["label"] = [1, 2, 3, 4]
+
+    mask = ModifiedANTsRegistrator._rasterize(points, image)
+    array = mask.numpy()
+    assert mask.pixeltype == "unsigned char"
+    assert array[1, 2, 3] == 1 and array[5, 0, 4] == 2
+    # the points outside the grid are dropped
+    assert np.count_nonzero(array) == 2
+
+
+def test_points_are_stored_and_reused_by_the_next_stage(tmp_path):
+    shape = (12, 12, 12)
+    labels = np.zeros(shape, dtype=np.float32)
+    labels[3, 4, 5], labels[7, 8, 2] = 1, 2
+    fixed = _save(_image(np.zeros(shape)), tmp_path / "fixed.nii.gz")
+    biopsy = _save(_image(labels), tmp_path / "biopsy.nii.gz")
+    identity = _translation(tmp_path / "identity.mat", (0.0, 0.0, 0.0))
+    shift = _translation(tmp_path / "shift.mat", (2.0, 0.0, 0.0))
+    registrator = ModifiedANTsRegistrator()
+
+    first = str(tmp_path / "co" / "co__biopsy.nii.gz")
+    registrator.transform_points(fixed, biopsy, first, identity, str(tmp_path / "co.log"))
+    points = pd.read_csv(points_path(first))
+    assert sorted(points["label"]) == [1, 2]
+    np.testing.assert_allclose(points.sort_values("label")[["x", "y", "z"]].values, [[3, 4, 5], [7, 8, 2]], atol=1e-4)
+    np.testing.assert_array_equal(ants.image_read(first).numpy(), labels)
+
+    # the next stage transforms the stored points, not the rasterized mask
+    _save(_image(np.zeros(shape)), first)
+    second = str(tmp_path / "atlas" / "atlas__biopsy.nii.gz")
+    registrator.transform_points(fixed, first, second, shift, str(tmp_path / "atlas.log"))
+    # resampling a binary version of the mask moves the marked voxels to the same place
+    binary = _save(_image(labels != 0), tmp_path / "binary.nii.gz")
+    resampled = str(tmp_path / "resampled.nii.gz")
+    registrator.transform(fixed, binary, resampled, shift, str(tmp_path / "resampled.log"), is_binary=True)
+    result = ants.image_read(second).numpy()
+    assert sorted(result[result != 0]) == [1, 2]
+    np.testing.assert_array_equal(result != 0, ants.image_read(resampled).numpy() != 0)
+
+
+def test_pad_places_the_region_in_the_fixed_grid():
+    fixed = _image(np.zeros((10, 10, 10)), spacing=(2.0, 2.0, 2.0), origin=(5.0, 0.0, -5.0))
+    region = np.arange(24, dtype=np.uint8).reshape(2, 3, 4)
+
+    padded = ModifiedANTsRegistrator._pad(ants.from_numpy(region), fixed, [1, 2, 3])
+    array = padded.numpy()
+    assert padded.pixeltype == "unsigned char"
+    assert padded.spacing == fixed.spacing and padded.origin == fixed.origin
+    np.testing.assert_array_equal(array[1:3, 2:5, 3:7], region)
+    assert array.sum() == region.sum()
+
+    empty = ModifiedANTsRegistrator._pad(None, fixed, None)
+    assert empty.shape == fixed.shape and not empty.numpy().any()
+
+
+def test_mask_region_covers_the_mapped_bounding_box(tmp_path):
+    fixed = _image(np.zeros((20, 20, 20)))
+    roi, biopsy = _masks()
+    identity = [_translation(tmp_path / "identity.mat", (0.0, 0.0, 0.0))]
+
+    fixed_lower, fixed_upper, moving_lower, moving_upper = ModifiedANTsRegistrator._mask_region(
+        fixed, [_image(roi), _image(biopsy)], identity, margin=2
+    )
+    # the union of both masks, widened by the margin
+    assert moving_lower == [3, 2, 4] and moving_upper == [15, 14, 15]
+    assert all(f <= m for f, m in zip(fixed_lower, moving_lower))
+    assert all(f >= m for f, m in zip(fixed_upper, moving_upper))
+
+    assert ModifiedANTsRegistrator._mask_region(fixed, [_image(np.zeros((20, 20, 20)))], identity) is None
+    far_away = _image(np.zeros((20, 20, 20)), origin=(1000.0, 0.0, 0.0))
+    assert ModifiedANTsRegistrator._mask_region(far_away, [_image(roi)], identity) is None
+
+
+def test_bounding_box_resampling_matches_the_full_grid(tmp_path):
+    fixed = _image(np.zeros((16, 18, 20)), spacing=(1.5, 1.0, 1.25), origin=(-2.0, 1.0, 0.6))
+    masks = [_image(mask) for mask in _masks()]
+    # no interpolated value lands exactly on the threshold
+    transformlist = [_translation(tmp_path / "shift.mat", (0.3, 0.6, 0.0))]
+
+    registrator = ModifiedANTsRegistrator(threshold=0.5)
+    channels = registrator._transform_masks(fixed, masks, transformlist, {"interpolator": "linear"})
+    for mask, channel in zip(masks, channels):
+        full = ants.apply_transforms(fixed=fixed, moving=mask, transformlist=transformlist, interpolator="linear")
+        assert channel.pixeltype == "unsigned char" and channel.shape == fixed.shape
+        np.testing.assert_array_equal(channel.numpy(), registrator._threshold(full).numpy())
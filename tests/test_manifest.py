@@ -0,0 +1,64 @@
+import os
+
+from modified.manifest import StageManifest, file_digest
+
+
+def _write(path, content):
+    with open(path, "w") as f:
+        f.write(content)
+    return str(path)
+
+
+def test_matches_unchanged_inputs_parameters_and_existing_outputs(tmp_path):
+    output = _write(tmp_path / "t1c.nii.gz", "image")
+    manifest = StageManifest(str(tmp_path))
+    manifest.write(
+        inputs={"t1c/image": "abc"},
+        parameters={"profile": "fast", "iterations": (10, 5)},
+        outputs={"t1c": {"image": output, "roi": None}},
+    )
+    # tuples compare equal to the lists loaded from json
+    assert manifest.matches({"t1c/image": "abc"}, {"profile": "fast", "iterations": (10, 5)})
+
+
+def test_changed_inputs_or_parameters_do_not_match(tmp_path):
+    output = _write(tmp_path / "t1c.nii.gz", "image")
+    manifest = StageManifest(str(tmp_path))
+    manifest.write(inputs={"t1c/image": "abc"}, parameters={"profile": "fast"}, outputs={"t1c": {"image": output}})
+    assert not manifest.matches({"t1c/image": "changed"}, {"profile": "fast"})
+    assert not manifest.matches({"t1c/image": "abc"}, {"profile": "accurate"})
+
+
+def test_missing_output_does_not_match(tmp_path):
+    output = _write(tmp_path / "t1c.nii.gz", "image")
+    manifest = StageManifest(str(tmp_path))
+    manifest.write(inputs={}, parameters={}, outputs={"t1c": {"image": output}})
+    os.remove(output)
+    assert not manifest.matches({}, {})
+
+
+def test_missing_or_unreadable_manifest_does_not_match(tmp_path):
+    manifest = StageManifest(str(tmp_path))
+    assert manifest.load() is None
+    assert not manifest.matches({}, {})
+    _write(manifest.path, "{not json")
+    assert not manifest.matches({}, {})
+
+
+def test_invalidate_removes_the_manifest(tmp_path):
+    manifest = StageManifest(str(tmp_path))
+    manifest.write(inputs={}, parameters={}, outputs={}, transforms={"t2": ["a.mat"]})
+    assert manifest.matches({}, {})
+    assert manifest.transforms == {"t2": ["a.mat"]}
+    manifest.invalidate()
+    assert not os.path.exists(manifest.path)
+    assert not manifest.matches({}, {})
+    # invalidating twice is fine
+    manifest.invalidate()
+
+
+def test_file_digest_depends_on_content(tmp_path):
+    a = _write(tmp_path / "a", "same")
+    b = _write(tmp_path / "b", "same")
+    c = _write(tmp_path / "c", "other")
+    assert file_digest(a) == file_digest(b) != file_digest(c)
@@ -0,0 +1,55 @@
+import os
+
+import pytest
+
+from modified.materialize import materialize, materialize_tree
+
+
+def _write(path, content):
+    with open(path, "w") as f:
+        f.write(content)
+    return str(path)
+
+
+def _read(path):
+    with open(path) as f:
+        return f.read()
+
+
+def test_materialize_creates_a_file_with_the_content(tmp_path):
+    src = _write(tmp_path / "src.nii.gz", "image")
+    method = materialize(src, str(tmp_path / "dst.nii.gz"))
+    assert method in ("reflink", "hardlink", "copy")
+    assert _read(tmp_path / "dst.nii.gz") == "image"
+
+
+def test_existing_destination_is_replaced_not_written_through(tmp_path):
+    src = _write(tmp_path / "src", "new")
+    dst = _write(tmp_path / "dst", "old")
+    # a file linked to the old destination elsewhere, e.g. a saved stage output
+    os.link(dst, tmp_path / "saved")
+    materialize(src, dst)
+    assert _read(dst) == "new"
+    assert _read(tmp_path / "saved") == "old"
+
+
+def test_same_path_is_left_alone(tmp_path):
+    src = _write(tmp_path / "src", "image")
+    assert materialize(src, src) == "same"
+    assert _read(src) == "image"
+
+
+def test_missing_source_raises(tmp_path):
+    with pytest.raises(OSError):
+        materialize(str(tmp_path / "missing"), str(tmp_path / "dst"))
+
+
+def test_materialize_tree_mirrors_the_folder(tmp_path):
+    src = tmp_path / "stage"
+    os.makedirs(src / "t2")
+    _write(src / "t1c.nii.gz", "center")
+    _write(src / "t2" / "t2.nii.gz", "moving")
+    methods = materialize_tree(str(src), str(tmp_path / "saved"))
+    assert sum(methods.values()) == 2
+    assert _read(tmp_path / "saved" / "t1c.nii.gz") == "center"
+    assert _read(tmp_path / "saved" / "t2" / "t2.nii.gz") == "moving"
@@ -0,0 +1,25 @@
+import numpy as np
+import pytest
+
+from modified.normalization import percentiles
+
+
+@pytest.mark.parametrize("lower, upper", [(0.1, 99.9), (0, 100), (25, 75), (50, 50), (1, 2)])
+@pytest.mark.parametrize("shape", [(1,), (7,), (10, 11, 12)])
+def test_percentiles_match_numpy(shape, lower, upper):
+    image = np.random.default_rng(0).normal(size=shape).astype(np.float32)
+    expected = np.percentile(image, [lower, upper])
+    np.testing.assert_allclose(percentiles(image, lower, upper), expected, rtol=1e-5, atol=1e-6)
+
+
+def test_percentiles_of_a_transposed_volume():
+    # memory-mapped volumes are read as transposed views
+    image = np.random.default_rng(1).integers(0, 1000, size=(8, 9, 10)).astype(np.int16).T
+    np.testing.assert_allclose(percentiles(image, 0.1, 99.9), np.percentile(image, [0.1, 99.9]))
+
+
+def test_percentiles_do_not_modify_the_image():
+    image = np.arange(100, dtype=np.float32)[::-1].copy()
+    before = image.copy()
+    percentiles(image, 10, 90)
+    np.testing.assert_array_equal(image, before)
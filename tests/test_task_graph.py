@@ -0,0 +1,96 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from modified.task_graph import TaskGraph
+
+
+def test_sequential_run_keeps_insertion_order():
+    order = []
+    graph = TaskGraph()
+    for name in ["a", "b", "c"]:
+        graph.add(name, lambda name=name: order.append(name) or name)
+    assert graph.run() == {"a": "a", "b": "b", "c": "c"}
+    assert order == ["a", "b", "c"]
+
+
+def test_executor_runs_tasks_after_their_dependencies():
+    finished = []
+    lock = threading.Lock()
+
+    def task(name, delay=0.0):
+        def run():
+            time.sleep(delay)
+            with lock:
+                finished.append(name)
+            return name
+
+        return run
+
+    graph = TaskGraph()
+    graph.add("register", task("register", delay=0.05))
+    graph.add("transform", task("transform"), deps=["register"])
+    graph.add("independent", task("independent"))
+    graph.add("save", task("save"), deps=["transform", "independent"])
+    with ThreadPoolExecutor(4) as executor:
+        results = graph.run(executor)
+    assert set(results) == {"register", "transform", "independent", "save"}
+    assert finished.index("register") < finished.index("transform") < finished.index("save")
+    assert finished.index("independent") < finished.index("save")
+    # the independent task does not wait for the slow registration
+    assert finished.index("independent") < finished.index("register")
+
+
+def test_none_dependencies_are_ignored():
+    graph = TaskGraph()
+    graph.add("a", lambda: 1, deps=[None, graph.get("skipped-stage/save")])
+    with ThreadPoolExecutor(2) as executor:
+        assert graph.run(executor) == {"a": 1}
+
+
+def test_unknown_dependencies_are_rejected():
+    graph = TaskGraph()
+    graph.add("register", lambda: None)
+    with pytest.raises(ValueError, match="registr"):
+        graph.add("transform", lambda: None, deps=["register", "registr"])
+    assert "transform" not in graph
+    assert graph.get("register") == "register"
+
+
+def test_duplicate_task_names_are_rejected():
+    graph = TaskGraph()
+    graph.add("a", lambda: None)
+    with pytest.raises(ValueError):
+        graph.add("a", lambda: None)
+
+
+def test_error_propagates_after_running_tasks_finished():
+    slow_done = threading.Event()
+
+    def fail():
+        raise RuntimeError("registration failed")
+
+    def slow():
+        time.sleep(0.1)
+        slow_done.set()
+
+    graph = TaskGraph()
+    graph.add("slow", slow)
+    graph.add("fail", fail)
+    graph.add("after", lambda: None, deps=["fail"])
+    with ThreadPoolExecutor(2) as executor:
+        with pytest.raises(RuntimeError, match="registration failed"):
+            graph.run(executor)
+    assert slow_done.is_set()
+    assert "after" not in graph.results
+
+
+def test_sequential_error_stops_the_run():
+    graph = TaskGraph()
+    graph.add("fail", lambda: 1 / 0)
+    graph.add("after", lambda: "never")
+    with pytest.raises(ZeroDivisionError):
+        graph.run()
+    assert "after" not in graph.results
@@ -0,0 +1,27 @@
+import json
+
+from modified.tracing import Tracer, aggregate_traces
+
+
+def test_spans_are_exported_and_aggregated(tmp_path):
+    tracer = Tracer()
+    with tracer.span("register", category="coregistration", modality="t2") as args:
+        args["iterations"] = 3
+    tracer.write(str(tmp_path / "p1" / "trace.json"), process_name="p1")
+    (span,) = tracer.spans("coregistration")
+    assert span["args"]["modality"] == "t2" and span["args"]["iterations"] == 3
+    assert span["args"]["wall_s"] >= 0
+
+    summary = aggregate_traces([str(tmp_path / "p1" / "trace.json"), str(tmp_path / "missing.json")], str(tmp_path / "batch.json"))
+    assert summary["coregistration/register"]["count"] == 1
+    with open(tmp_path / "batch.json") as f:
+        assert len(json.load(f)["traceEvents"]) == 2
+
+
+def test_disabled_tracer_records_nothing():
+    tracer = Tracer(enabled=False)
+    with tracer.span("register", category="coregistration") as args:
+        tracer.annotate(cpu_s=1.0)
+        args["iterations"] = 3
+    tracer.add_span("coregistration", "stage", 0, 1.0)
+    assert tracer.spans() == []
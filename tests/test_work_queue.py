@@ -0,0 +1,88 @@
+import os
+import threading
+import time
+
+from modified.work_queue import WorkQueue
+
+EXAMS = [f"/data/exam_{index:02d}" for index in range(20)]
+
+
+def _expire(queue, exam_dir):
+    # as if the worker holding the lease stopped renewing it lease_seconds ago
+    past = time.time() - 2 * queue.lease_seconds
+    os.utime(queue._lease_path(exam_dir), (past, past))
+
+
+def test_claim_and_complete(tmp_path):
+    queue = WorkQueue(str(tmp_path))
+    assert queue.claim(EXAMS[:2]) == EXAMS[0]
+    assert queue.claim(EXAMS[:2]) == EXAMS[1]
+    # both leased by this process
+    assert queue.claim(EXAMS[:2]) is None
+    assert queue.complete(EXAMS[0])
+    assert queue.complete(EXAMS[1], error="Traceback ...")
+    assert not queue.complete(EXAMS[1])
+    assert queue.summary(EXAMS[:3]) == {"succeeded": 1, "failed": 1, "leased": 0, "pending": 1}
+
+
+def test_live_lease_of_another_worker_is_not_claimed(tmp_path):
+    first, second = WorkQueue(str(tmp_path)), WorkQueue(str(tmp_path))
+    assert first.claim(EXAMS[:1]) == EXAMS[0]
+    assert second.claim(EXAMS[:1], wait=False) is None
+
+
+def test_expired_lease_is_taken_over_and_dropped_by_its_old_owner(tmp_path):
+    first, second = WorkQueue(str(tmp_path)), WorkQueue(str(tmp_path))
+    first.claim(EXAMS[:1])
+    _expire(first, EXAMS[0])
+    assert second.claim(EXAMS[:1], wait=False) == EXAMS[0]
+    first.renew()
+    assert first._held == {}
+    # the renewal did not overwrite the lease of the new worker
+    assert first._read(second._lease_path(EXAMS[0]))["worker"] == second.worker
+    # releasing a lease that was taken over leaves it in place
+    first._held[first.key(EXAMS[0])] = first._lease_path(EXAMS[0])
+    first.release(EXAMS[0])
+    assert os.path.exists(second._lease_path(EXAMS[0]))
+
+
+def test_lease_renewed_after_inspection_is_not_taken_over(tmp_path):
+    first, second = WorkQueue(str(tmp_path)), WorkQueue(str(tmp_path))
+    first.claim(EXAMS[:1])
+    _expire(first, EXAMS[0])
+    lease_path = second._lease_path(EXAMS[0])
+    inspected = os.stat(lease_path)
+    # the owner renews between the inspection and the takeover
+    first.renew()
+    assert second._move_verified(lease_path, inspected) is None
+    assert first._read(lease_path)["worker"] == first.worker
+    assert first._held
+
+
+def test_competing_claimers_never_share_an_exam(tmp_path):
+    queues = [WorkQueue(str(tmp_path)) for _ in range(4)]
+    claimed = {queue.worker: [] for queue in queues}
+    barrier = threading.Barrier(len(queues))
+
+    def drain(queue):
+        barrier.wait()
+        while (exam_dir := queue.claim(EXAMS, wait=False)) is not None:
+            claimed[queue.worker].append(exam_dir)
+
+    threads = [threading.Thread(target=drain, args=(queue,)) for queue in queues]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    all_claimed = [exam_dir for exams in claimed.values() for exam_dir in exams]
+    assert sorted(all_claimed) == EXAMS
+
+
+def test_heartbeat_releases_leases_on_exit(tmp_path):
+    queue = WorkQueue(str(tmp_path), lease_seconds=0.3)
+    with queue.heartbeat():
+        queue.claim(EXAMS[:1])
+        time.sleep(0.4)
+        # renewed in the background, so still live
+        assert WorkQueue(str(tmp_path)).claim(EXAMS[:1], wait=False) is None
+    assert queue.summary(EXAMS[:1]) == {"succeeded": 0, "failed": 0, "leased": 0, "pending": 1}
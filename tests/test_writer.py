@@ -0,0 +1,66 @@
+import threading
+import time
+
+from modified.writer import WriteBatch, WriterPool
+
+
+def test_batch_runs_jobs_in_order_then_cleanup():
+    log = []
+    batch = WriteBatch(jobs=[lambda: log.append("a"), lambda: log.append("b")], cleanup=[lambda: log.append("clean")])
+    assert batch.run() is None
+    assert log == ["a", "b", "clean"]
+
+
+def test_failed_job_is_reported_and_keeps_the_temp_folder():
+    log = []
+
+    def fail():
+        raise OSError("disk full")
+
+    batch = WriteBatch(jobs=[fail, lambda: log.append("b")], cleanup=[lambda: log.append("clean")])
+    error = batch.run()
+    assert "disk full" in error
+    # the other writes still happen, the cleanup does not
+    assert log == ["b"]
+
+
+def test_pool_reports_failures_per_patient():
+    def fail():
+        raise OSError("disk full")
+
+    with WriterPool(threads=2) as writer:
+        ok = writer.submit("patient-1", WriteBatch(jobs=[lambda: None]))
+        failed = writer.submit("patient-2", WriteBatch(jobs=[fail]))
+    assert ok.result() == ("patient-1", None)
+    patient, error = failed.result()
+    assert patient == "patient-2" and "disk full" in error
+    assert list(writer.failures) == ["patient-2"]
+
+
+def test_submit_blocks_while_the_queue_is_full():
+    release = threading.Event()
+    writer = WriterPool(threads=1, max_pending=1)
+    writer.submit("patient-1", WriteBatch(jobs=[release.wait]))
+    submitted = threading.Event()
+
+    def submit_next():
+        writer.submit("patient-2", WriteBatch())
+        submitted.set()
+
+    thread = threading.Thread(target=submit_next)
+    thread.start()
+    time.sleep(0.1)
+    assert not submitted.is_set()
+    release.set()
+    thread.join(timeout=5)
+    assert submitted.is_set()
+    writer.close()
+
+
+def test_close_flushes_pending_writes():
+    written = []
+    writer = WriterPool(threads=1, max_pending=4)
+    for index in range(4):
+        writer.submit(f"patient-{index}", WriteBatch(jobs=[lambda index=index: (time.sleep(0.01), written.append(index))]))
+    writer.close()
+    assert written == [0, 1, 2, 3]